@@ -16,7 +16,8 @@ from django.contrib import messages
 from django.core.cache import cache
 
 from . import models
-from programs import http_funcs, ap
+from programs import http_funcs, blank_funcs, calc_funcs, diff_funcs, diffusion_funcs, filter_funcs, job_funcs, \
+    raw_funcs, regression_funcs, sequence_funcs, upload_funcs, walker_funcs, ap
 from programs.log_funcs import debug_print
 
 
@@ -44,7 +45,7 @@ class CalcHtmlView(http_funcs.ArArView):
 
     def open_arr_file(self, request, *args, **kwargs):
         web_file_path, file_name, extension = \
-            ap.files.basic.upload(request.FILES.get('arr_file'), settings.UPLOAD_ROOT)
+            upload_funcs.upload(request.FILES.get('arr_file'), settings.UPLOAD_ROOT)
         messages.info(request, f'Uploaded file: {web_file_path}')
         try:
             sample = ap.from_arr(web_file_path)
@@ -58,7 +59,7 @@ class CalcHtmlView(http_funcs.ArArView):
     def open_full_xls_file(self, request, *args, **kwargs):
         try:
             web_file_path, file_name, extension = \
-                ap.files.basic.upload(request.FILES.get('full_xls_file'), settings.UPLOAD_ROOT)
+                upload_funcs.upload(request.FILES.get('full_xls_file'), settings.UPLOAD_ROOT)
             messages.info(request, f'Uploaded file: {web_file_path}')
             file_name = file_name if '.full' not in file_name else file_name.split('.full')[0]
             sample = ap.from_full(file_path=web_file_path, sample_name=file_name)
@@ -72,7 +73,7 @@ class CalcHtmlView(http_funcs.ArArView):
     def open_age_file(self, request, *args, **kwargs):
         try:
             web_file_path, sample_name, extension = \
-                ap.files.basic.upload(request.FILES.get('age_file'), settings.UPLOAD_ROOT)
+                upload_funcs.upload(request.FILES.get('age_file'), settings.UPLOAD_ROOT)
             messages.info(request, f'Uploaded file: {web_file_path}')
             sample = ap.from_age(file_path=web_file_path, sample_name=sample_name)
             try:
@@ -103,7 +104,7 @@ class CalcHtmlView(http_funcs.ArArView):
         for i in range(length):
             file = request.FILES.get(str(i))
             try:
-                web_file_path, file_name, suffix = ap.files.basic.upload(
+                web_file_path, file_name, suffix = upload_funcs.upload(
                     file, settings.UPLOAD_ROOT)
                 messages.info(request, f'Uploaded file: {web_file_path}')
             except (Exception, BaseException) as e:
@@ -154,12 +155,13 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
 
     def update_sample_photo(self, request, *args, **kwargs):
         file = request.FILES.get('picture')
-        web_file_path, name, suffix = ap.files.basic.upload(file, os.path.join(settings.STATICFILES_DIRS[0], 'upload'))
+        web_file_path, name, suffix = upload_funcs.upload(file, os.path.join(settings.STATICFILES_DIRS[0], 'upload'))
         messages.info(request, f"Uploaded picture: {web_file_path}")
         return self.JsonResponse({'picture': settings.STATIC_URL + 'upload/' + file.name})
 
     def get_auto_scale(self, request, *args, **kwargs):
         figure_id = self.body['figure_id']
+        self.mark_dirty(figure_id)  # axes are rescaled but not written back
         xscale, yscale = ap.smp.style.reset_plot_scale(smp=self.sample, only_figure=figure_id)
         return self.JsonResponse({
             'status': 'success', 'xMin': xscale[0], 'xMax': xscale[1], 'xInterval': xscale[2],
@@ -199,7 +201,9 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
 
         self.sample.sequence()
 
-        http_funcs.create_cache(self.sample, self.cache_key)  # Update cache
+        # Only components changed from the front and their sample values are written back
+        dirty = http_funcs.get_dirty_fields([*diff.keys(), *res.keys()], *http_funcs.SEQUENCE_ATTRS)
+        http_funcs.create_cache(self.sample, self.cache_key, dirty=dirty)  # Update cache
         return self.JsonResponse(res)
 
     def click_points_update_figures(self, request, *args, **kwargs):
@@ -210,23 +214,26 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
         figures = self.content.pop('figures',
                                    ['figure_2', 'figure_3', 'figure_4', 'figure_5', 'figure_6', 'figure_7', ])
         sample = self.sample
-        components_backup = copy.deepcopy(ap.smp.basic.get_components(sample))
         # debug_print(f"{sample.IsochronMark = }")
 
+        # Selections are kept in Info, replotting changes the isochron figures, only these are compared
+        self.mark_dirty('0', *(ap.smp.plots.ISOCHRON_INDEX_DICT.keys() if auto_replot else []))
+        snapshot = diff_funcs.ComponentSnapshot(sample, self.dirty)
         data_index = clicked_data[-1] - 1  # Isochron plot data label starts from 1, not 0
         sample.set_selection(data_index, [1, 2][current_set == "set2"])
 
         if auto_replot:
             # Re-plot after clicking points
-            sample.recalculate(re_plot=True, isInit=False, isIsochron=True, isPlateau=False, figures=figures)
+            # Regressions of selections seen before are taken from the memo
+            calc_funcs.replot_isochrons(sample, figures=figures)
             # ap.recalculate(sample, re_plot=True, isInit=False, isIsochron=True, isPlateau=True)
 
         # Response are changes in sample.Components, in this way we can decrease the size of response.
-        res = ap.smp.basic.get_diff_smp(
-            backup=components_backup, smp=ap.smp.basic.get_components(sample))
+        res = snapshot.get_diff()
         # Update isochron table data, changes in isotope table is not required to transfer
         ap.smp.table.update_table_data(sample, only_table='7')
-        http_funcs.create_cache(sample, self.cache_key)  # 更新缓存
+        self.mark_dirty('7', *http_funcs.SEQUENCE_ATTRS)
+        http_funcs.create_cache(sample, self.cache_key, dirty=http_funcs.get_dirty_fields(self.dirty))  # 更新缓存
         # debug_print(f"在点击事件结束之后 {sample.IsochronMark = }")
 
         return self.JsonResponse({'res': ap.smp.json.dumps(res)})
@@ -237,16 +244,24 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
         data = self.body['data']
         sample = self.sample
         messages.info(request, f'Updating handsontable, btn id: {btn_id}')
-        # backup for later comparision
-        components_backup = copy.deepcopy(ap.smp.basic.get_components(sample))
+        total_params = list(sample.TotalParam)
         try:
+            if btn_id != '0':
+                data = ap.calc.arr.remove_empty(data)
+                if len(data) == 0:
+                    raise ValueError("The length of data list must be greater than 0")
+            # Components changed by the edit, only these are compared for the response
+            if btn_id in ['0', '7']:
+                self.mark_dirty(*(['0'] if btn_id == '0' else ap.smp.basic.get_components(sample).keys()))
+            elif len(data) > 1 and data[1] != sample.SequenceValue:
+                self.mark_dirty(*http_funcs.TABLE_VALUE_ATTRS.keys())  # values of sequences are in all tables
+            else:
+                self.mark_dirty(btn_id)
+            snapshot = diff_funcs.ComponentSnapshot(sample, self.dirty)
             if btn_id == '0':  # 实验信息
                 ap.smp.basic.update_plot_from_dict(sample.Info, data)
                 messages.info(request, f'Update completed, btn id: {btn_id}')
             else:
-                data = ap.calc.arr.remove_empty(data)
-                if len(data) == 0:
-                    raise ValueError("The length of data list must be greater than 0")
                 sample.update_table(data, btn_id)
                 if btn_id == '7':
                     # Re-calculate isochron and plateau data, and replot.
@@ -262,8 +277,15 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
             messages.error(request, e)
             return self.JsonResponse({'msg': f'Error: {e}'}, status=403)
 
-        http_funcs.create_cache(sample, self.cache_key)  # Update cache
-        res = ap.smp.basic.get_diff_smp(components_backup, ap.smp.basic.get_components(sample))
+        # Steps reading the edited values are evaluated by the next recalculation
+        if btn_id == '8':
+            calc_funcs.mark_dirty(self.cache_key, calc_funcs.get_param_steps(total_params, sample.TotalParam))
+        elif btn_id in calc_funcs.TABLE_STEPS:
+            calc_funcs.mark_dirty(self.cache_key, [calc_funcs.TABLE_STEPS[btn_id]])
+        res = snapshot.get_diff()
+        if btn_id != '0':
+            self.mark_dirty(*http_funcs.SEQUENCE_ATTRS)
+        http_funcs.create_cache(sample, self.cache_key, dirty=http_funcs.get_dirty_fields(self.dirty))  # Update cache
         messages.info(request, f"Keys of difference: {list(res.keys())}")
         return self.JsonResponse({'changed_components': ap.smp.json.dumps(res)})
 
@@ -308,7 +330,7 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
 
     def recalculation(self, request, *args, **kwargs):
         sample = self.sample
-        checked_options = self.content['checked_options']
+        checked_options = self.content.get('checked_options', [])
         others = self.content.pop('others', {})
         isochron_mark = self.content.pop('isochron_mark', False)
         # debug_print(f"Recalculation Isochron Mark = {isochron_mark}")
@@ -320,20 +342,32 @@ class ButtonsResponseObjectView(http_funcs.ArArView):
         if isochron_mark:
             sample.IsochronMark = isochron_mark.copy()
             sample.sequence()
-        # backup for later comparision
-        components_backup = copy.deepcopy(ap.smp.basic.get_components(sample))
+        # Fingerprinted backup for later comparision
+        snapshot = diff_funcs.ComponentSnapshot(sample)
+        # Selected steps and steps marked dirty by previous changes, steps downstream of them are included
+        steps = [*calc_funcs.get_steps(checked_options), *calc_funcs.get_dirty(self.cache_key)]
+        monte_carlo = bool(checked_options[11]) if len(checked_options) > 11 else False
+        if job_funcs.is_async(self.content):
+            # Changes of marks and preference are saved for the job, the client polls api/job_status
+            http_funcs.create_cache(sample, self.cache_key)
+            job_id = job_funcs.submit_job('recalculation', job_funcs.recalculation_job, self.cache_key, steps,
+                                          monte_carlo, others, cache_key=self.cache_key)
+            messages.info(request, f"Recalculation job submitted: {job_id}")
+            return self.JsonResponse({'msg': "Recalculation job submitted", 'job_id': job_id})
         try:
             # Re-calculating based on selected options
-            sample.recalculate(*checked_options, **others)
+            steps = calc_funcs.recalculate(sample, steps, monte_carlo=monte_carlo, **others)
             # sample = ap.recalculate(sample, *checked_options)
         except Exception as e:
             debug_print(traceback.format_exc())
             messages.error(request, e)
             return self.JsonResponse({'msg': f'Error in recalculating: {e}'}, status=403)
+        calc_funcs.clear_dirty(self.cache_key)
+        messages.info(request, f"Recalculated steps: {steps}")
         ap.smp.table.update_table_data(sample)  # Update data of tables after re-calculation
         # Update cache
         http_funcs.create_cache(sample, self.cache_key)
-        res = ap.smp.basic.get_diff_smp(backup=components_backup, smp=ap.smp.basic.get_components(sample))
+        res = snapshot.get_diff()
         messages.info(request, f"Recalculation completed. Keys of difference: {list(res.keys())}")
         return self.JsonResponse({'msg': "Success to recalculate", 'res': ap.smp.json.dumps(res)})
 
@@ -376,7 +410,7 @@ class RawFileView(http_funcs.ArArView):
         names = list(models.InputFilterParams.objects.values_list('name', flat=True))
         for file in request.FILES.getlist('raw_file'):
             try:
-                web_file_path, file_name, suffix = ap.files.basic.upload(
+                web_file_path, file_name, suffix = upload_funcs.upload(
                     file, settings.UPLOAD_ROOT)
             except (Exception, BaseException) as e:
                 messages.error(request, e)
@@ -397,8 +431,8 @@ class RawFileView(http_funcs.ArArView):
         print(f"{filter_name = }")
         filter_paths = [getattr(models, "InputFilterParams").objects.get(name=each).file_path for each in filter_name]
         try:
-            raw = ap.smp.raw.to_raw(file_path=file_path, input_filter_path=filter_paths)
-            raw.do_regression()
+            raw = raw_funcs.to_raw(file_path=file_path, input_filter_path=filter_paths, ip=self.ip)
+            regression_funcs.do_regression(raw)
 
             allIrraNames = list(models.IrraParams.objects.values_list('name', flat=True))
             allCalcNames = list(models.CalcParams.objects.values_list('name', flat=True))
@@ -406,8 +440,9 @@ class RawFileView(http_funcs.ArArView):
 
             # update cache
             cache_key = http_funcs.create_cache(raw)
+            regression_funcs.set_validity(raw, cache_key)
             return self.render(request, 'extrapolate.html', {
-                'raw_data': ap.smp.json.dumps(raw), 'raw_cache_key': ap.smp.json.dumps(cache_key),
+                'raw_data': ap.smp.json.dumps(sequence_funcs.get_summary(raw)), 'raw_cache_key': ap.smp.json.dumps(cache_key),
                 'allIrraNames': allIrraNames, 'allCalcNames': allCalcNames, 'allSmpNames': allSmpNames
             })
         except FileNotFoundError as e:
@@ -433,6 +468,13 @@ class RawFileView(http_funcs.ArArView):
 
         raw: ap.RawData = self.sample
 
+        # Regressions of the sequences of the mapping should be numbers
+        names = {row.get(key) for row in selectedSequences for key in ['unknown', 'blank']}
+        failed = regression_funcs.get_failed(raw, self.cache_key, names=names)
+        if failed:
+            failed = sorted(list(set([seq[0] + 1 for seq in failed])))
+            return self.JsonResponse({'msg': f"Errors in regression results of sequences: {failed}"}, status=403)
+
         # create sample
         sample = raw.to_sample(selectedSequences)
 
@@ -451,8 +493,16 @@ class RawFileView(http_funcs.ArArView):
             sample.set_params(sampleParams['param'], 'smp', rows)
         except (BaseException, Exception):
             debug_print(traceback.format_exc())
+        if job_funcs.is_async(self.body):
+            # The sample is cached with this key once the job is finished
+            cache_key = http_funcs.create_cache_key()
+            http_funcs.set_mysql(request, models.CalcRecord, fingerprint, cache_key=cache_key)
+            job_id = job_funcs.submit_job('raw_data_submit', job_funcs.raw_data_submit_job, sample, cache_key,
+                                          cache_key=cache_key)
+            messages.info(request, f"Calculation job submitted: {job_id}")
+            return self.JsonResponse({'job_id': job_id, 'cache_key': cache_key})
         try:
-            sample.recalculate(*[True] * 11, False, *[True] * 4)  # Calculation after submitting row data
+            calc_funcs.recalculate(sample, ['initial'])  # Calculation after submitting row data, all steps
             # ap.recalculate(sample, *[True] * 12)  # Calculation after submitting row data
             ap.smp.table.update_table_data(sample)  # Update table after submission row data and calculation
         except (Exception, BaseException) as e:
@@ -471,16 +521,18 @@ class RawFileView(http_funcs.ArArView):
     def import_blank_file(self, request, *args, **kwargs):
         file = request.FILES.get('blank_file')
         cache_key = request.POST.get('cache_key')
-        raw: ap.RawData = pickle.loads(cache.get(cache_key))
+        raw: ap.RawData = http_funcs.cache_load(cache_key)
 
-        web_file_path, file_name, suffix = ap.files.basic.upload(
+        web_file_path, file_name, suffix = upload_funcs.upload(
             file, settings.UPLOAD_ROOT)
+        results_only = request.POST.get('results_only')
+        results_only = sequence_funcs.SEQUENCE_IMPORT_RESULTS_ONLY if results_only is None \
+            else results_only.lower() in ['true', '1']
         try:
-            with open(web_file_path, 'rb') as f:
-                sequences = pickle.load(f)
-        except pickle.UnpicklingError:
+            sequences = sequence_funcs.load(web_file_path, results_only=results_only)
+        except (pickle.UnpicklingError, ValueError, KeyError, EOFError) as e:
             return self.JsonResponse({
-                'msg': "The file input cannot be unpicked. Please check the file format"},
+                'msg': f"The sequence file cannot be read. Please check the file format. {e}"},
                 encoder=ap.smp.json.MyEncoder, status=403)
 
         raw.sequence = ap.calc.arr.multi_append(raw.sequence, *sequences)
@@ -539,6 +591,21 @@ class RawFileView(http_funcs.ArArView):
         http_funcs.create_cache(raw, cache_key=self.cache_key)  # update raw
         return self.JsonResponse({})
 
+    def get_raw_sequences(self, request, *args, **kwargs):
+        """
+        Cycles of sequences of a raw data, the sequences are given by indexes or by a page of
+        start and stop, and encoding is json or binary, see sequence_funcs.encode_cycles
+        """
+        raw: ap.RawData = self.sample
+        indexes = self.body.get('indexes')
+        if indexes is None:
+            indexes = range(len(raw.sequence))[self.body.get('start', 0):self.body.get('stop')]
+        encoding = self.body.get('encoding', 'json')
+        sequences = {index: sequence_funcs.encode_cycles(raw.sequence[index], encoding)
+                     for index in indexes if 0 <= index < len(raw.sequence)}
+        return self.JsonResponse({'sequences': sequences}, encoder=ap.smp.json.MyEncoder,
+                                 content_type='application/json', safe=True)
+
     def calc_raw_chart_clicked(self, request, *args, **kwargs):
         try:
             selectionForAll = self.body['selectionForAll']
@@ -553,7 +620,7 @@ class RawFileView(http_funcs.ArArView):
                     raw.sequence[sequence_index].flag[each][_isotope * 2 + 1] = status
                     raw.sequence[sequence_index].flag[each][_isotope * 2 + 2] = status
 
-            raw.do_regression(sequence_index=[sequence_index], isotopic_index=isotopic_index)
+            regression_funcs.update_regression(raw, sequence_index, cache_key=self.cache_key)
         except (BaseException, Exception) as e:
             debug_print(traceback.format_exc())
             self.error_msg = f"{e}"
@@ -567,15 +634,15 @@ class RawFileView(http_funcs.ArArView):
 
     def calc_raw_average_blanks(self, request, *args, **kwargs):
         blanks = self.body['blanks']
+        intercepts, errors, relative_errors = blank_funcs.average(
+            np.array([[j[i]['intercept'] for i in range(5)] for j in blanks], dtype=float),
+            np.array([[j[i]['absolute err'] for i in range(5)] for j in blanks], dtype=float))
         newBlank = []
         results = []
-        for i in range(5):
-            _intercept = sum([j[i]['intercept'] for j in blanks]) / len(blanks)
-            _err = ap.calc.err.div(
-                (_intercept, ap.calc.err.add(*[j[i]['absolute err'] for j in blanks])), (len(blanks), 0))
-            _relative_err = _err / _intercept * 100
+        for i, (_intercept, _err, _relative_err) in enumerate(zip(
+                intercepts.tolist(), errors.tolist(), relative_errors.tolist())):
             isotope = {
-                'isotope': ["Ar36", "Ar37", "Ar38", "Ar39", "Ar40"][i],
+                'isotope': blank_funcs.ISOTOPES[i],
                 'intercept': _intercept, 'absolute err': _err, 'relative err': _relative_err, 'r2': None, 'mswd': None
             }
             newBlank.append(isotope)
@@ -619,17 +686,41 @@ class RawFileView(http_funcs.ArArView):
         return self.JsonResponse({'sequences': new_sequences},
                             encoder=ap.smp.json.MyEncoder, content_type='application/json', safe=True)
 
+    def calc_raw_blank_evolution(self, request, *args, **kwargs):
+        """
+        Interpolated blanks computed on the server, for the unknowns and the given blanks
+        Parameters
+        ----------
+        request : body of blanks, list of names of blank sequences, mode, 'linear',
+            'polynomial', 'nearest' or 'average', or a list of modes for each isotope, and
+            degree of polynomials, default 2, or a list of degrees for each isotope
+
+        Returns
+        -------
+        interpolated blank sequences, saved as raw.interpolated_blank
+        """
+        names = list(self.body['blanks'])
+        mode = self.body.get('mode', 'linear')
+        degree = self.body.get('degree', 2)
+        raw: ap.RawData = self.sample
+        blanks = [seq for seq in raw.sequence if seq.name in names]
+        # Same sequences as the datetime list of the interpolation dialog
+        sequences = [seq for seq in raw.sequence if seq.name in names or not seq.is_blank()]
+        try:
+            new_sequences = blank_funcs.get_interpolated_blanks(blanks, sequences, mode=mode, degree=degree)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            return self.JsonResponse({'msg': f"Blank interpolation failed: {e}"}, status=403)
+        raw.interpolated_blank = new_sequences
+
+        http_funcs.create_cache(raw, cache_key=self.cache_key)  # update cache
+
+        return self.JsonResponse({'sequences': new_sequences},
+                                 encoder=ap.smp.json.MyEncoder, content_type='application/json', safe=True)
+
     def check_regression(self, request, *args, **kwargs):
         raw: ap.RawData = self.sample
 
-        failed = []
-        for seq in raw.sequence:
-            if seq.is_removed:
-                continue
-            for ar in range(5):
-                regression_res = seq.results[ar][seq.fitting_method[ar]]
-                if not all([isinstance(i, (float, int)) for i in regression_res]):
-                    failed.append([seq.index, seq.name, f"Ar{36+ar}"])
+        failed = regression_funcs.get_failed(raw, self.cache_key)
 
         msg = "All sequence are valid for later calculation!"
         if failed:
@@ -666,8 +757,7 @@ class RawFileView(http_funcs.ArArView):
         file_path = os.path.join(settings.DOWNLOAD_ROOT,
                                  f"{sequences[0].name}{' et al' if len(sequences) > 1 else ''}.seq")
         export_href = '/' + settings.DOWNLOAD_URL + f"{sequences[0].name}{' et al' if len(sequences) > 1 else ''}.seq"
-        with open(file_path, 'wb') as f:  # save serialized json data to a readable text
-            f.write(pickle.dumps(sequences))
+        sequence_funcs.dump(sequences, file_path)
         messages.info(request, f"Export selected sequences completed")
         return self.JsonResponse({"href": export_href})
 
@@ -805,11 +895,13 @@ class ParamsSettingView(http_funcs.ArArView):
             if pin == old.pin:
                 if flag == 'update':
                     path = ap.files.basic.write(old.file_path, params)
+                    filter_funcs.invalidate_filter_plan(old.file_path)
                     old.save()
                     messages.info(request, f'Update parameter project successfully. A {type.lower()} project has been updated, name: {name}, path: {path}')
                     return self.JsonResponse({'status': 'success'})
                 elif flag == 'delete':
                     if ap.files.basic.delete(old.file_path):
+                        filter_funcs.invalidate_filter_plan(old.file_path)
                         old.delete()
                         messages.info(request, f'Delete parameter project successfully. A {type.lower()} project has been deleted, name: {name}')
                         return self.JsonResponse({'status': 'success'})
@@ -826,9 +918,16 @@ class ParamsSettingView(http_funcs.ArArView):
         param_type = str(self.body['type'])  # type = 'irra', or 'calc', or 'smp'
         rows = [i - 1 for i in list(self.body['rows'])]  # zero based
         debug_print(f"{rows = }")
+        if job_funcs.is_async(self.body):
+            # Params are set and the steps reading them are recalculated in the job
+            job_id = job_funcs.submit_job('set_params', job_funcs.set_params_job, self.cache_key, params,
+                                          param_type, rows, cache_key=self.cache_key)
+            messages.info(request, f"Set parameters job submitted: {job_id}")
+            return self.JsonResponse({'msg': 'Set parameters job submitted', 'job_id': job_id})
         sample = self.sample
-        # backup for later comparision
-        components_backup = copy.deepcopy(ap.smp.basic.get_components(sample))
+        # Fingerprinted backup for later comparision
+        snapshot = diff_funcs.ComponentSnapshot(sample)
+        total_params = list(sample.TotalParam)  # rows are replaced rather than changed in place
 
         try:
             sample.set_params(params, param_type, rows)
@@ -841,10 +940,12 @@ class ParamsSettingView(http_funcs.ArArView):
             messages.error(request, f'Set parameters, unknown error: {type(e).__name__}: {str(e)}')
             return self.JsonResponse({'msg': f'{type(e).__name__}: {str(e)}'}, status=403)
 
+        # Steps reading the changed params are evaluated by the next recalculation
+        calc_funcs.mark_dirty(self.cache_key, calc_funcs.get_param_steps(total_params, sample.TotalParam))
         ap.smp.table.update_table_data(sample)  # Update data of tables after changes of calculation parameters
         # update cache
         http_funcs.create_cache(sample, self.cache_key)
-        res = ap.smp.basic.get_diff_smp(backup=components_backup, smp=ap.smp.basic.get_components(sample))
+        res = snapshot.get_diff()
         # debug_print(f"Diff after reset_calc_params: {res}")
         messages.error(request, f'Set parameters completed')
         return self.JsonResponse({'msg': 'Successfully!', 'changed_components': ap.smp.json.dumps(res)}, status=200)
@@ -874,7 +975,7 @@ class ThermoView(http_funcs.ArArView):
         for i in range(len(request.FILES)):
             try:
                 file = request.FILES.get(str(i))
-                web_file_path, file_name, suffix = ap.files.basic.upload(file, destination_folder)
+                web_file_path, file_name, suffix = upload_funcs.upload(file, destination_folder)
             except (Exception, BaseException) as e:
                 pass
             else:
@@ -1152,35 +1253,47 @@ class ThermoView(http_funcs.ArArView):
             e_combinations = [energies[: ndoms]]
             f_combinations = [fractions[: ndoms]]
 
-        for index, (_e, _f) in enumerate(list(itertools.product(*[e_combinations, f_combinations]))):
-            debug_print(f"{index = }, {_e = }, {_f = }")
-
-            file_name = f"{'walker1' if use_walker1 else 'walker2'} {k=:.1f} " \
-                        f"es={'-'.join([str(int(i / 1000)) for i in _e])} " \
-                        f"fs={'-'.join([str(i) for i in _f])} " \
-                        f"{gs=:.0f} " \
-                        f"{ad=:.0e} " \
-                        f"{f=:.0e} " \
-                        f"{ndoms=:.0f} " \
-                        f"pumping={checkable_params[6]} " \
-                        f"multi"
-
-            try:
-                _start = time.time()
-                demo, status = ap.thermo.arw.run(
-                    times, temps, statuses,
-                    _e, _f, ndoms, file_name=file_name, k=k, grain_szie=gs, dimension=dimension,
-                    atom_density=ad, frequency=f, simulation=False, targets=targets, epsilon=0.05, use_walker1=use_walker1
-                )
-            except ap.thermo.arw.OverEpsilonError as e:
-                debug_print(traceback.format_exc())
-                return self.JsonResponse({})
-            else:
-                debug_print(traceback.format_exc())
-                ap.thermo.arw.save_ads(demo, f"{loc}", name=demo.name + f" {(time.time() - _start) / 3600:.2f}h")
-
-        return self.JsonResponse({})
+        combinations = list(itertools.product(*[e_combinations, f_combinations]))
+        if self.body.get('forward_model'):
+            # Screen the combinations with the analytical model instead of walking
+            misfits, measured = diffusion_funcs.screen(
+                targets, times, temps, statuses, [_e for _e, _f in combinations], [_f for _e, _f in combinations],
+                grain_size=gs, dimension=dimension, atom_density=ad, frequency=f,
+                geometry=self.body.get('geometry') or 'cube')
+            order = np.argsort(misfits)[:int(self.body.get('limit', 100))]
+            return self.JsonResponse({'models': [
+                {'energies': list(combinations[i][0]), 'fractions': list(combinations[i][1]),
+                 'misfit': float(misfits[i]), 'measured': measured[i].tolist()} for i in order.tolist()
+            ], 'total': len(combinations)}, encoder=ap.smp.json.MyEncoder)
+
+        # Combinations run in the walker pool, the client polls walker_status with the sweep id
+        sweep_id = walker_funcs.submit_sweep(
+            combinations, loc, times, temps, statuses, targets, ndoms, use_walker1, k, gs, ad, f,
+            pumping=checkable_params[6], dimension=dimension,
+            engine='array' if domain_params[16] == "array" else 'ararpy')
+        debug_print(f"{sweep_id = }, {len(combinations) = }")
+        return self.JsonResponse({'sweep_id': sweep_id, 'total': len(combinations)})
+
+    def resume_walker(self, request, *args, **kwargs):
+        # Submit again the unfinished combinations of a sweep from its checkpoint in the workspace
+        random_index = self.body['random_index']
+        sweep_id = str(self.body['sweep_id'])
+        loc = os.path.join(settings.MDD_ROOT, f'{random_index}')
+        if random_index == "" or not os.path.exists(walker_funcs.get_checkpoint_path(loc, sweep_id)):
+            return self.JsonResponse({'msg': f"Sweep checkpoint not found: {sweep_id}"}, status=404)
+        try:
+            sweep_id = walker_funcs.resume_sweep(loc, sweep_id)
+        except walker_funcs.SweepRunningError as e:
+            return self.JsonResponse({'msg': f"{e}"}, status=403)
+        sweep = walker_funcs.get_sweep(sweep_id)
+        return self.JsonResponse({'sweep_id': sweep_id, 'total': sweep['total'], 'done': sweep['done']})
 
+    def walker_status(self, request, *args, **kwargs):
+        # State of a walker parameter sweep and of each of its combinations
+        sweep = walker_funcs.get_sweep(str(self.body['sweep_id']))
+        if sweep is None:
+            return self.JsonResponse({'msg': f"Sweep not found: {self.body['sweep_id']}"}, status=404)
+        return self.JsonResponse(sweep)
 
     def run_40ar_walker(self, request, *args, **kwargs):
         sample_name = self.body['sample_name']
@@ -1494,6 +1607,12 @@ class ThermoView(http_funcs.ArArView):
                         diff = ap.thermo.arw.read_ads(os.path.join(loc, f))
                         debug_print(f"{f = }, {len(diff.released_per_step) = }, {diff.atom_density = :.0e}")
                         ads_released.append(np.array(diff.released_per_step) / diff.natoms)
+                    elif f.endswith(".npz") and f.startswith("array "):  # models of the array walker
+                        if not os.path.exists(os.path.join(loc, f)):
+                            continue
+                        index += 1
+                        release_name.append(f"Released{index}: {f}")
+                        ads_released.append(diffusion_funcs.read_released(os.path.join(loc, f)))
 
             ads_released = np.transpose(ads_released)
 
@@ -1667,7 +1786,7 @@ class ApiView(http_funcs.ArArView):
         debug_print(f"Number of files: {len(files)}")
         for file in files:
             try:
-                web_file_path, file_name, suffix = ap.files.basic.upload(
+                web_file_path, file_name, suffix = upload_funcs.upload(
                     file, settings.UPLOAD_ROOT)
             except (Exception, BaseException):
                 continue
@@ -1677,6 +1796,20 @@ class ApiView(http_funcs.ArArView):
                 })
         return self.JsonResponse({'files': res})
 
+    def job_status(self, request, *args, **kwargs):
+        # State, stage progress and result of a background job
+        job = job_funcs.get_job(str(self.body['job_id']))
+        if job is None:
+            return self.JsonResponse({'msg': f"Job not found: {self.body['job_id']}"}, status=404)
+        return self.JsonResponse(job)
+
+    def cache_stats(self, request, *args, **kwargs):
+        # Hit and miss counters of the live sample cache, the isochron memo, the parsed raw files and the
+        # upload store in this worker
+        return self.JsonResponse({**http_funcs.sample_lru.stats(), 'isochron_memo': calc_funcs.isochron_memo.stats(),
+                                  'raw_files': raw_funcs.raw_file_cache.stats(),
+                                  'uploads': upload_funcs.upload_store.stats()})
+
     def export_arr(self, request, *args, **kwargs):
         sample = self.sample
         debug_print(self.sample.Info.results.isochron['figure_2'])
@@ -0,0 +1,174 @@
+"""
+Blank evolution.
+
+Blanks of the unknowns of a run are estimated from the measured blank sequences as
+functions of time. Values of all unknowns and all five isotopes are computed at once on
+arrays of shape (sequences, isotopes), with errors propagated from the blank intercepts
+(linear, nearest, average) or from the scatter of the blanks about the fitted curve
+(polynomial).
+"""
+from datetime import datetime, timezone
+import numpy as np
+from . import ap
+
+ISOTOPES = ["Ar36", "Ar37", "Ar38", "Ar39", "Ar40"]
+MODES = ['linear', 'polynomial', 'nearest', 'average']
+
+
+def get_timestamp(string: str):
+    """
+    Seconds since 1970-01-01 of an ISO datetime of a sequence, naive datetimes are UTC
+    """
+    dt = datetime.fromisoformat(str(string))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def get_intercepts(sequences: list):
+    """
+    Intercepts and absolute errors of the selected fitting methods of sequences
+    Returns
+    -------
+    values, errors : arrays of shape (sequences, 5)
+    """
+    res = [[seq.results[i][int(seq.fitting_method[i])][:2] for i in range(5)] for seq in sequences]
+    try:
+        res = np.array(res, dtype=float).reshape(len(sequences), 5, 2)
+    except (TypeError, ValueError):
+        failed = [f"{seq.name} {ISOTOPES[i]}" for seq, row in zip(sequences, res) for i in range(5)
+                  if not all([isinstance(j, (float, int)) for j in row[i]])]
+        raise ValueError(f"Invalid regression results of blanks: {', '.join(failed)}")
+    return res[:, :, 0], res[:, :, 1]
+
+
+def average(values, errors):
+    """
+    Mean of blanks and its error sqrt(sum(s ** 2)) / n, for all isotopes at once
+    Parameters
+    ----------
+    values, errors : arrays of shape (blanks, isotopes)
+
+    Returns
+    -------
+    intercepts, errors and relative errors in percent, arrays of shape (isotopes,)
+    """
+    n = len(values)
+    intercept = np.sum(values, axis=0) / n
+    err = np.sqrt(np.sum(errors ** 2, axis=0)) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intercept, err, err / intercept * 100
+
+
+def linear(t_blank, values, errors, t):
+    """
+    Interpolation between the blanks measured before and after each time, blanks before
+    the first or after the last blank are the first or last blank
+    """
+    k = np.clip(np.searchsorted(t_blank, t, side='right'), 1, len(t_blank) - 1)
+    t0, t1 = t_blank[k - 1], t_blank[k]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(t1 > t0, (t - t0) / (t1 - t0), 0)
+    w = np.clip(w, 0, 1)[:, np.newaxis]
+    value = (1 - w) * values[k - 1] + w * values[k]
+    err = np.sqrt(((1 - w) * errors[k - 1]) ** 2 + (w * errors[k]) ** 2)
+    return value, err
+
+
+def nearest(t_blank, values, errors, t):
+    """
+    Blanks measured closest in time, the earlier one for ties
+    """
+    k = np.clip(np.searchsorted(t_blank, t, side='left'), 1, len(t_blank) - 1)
+    k = np.where(np.abs(t - t_blank[k - 1]) <= np.abs(t_blank[k] - t), k - 1, k)
+    return values[k], errors[k]
+
+
+def polynomial(t_blank, values, errors, t, degree: int = 2):
+    """
+    Least-squares polynomials of time fitted to the blanks of all isotopes. Errors are the
+    standard errors of the fitted values, sey * sqrt(x0' (X'X)^-1 x0), as for the errors of
+    intercepts of ap.calc.regression.linest, and NaN if there are no degrees of freedom.
+    """
+    if len(t_blank) < degree + 1:
+        raise ValueError(f"At least {degree + 1} blanks are required for a polynomial of degree {degree}")
+    # Times are centred and scaled before taking powers
+    center = t_blank.mean()
+    scale = np.ptp(t_blank) or 1
+    x = np.vander((t_blank - center) / scale, degree + 1, increasing=True)
+    x0 = np.vander((t - center) / scale, degree + 1, increasing=True)
+    beta, *_ = np.linalg.lstsq(x, values, rcond=None)
+    dof = len(t_blank) - degree - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sey = np.sqrt(np.sum((values - x @ beta) ** 2, axis=0) / dof) if dof > 0 else np.full(values.shape[1], np.nan)
+    h = np.sum((x0 @ np.linalg.pinv(x.T @ x)) * x0, axis=1)
+    return x0 @ beta, np.sqrt(h)[:, np.newaxis] * sey
+
+
+def evolve(t_blank, values, errors, t, mode='linear', degree=2):
+    """
+    Blanks at times t
+    Parameters
+    ----------
+    t_blank : times of the blanks in seconds, shape (blanks,)
+    values, errors : intercepts and absolute errors of the blanks, shape (blanks, isotopes)
+    t : times of the unknowns in seconds, shape (unknowns,)
+    mode : 'linear', 'polynomial', 'nearest' or 'average', or a list of them, one for each
+        isotope
+    degree : degree of polynomials, or a list of degrees for each isotope
+
+    Returns
+    -------
+    values and absolute errors of blanks at times t, arrays of shape (unknowns, isotopes)
+    """
+    t_blank, values, errors, t = [np.asarray(i, dtype=float) for i in [t_blank, values, errors, t]]
+    if len(t_blank) == 0:
+        raise ValueError("No blank sequences given")
+    order = np.argsort(t_blank, kind='stable')
+    t_blank, values, errors = t_blank[order], values[order], errors[order]
+    modes = [mode] * values.shape[1] if isinstance(mode, str) else list(mode)
+    degrees = [int(degree)] * values.shape[1] if isinstance(degree, (int, float)) else [int(i) for i in degree]
+    value, err = np.full((len(t), values.shape[1]), np.nan), np.full((len(t), values.shape[1]), np.nan)
+    # Isotopes of the same mode and degree are computed together
+    for _mode, _degree in set(zip(modes, degrees)):
+        cols = [i for i, each in enumerate(zip(modes, degrees)) if each == (_mode, _degree)]
+        if _mode == 'average':
+            _value, _err, _ = average(values[:, cols], errors[:, cols])
+            value[:, cols], err[:, cols] = _value, _err
+        elif _mode == 'polynomial':
+            value[:, cols], err[:, cols] = polynomial(t_blank, values[:, cols], errors[:, cols], t, degree=_degree)
+        elif _mode in ['linear', 'nearest'] and len(t_blank) == 1:
+            value[:, cols], err[:, cols] = values[0, cols], errors[0, cols]
+        elif _mode in ['linear', 'nearest']:
+            func = linear if _mode == 'linear' else nearest
+            value[:, cols], err[:, cols] = func(t_blank, values[:, cols], errors[:, cols], t)
+        else:
+            raise ValueError(f"Unknown mode of blank evolution: {_mode}, should be one of {MODES}")
+    return value, err
+
+
+def get_interpolated_blanks(blanks: list, sequences: list, mode='linear', degree=2):
+    """
+    Blank sequences for raw.interpolated_blank
+    Parameters
+    ----------
+    blanks : blank Sequences
+    sequences : Sequences the blanks are estimated for, ap.smp.initial matches them with
+        the interpolated blanks by datetime
+    mode, degree : see evolve
+
+    Returns
+    -------
+    list of Sequences
+    """
+    values, errors = get_intercepts(blanks)
+    t = [get_timestamp(seq.datetime) for seq in sequences]
+    value, err = evolve([get_timestamp(seq.datetime) for seq in blanks], values, errors, t, mode=mode, degree=degree)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = (err / value * 100).tolist()
+    value, err = value.tolist(), err.tolist()
+    return [ap.Sequence(
+        name="Interpolated Blank", fitting_method=[0, 0, 0, 0, 0], index=index, datetime=seq.datetime,
+        type_str='blank', is_estimated=True,
+        results=[[[value[index][i], err[index][i], relative[index][i], np.nan]] for i in range(5)],
+    ) for index, seq in enumerate(sequences)]
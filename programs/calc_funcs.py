@@ -0,0 +1,330 @@
+"""
+Incremental recalculation of samples.
+
+The steps of ap.smp.calculation.recalculate are declared as a dependency graph. A change
+marks the steps reading the changed values dirty, and only these steps and the ones
+downstream of them are evaluated, instead of hand-picking the option flags.
+"""
+import copy
+import hashlib
+import pickle
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from . import ap
+from .http_funcs import DEFAULT_CACHE_TIMEOUT
+
+# Number of isochron regression results kept per worker
+ISOCHRON_MEMO_SIZE = getattr(settings, 'ISOCHRON_MEMO_SIZE', 4096)
+# How regressions of different isochron figures are run: 'serial', 'thread' or 'process'
+ISOCHRON_EXECUTOR = getattr(settings, 'ISOCHRON_EXECUTOR', 'serial')
+ISOCHRON_WORKERS = getattr(settings, 'ISOCHRON_WORKERS', None)
+
+# Steps in the order of the option flags of Sample.recalculate, monte_carlo (index 11) is
+# a modifier of calc_ratio rather than a step
+RECALC_STEPS = [
+    'initial', 'corr_blank', 'corr_massdiscr', 'corr_decay', 'degas_ca', 'degas_k', 'degas_cl',
+    'degas_atm', 'degas_r', 'calc_ratio', 'apparent_age', 'monte_carlo', 'plot', 'plot_style',
+    'table', 'table_style',
+]
+
+# Steps reading the results of each step. Corrections and degassing are applied one after
+# another on CorrectedValues, so they form a chain; plots and tables read the final values.
+# Styles are not reset by changes of values, they are only evaluated when asked for or
+# when the sample is initialized.
+RECALC_GRAPH = {
+    'initial': ['corr_blank', 'plot_style', 'table_style'],
+    'corr_blank': ['corr_massdiscr'],
+    'corr_massdiscr': ['corr_decay'],
+    'corr_decay': ['degas_ca'],
+    'degas_ca': ['degas_k'],
+    'degas_k': ['degas_cl'],
+    'degas_cl': ['degas_atm'],
+    'degas_atm': ['degas_r'],
+    'degas_r': ['calc_ratio'],
+    'calc_ratio': ['apparent_age', 'plot', 'table'],
+    'apparent_age': ['plot', 'table'],
+    'plot': [],
+    'plot_style': [],
+    'table': [],
+    'table_style': [],
+}
+
+# First step reading each row range of Sample.TotalParam, rows not listed here are
+# conservatively taken as inputs of corr_blank, i.e. they trigger a full recalculation
+PARAM_STEPS = [
+    ((101, 103), 'corr_blank'), ((111, 112), 'corr_blank'), ((126, 136), 'corr_blank'),
+    ((69, 81), 'corr_massdiscr'), ((100, 101), 'corr_massdiscr'), ((103, 104), 'corr_massdiscr'),
+    ((27, 32), 'corr_decay'), ((42, 46), 'corr_decay'), ((104, 106), 'corr_decay'),
+    ((8, 14), 'degas_ca'), ((106, 107), 'degas_ca'),
+    ((14, 18), 'degas_k'), ((107, 108), 'degas_k'),
+    ((4, 6), 'degas_cl'), ((32, 33), 'degas_cl'), ((46, 48), 'degas_cl'), ((56, 58), 'degas_cl'),
+    ((108, 109), 'degas_cl'),
+    ((0, 2), 'degas_atm'), ((109, 110), 'degas_atm'),
+    ((20, 22), 'calc_ratio'),
+    ((34, 36), 'apparent_age'), ((58, 69), 'apparent_age'), ((93, 97), 'apparent_age'),
+    ((97, 98), 'plot'), ((115, 120), 'plot'),
+]
+
+# First step reading the values edited in each table
+TABLE_STEPS = {
+    '1': 'corr_blank', '2': 'corr_blank', '3': 'degas_ca', '4': 'calc_ratio',
+}
+
+
+def get_downstream(steps):
+    """
+    Steps and all steps depending on them, in the order of evaluation
+    """
+    marked = set()
+    stack = [step for step in steps if step in RECALC_GRAPH]
+    while stack:
+        step = stack.pop()
+        if step not in marked:
+            marked.add(step)
+            stack.extend(RECALC_GRAPH[step])
+    return [step for step in RECALC_STEPS if step in marked]
+
+
+def get_param_steps(old_params: list, new_params: list):
+    """
+    Steps reading the rows of TotalParam that differ between old and new params
+    """
+    steps = set()
+    for row in range(max(len(old_params), len(new_params))):
+        old = old_params[row] if row < len(old_params) else None
+        new = new_params[row] if row < len(new_params) else None
+        if str(old) == str(new):
+            continue
+        steps.add(next((step for (start, end), step in PARAM_STEPS if start <= row < end), 'corr_blank'))
+    return [step for step in RECALC_STEPS if step in steps]
+
+
+def get_options(steps, monte_carlo: bool = False):
+    """
+    Option flags of Sample.recalculate to evaluate the given steps
+    """
+    options = [step in steps for step in RECALC_STEPS]
+    options[RECALC_STEPS.index('monte_carlo')] = monte_carlo
+    return options
+
+
+def get_steps(options):
+    """
+    Steps selected by option flags of Sample.recalculate
+    """
+    return [step for step, checked in zip(RECALC_STEPS, options) if checked and step != 'monte_carlo']
+
+
+def get_dirty_key(cache_key):
+    return f"{cache_key}:recalc"
+
+
+def mark_dirty(cache_key, steps):
+    """
+    Add steps to the dirty steps of a cached sample, they are evaluated by the next recalculation
+    """
+    dirty = set(cache.get(get_dirty_key(cache_key), [])) | set(steps)
+    cache.set(get_dirty_key(cache_key), [step for step in RECALC_STEPS if step in dirty],
+              timeout=DEFAULT_CACHE_TIMEOUT)
+
+
+def get_dirty(cache_key):
+    return cache.get(get_dirty_key(cache_key), [])
+
+
+def clear_dirty(cache_key):
+    cache.delete(get_dirty_key(cache_key))
+
+
+def recalculate(sample, steps, monte_carlo: bool = False, progress=None, **kwargs):
+    """
+    Evaluate the given steps and the steps downstream of them.
+    Parameters
+    ----------
+    sample
+    steps
+    monte_carlo
+    progress : optional, callable(step, done, total), steps are then evaluated one by one
+        and progress is called after each of them
+    kwargs : passed to Sample.recalculate
+
+    Returns
+    -------
+    list, evaluated steps
+    """
+    steps = get_downstream(steps)
+    if not steps:
+        return steps
+    if progress is None:
+        sample.recalculate(*get_options(steps, monte_carlo), **kwargs)
+        return steps
+    for done, step in enumerate(steps):
+        sample.recalculate(*get_options([step], monte_carlo), **kwargs)
+        progress(step, done + 1, len(steps))
+    return steps
+
+
+class IsochronMemo:
+    """
+    Bounded LRU of isochron regression results, keyed by figure, the bitmask of the
+    selected sequences and a hash of the values and parameters the regression reads.
+    Toggling points back and forth, or undoing a selection, finds the results here
+    instead of fitting again.
+    """
+
+    def __init__(self, max_entries: int = ISOCHRON_MEMO_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(self._items[key])
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = copy.deepcopy(value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0,
+                'entries': len(self._items), 'max_entries': self.max_entries,
+            }
+
+
+isochron_memo = IsochronMemo()
+
+
+def get_selection_mask(sequence):
+    """
+    Bitmask of selected sequence indexes
+    """
+    mask = 0
+    for index in sequence:
+        mask |= 1 << int(index)
+    return mask
+
+
+def get_params_hash(sample):
+    """
+    Hash of the sample values read by isochron regressions and ages
+    """
+    return hashlib.blake2b(pickle.dumps(
+        (sample.IsochronValues, sample.TotalParam, sample.Info.sample.type)), digest_size=16).digest()
+
+
+def get_isochron_executor():
+    """
+    Pool running the regressions of different figures at the same time, None for 'serial'
+    """
+    global _isochron_executor
+    if ISOCHRON_EXECUTOR == 'serial':
+        return None
+    with _executor_lock:
+        if _isochron_executor is None:
+            executor_class = ProcessPoolExecutor if ISOCHRON_EXECUTOR == 'process' else ThreadPoolExecutor
+            _isochron_executor = executor_class(max_workers=ISOCHRON_WORKERS)
+    return _isochron_executor
+
+
+_isochron_executor = None
+_executor_lock = threading.Lock()
+
+
+def fit_isochrons(sample, key, sequences):
+    """
+    Regression results of the sets of an isochron figure
+    Parameters
+    ----------
+    sample : sample instance
+    key : figure id in ap.smp.plots.ISOCHRON_INDEX_DICT
+    sequences : list of lists of sequence indexes
+
+    Returns
+    -------
+    list of dicts
+    """
+    val = ap.smp.plots.ISOCHRON_INDEX_DICT[key]
+    results = []
+    for sequence in sequences:
+        set_data = ap.calc.arr.partial(
+            sample.IsochronValues, rows=sequence, cols=list(range(*val['data_index'])))
+        if key != 'figure_7':
+            results.append(ap.smp.plots.get_isochron_results(
+                set_data, figure_type=val["figure_type"], smp=sample, sequence=sequence))
+        else:
+            results.append(ap.smp.plots.get_3D_results(data=set_data, sequence=sequence, sample=sample))
+    return results
+
+
+def recalc_isochrons(sample, figures=None):
+    """
+    Same as ap.smp.plots.recalc_isochrons, with regression results taken from isochron_memo.
+    Figures that are not in the memo are fitted in the pool of get_isochron_executor, and
+    the results are merged into the sample in the order of the figures.
+    """
+    if figures is None:
+        figures = list(ap.smp.plots.ISOCHRON_INDEX_DICT.keys())
+    params_hash = get_params_hash(sample)
+    results = {}  # figure id: list of results of set1, set2, set3
+    missing = {}  # figure id: indexes and sequences of sets to be fitted
+    for key in ap.smp.plots.ISOCHRON_INDEX_DICT.keys():
+        if key not in figures:
+            continue
+        figure = ap.smp.basic.get_component_byid(sample, key)
+        figure.set3.data, figure.set1.data, figure.set2.data = \
+            sample.UnselectedSequence.copy(), sample.SelectedSequence1.copy(), sample.SelectedSequence2.copy()
+        results[key] = []
+        for index, sequence in enumerate([figure.set1.data, figure.set2.data, figure.set3.data]):
+            results[key].append(isochron_memo.get((key, get_selection_mask(sequence), params_hash)))
+            if results[key][index] is None:
+                missing.setdefault(key, []).append((index, sequence))
+
+    executor = get_isochron_executor() if len(missing) > 1 else None
+    if executor is None:
+        fitted = [fit_isochrons(sample, key, [seq for _, seq in sets]) for key, sets in missing.items()]
+    else:
+        fitted = list(executor.map(
+            fit_isochrons, [sample] * len(missing), missing.keys(),
+            [[seq for _, seq in sets] for sets in missing.values()]))
+    for (key, sets), figure_results in zip(missing.items(), fitted):
+        for (index, sequence), iso_res in zip(sets, figure_results):
+            isochron_memo.put((key, get_selection_mask(sequence), params_hash), iso_res)
+            results[key][index] = iso_res
+
+    for key, figure_results in results.items():
+        for index, iso_res in enumerate(figure_results):
+            sample.Info.results.isochron[key].update({index: iso_res})
+
+
+def replot_isochrons(sample, figures=None):
+    """
+    Same as Sample.recalculate(re_plot=True, isInit=False, isIsochron=True, isPlateau=False),
+    using memoized isochron regressions
+    """
+    if len(sample.UnselectedSequence) == len(sample.SelectedSequence1) == len(sample.SelectedSequence2) == 0:
+        sample.UnselectedSequence = list(range(len(sample.SequenceName)))
+    try:
+        recalc_isochrons(sample, figures)
+    except (Exception, BaseException):
+        print("recalc_isochrons(sample, figures) error:\n", traceback.format_exc())
+    try:
+        ap.smp.plots.reset_isochron_line_data(sample)
+    except (Exception, BaseException):
+        print("reset_isochron_line_data(sample):\n", traceback.format_exc())
@@ -0,0 +1,53 @@
+import hashlib
+import pickle
+from . import ap
+
+
+def get_fingerprint(value: bytes):
+    """
+    Content hash of a pickled component, numpy arrays are pickled with their buffers
+    """
+    return hashlib.blake2b(value, digest_size=16).digest()
+
+
+class ComponentSnapshot:
+    """
+    Pickled copies of the components a handler is going to change, with their fingerprints,
+    taken before the change.
+
+    The handler names the components it changes, the fields it marks dirty, and only
+    these are pickled and compared afterwards. get_diff() runs the recursive comparison of
+    ap.smp.basic.get_diff_smp on those whose fingerprint has changed. All components are
+    taken if none are named, e.g. for a full recalculation.
+
+    Usage:
+        snapshot = ComponentSnapshot(sample, ['0', 'figure_2'])
+        sample.recalculate(...)
+        res = snapshot.get_diff()
+    """
+
+    def __init__(self, sample, dirty=None):
+        self.sample = sample
+        self.backups = {}  # component id: pickled component
+        self.fingerprints = {}  # component id: fingerprint
+        components = ap.smp.basic.get_components(sample) if dirty is None else {
+            str(each): ap.smp.basic.get_component_byid(sample, str(each)) for each in dirty}
+        for comp_id, comp in components.items():
+            if comp is None:
+                continue  # attribute names among the dirty fields
+            self.backups[comp_id] = pickle.dumps(comp)
+            self.fingerprints[comp_id] = get_fingerprint(self.backups[comp_id])
+
+    def get_diff(self):
+        """
+        Returns
+        -------
+        dict, difference of the snapshotted components in the format of ap.smp.basic.get_diff_smp
+        """
+        res = {}
+        for comp_id, backup in self.backups.items():
+            comp = ap.smp.basic.get_component_byid(self.sample, comp_id)
+            if get_fingerprint(pickle.dumps(comp)) == self.fingerprints[comp_id]:
+                continue
+            res.update(ap.smp.basic.get_diff_smp(backup={comp_id: pickle.loads(backup)}, smp={comp_id: comp}))
+        return res
@@ -0,0 +1,494 @@
+"""
+Diffusion models of step heating experiments.
+
+ArrayWalker is a random walker engine holding the positions of all walkers of all domains
+in one numpy array. The domains are those of ap.thermo.arw.run: nested cubes centred in the
+grain, of sides grain_size * fraction μm from the outer domain to the inner ones, each
+domain holding the walkers between its faces and those of the next inner domain, as many
+as atom_density atoms per cm3. Gas of an inner domain is released by crossing the outer
+domains. Walkers move as Brownian particles with the jumps of ararpy's walkers, of
+STEP_LENGTH μm at frequency * exp(-E / RT) per second, E being the activation energy of
+the domain a walker is in, that is with the diffusion coefficient
+
+    D = frequency * exp(-E / RT) * STEP_LENGTH ** 2 / (2 * dimension)
+
+Each heating step is split into substeps short enough for the spread of one substep to be
+a small part of the thinnest domain, every substep draws the displacements of all walkers
+at once, and walkers leaving the outer domain, or crossing one of its faces and coming
+back within a substep (Brownian bridge), are released. The number of draws depends on the
+domains and on the heating schedule instead of the number of jumps, so that no
+acceleration factor is needed.
+
+forward is the deterministic counterpart of the walkers. The nested cubes are shells of the
+distance max(|x|, |y|, |z|) to the centre, and the walkers, jumping with the diffusion
+coefficient of where they are, are solved as a master equation on cells of this distance,
+the gas of each cell moving to the next ones at rates D / h ** 2, with the volumes and face
+areas of the cube shells. Each heating step is solved exactly by the eigenvalues of the
+rates at its temperature. Shells of the distance are those of a ball, so that a single
+domain releases gas as a sphere of the half side; the released fraction is converted to a
+cube at the same dimensionless time D * t / r ** 2, 1 - (1 - F_plane) ** dimension. It
+takes tens of milliseconds for a schedule, and screen evaluates many candidate domain models
+at once.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from django.conf import settings
+from . import ap
+
+R = 8.314462618  # gas constant, J/(mol K)
+# Jump length of the walkers in μm, 2.5 Å as the walks of ap.thermo.arw.DiffSimulation
+STEP_LENGTH = 0.0001 * 2.5
+# Walkers simulated at most, fewer walkers of the same proportions are simulated otherwise
+WALKER_MAX_ATOMS = getattr(settings, 'WALKER_MAX_ATOMS', 1000000)
+# Heating steps between two checkpoints of the walkers of a run
+WALKER_CHECKPOINT_STEPS = getattr(settings, 'WALKER_CHECKPOINT_STEPS', 5)
+GEOMETRIES = ['cube', 'sphere', 'plane', 'cylinder']
+# First zeros of the Bessel function J0, further zeros are given by McMahon's expansion
+_J0_ZEROS = [2.404825557695773, 5.520078110286311, 8.653727912911013, 11.791534439014281, 14.930917708487787]
+
+
+class OverEpsilonError(Exception):
+    """
+    The released fractions of a model are further than epsilon from the targets
+    """
+
+
+def get_domains(energies, fractions, grain_size, atom_density=1e10, dimension=3):
+    """
+    Nested domains of ap.thermo.arw.run, sorted from the outer domain to the inner ones
+    Returns
+    -------
+    energies, sides in μm, and expected atoms of each domain, arrays of shape (ndoms, )
+    """
+    energies = np.asarray(energies, dtype=np.float64)
+    fractions = np.asarray(fractions, dtype=np.float64)
+    # The third domain is 5 / 4 as dense as the others in ap.thermo.arw.run
+    densities = np.where(np.arange(len(fractions)) == 2, atom_density * 5 / 4, atom_density)
+    order = np.argsort(-fractions, kind='stable')
+    sides = np.floor(grain_size * fractions[order])
+    atoms = densities[order] ** (dimension / 3) * (sides * 1e-4) ** dimension
+    atoms[:-1] *= 1 - (sides[1:] / np.where(sides[:-1] > 0, sides[:-1], 1)) ** dimension
+    return energies[order], sides, atoms
+
+
+class ArrayWalker:
+    """
+    Walkers of all domains in one array
+    Parameters
+    ----------
+    energies : activation energies of the domains in J/mol
+    fractions : sides of the domains relative to the grain size, as in ap.thermo.arw.run
+    grain_size : size of the grain in μm
+    dimension : 1, 2 or 3, number of axes of the domains
+    atom_density : atoms per cm3
+    frequency : jump attempt frequency in Hz
+    step_length : jump length in μm
+    max_atoms : walkers simulated at most
+    resolution : largest spread of a substep, relative to the thickness of the thinnest domain
+    max_substeps : substeps of a heating step at most
+    seed : seed of the random generator
+    """
+    def __init__(self, energies, fractions, grain_size, dimension=3, atom_density=1e10, frequency=1e13,
+                 step_length=STEP_LENGTH, max_atoms=WALKER_MAX_ATOMS, resolution=0.2, max_substeps=10000,
+                 seed=None, name=''):
+        self.name = name
+        self.energies, self.sides, atoms = get_domains(energies, fractions, grain_size, atom_density, dimension)
+        self.fractions = self.sides / grain_size
+        self.ndoms = len(self.energies)
+        self.grain_size = grain_size
+        self.dimension = dimension
+        self.atom_density = atom_density
+        self.frequency = frequency
+        self.step_length = step_length
+        self.resolution = resolution
+        self.max_substeps = max_substeps
+        # Half thickness of the shell of each domain, the inner domain being a full cube
+        self.widths = np.diff(-self.sides, append=0) / 2
+        scale = min(1., max_atoms / max(atoms.sum(), 1))
+        counts = np.round(atoms * scale).astype(np.int64)
+        self.rng = np.random.default_rng(seed)
+        self.domain = np.repeat(np.arange(self.ndoms), counts)
+        self.positions = np.concatenate(
+            [self.get_initial_positions(index, count) for index, count in enumerate(counts)] or
+            [np.zeros((0, dimension))])
+        self.escaped = np.zeros(len(self.domain), dtype=bool)
+        self.counts = counts
+        self.released = []  # walkers released of each domain at each heating step
+        self.substeps = 0
+
+    def get_initial_positions(self, index, count):
+        # Uniform in the cube of the domain, outside the cube of the next inner domain
+        positions = np.zeros((0, self.dimension))
+        inner = self.sides[index + 1] / 2 if index + 1 < self.ndoms else 0
+        while len(positions) < count:
+            new = (self.rng.random((count, self.dimension)) - 0.5) * self.sides[index]
+            positions = np.concatenate([positions, new[np.abs(new).max(axis=1) >= inner]])
+        return positions[:count]
+
+    def get_variances(self, temperature):
+        """
+        Variance of the displacement along each axis per second in each domain, μm2/s
+        """
+        return self.frequency * np.exp(-self.energies / (R * (temperature + 273.15))) * \
+            self.step_length ** 2 / self.dimension
+
+    def locate(self, positions):
+        """
+        Index of the innermost domain each position is in, -1 outside the outer domain
+        """
+        distance = np.abs(positions).max(axis=1) * 2
+        return (distance[:, None] <= self.sides).sum(axis=1) - 1
+
+    def step(self, duration, temperature):
+        """
+        Heat for duration seconds at temperature °C
+        Returns
+        -------
+        int array, walkers of each domain released in the step
+        """
+        sigma = np.sqrt(self.get_variances(temperature) * max(duration, 0))
+        released = np.zeros(self.ndoms, dtype=np.int64)
+        if sigma.max(initial=0) == 0:
+            self.released.append(released)
+            return released
+        substeps = np.ceil((sigma / (self.resolution * np.maximum(self.widths, 1e-12))).max() ** 2)
+        substeps = int(np.clip(substeps, 1, self.max_substeps))
+        sigma = sigma / np.sqrt(substeps)
+        half = self.sides[0] / 2
+        for _ in range(substeps):
+            index = np.flatnonzero(~self.escaped)
+            if len(index) == 0:
+                break
+            x0 = self.positions[index]
+            s = sigma[np.maximum(self.locate(x0), 0)][:, None]
+            x1 = x0 + self.rng.standard_normal(x0.shape) * s
+            out = (np.abs(x1) > half).any(axis=1)
+            # Probability of having crossed a face of the outer domain between two positions inside it
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                stay = (1 - np.exp(-2 * (half + x0) * (half + x1) / s ** 2)) * \
+                       (1 - np.exp(-2 * (half - x0) * (half - x1) / s ** 2))
+            stay = np.where(np.isfinite(stay), stay, 1).prod(axis=1)
+            escaped = out | (self.rng.random(len(index)) >= stay)
+            self.positions[index] = x1
+            self.escaped[index[escaped]] = True
+            released += np.bincount(self.domain[index[escaped]], minlength=self.ndoms)
+            self.substeps += 1
+        self.released.append(released)
+        return released
+
+    def get_released_fractions(self):
+        """
+        Returns
+        -------
+        array of shape (steps, ndoms), fractions of all walkers released by each domain at each step
+        """
+        if len(self.released) == 0:
+            return np.zeros((0, self.ndoms))
+        return np.array(self.released, dtype=np.float64) / max(len(self.domain), 1)
+
+    def save_state(self, file_path, key='', **others):
+        """
+        Write the walkers, the released counts and the state of the random generator to an
+        .npz file, replacing an older one only once it is complete
+        Parameters
+        ----------
+        key : key of the inputs of the walk, see load_state
+        others : numbers of the walk kept with the state, e.g. the heating steps done
+        """
+        with open(file_path + '.tmp', 'wb') as f:
+            np.savez(f, positions=self.positions, domain=self.domain, escaped=self.escaped,
+                     released=np.array(self.released, dtype=np.int64).reshape(-1, self.ndoms),
+                     substeps=self.substeps, key=key, rng=json.dumps(self.rng.bit_generator.state),
+                     others=json.dumps(others))
+        os.replace(file_path + '.tmp', file_path)
+
+    def load_state(self, file_path, key=''):
+        """
+        Restore the state saved by save_state if it exists and has been saved for the same key
+        Returns
+        -------
+        dict of the numbers kept with the state, None if it has not been restored
+        """
+        if not os.path.exists(file_path):
+            return None
+        with np.load(file_path, allow_pickle=False) as npz:
+            if str(npz['key']) != key:
+                return None
+            self.positions, self.domain, self.escaped = npz['positions'], npz['domain'], npz['escaped']
+            self.released = list(npz['released'])
+            self.substeps = int(npz['substeps'])
+            self.rng.bit_generator.state = json.loads(str(npz['rng']))
+            return json.loads(str(npz['others']))
+
+
+def get_run_key(*args, **kwargs):
+    """
+    Key of the inputs of a walk, the checkpoint of a walk is only restored for the same inputs
+    """
+    values = [np.asarray(each).tolist() if isinstance(each, (np.ndarray, list, tuple)) else each for each in args]
+    return hashlib.blake2b(json.dumps([values, sorted(kwargs.items())], default=str).encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+def run(times, temps, statuses, energies, fractions, ndoms, grain_size, dimension=3, atom_density=1e10,
+        frequency=1e13, targets=None, epsilon=0.05, seed=None, file_name='', checkpoint=None,
+        checkpoint_steps=WALKER_CHECKPOINT_STEPS, **kwargs):
+    """
+    Walk through a heating schedule
+    Parameters
+    ----------
+    times : cumulative times of the heating steps in seconds
+    temps : temperatures of the heating steps in °C
+    statuses : whether the gas of each step is measured, False for pumping phases
+    energies, fractions : activation energies in J/mol and relative sizes, from outer domains to inner ones
+    ndoms : number of domains
+    targets : cumulative released fractions measured at each step, the walk stops with
+        OverEpsilonError as soon as a measured step is further than epsilon
+    checkpoint : optional, path of the .npz file the walkers are saved to every checkpoint_steps
+        heating steps; a walk with the same inputs and seed continues from it, giving the same
+        results as a walk that has not been interrupted
+    kwargs : other parameters of ArrayWalker
+
+    Returns
+    -------
+    ArrayWalker
+    """
+    walker = ArrayWalker(energies[:ndoms], fractions[:ndoms], grain_size, dimension=dimension,
+                         atom_density=atom_density, frequency=frequency, seed=seed, name=file_name, **kwargs)
+    durations = np.diff(np.asarray(times, dtype=np.float64), prepend=0)
+    released, start = 0, 0
+    if checkpoint is not None:
+        key = get_run_key(times, temps, statuses, energies[:ndoms], fractions[:ndoms], grain_size, dimension,
+                          atom_density, frequency, targets, epsilon, seed, **kwargs)
+        restored = walker.load_state(checkpoint, key)
+        if restored is not None:
+            released, start = restored['released'], restored['steps']
+    for index in range(start, len(durations)):
+        released += walker.step(durations[index], temps[index]).sum() / max(len(walker.domain), 1)
+        if targets is not None and statuses[index] and abs(released - targets[index]) > epsilon:
+            raise OverEpsilonError(f"Released fraction {released:.4f} at step {index + 1} is further than "
+                                   f"{epsilon} from the target {targets[index]:.4f}")
+        if checkpoint is not None and (index + 1) % checkpoint_steps == 0 and index + 1 < len(durations):
+            walker.save_state(checkpoint, key, released=float(released), steps=index + 1)
+    walker.times, walker.temps, walker.statuses = list(times), list(temps), list(statuses)
+    return walker
+
+
+def save(walker: ArrayWalker, loc: str, name: str = None):
+    """
+    Save the released fractions and the parameters of a walk as an .npz file in loc
+    """
+    file_path = os.path.join(loc, f"{name or walker.name}.npz")
+    np.savez_compressed(
+        file_path, times=np.asarray(walker.times, dtype=np.float64), temps=np.asarray(walker.temps, dtype=np.float64),
+        statuses=np.asarray(walker.statuses, dtype=bool), energies=walker.energies, fractions=walker.fractions,
+        released=walker.get_released_fractions(), counts=walker.counts,
+        params=np.array([walker.grain_size, walker.dimension, walker.atom_density, walker.frequency,
+                         walker.step_length]),
+    )
+    return file_path
+
+
+def read_released(file_path: str):
+    """
+    Cumulative fractions released at the measured steps of a walk saved by save, the same as
+    released_per_step / natoms of an .ads file
+    """
+    with np.load(file_path, allow_pickle=False) as npz:
+        released = np.cumsum(npz['released'].sum(axis=1))
+        return released[npz['statuses']]
+
+
+def benchmark(times, temps, statuses, energies, fractions, ndoms, k, grain_size, dimension=3, atom_density=1e10,
+              frequency=1e13, use_walker1=True, targets=None, seed=None):
+    """
+    Seconds taken and released fractions of ararpy's walker and of ArrayWalker for the same
+    inputs of run_walker
+    Returns
+    -------
+    dict, seconds of each engine, cumulative released fractions at the measured steps, and
+    the largest difference between them
+    """
+    targets = np.zeros(len(times)) if targets is None else targets
+    if seed is not None:
+        np.random.seed(seed)
+    _start = time.time()
+    demo, _ = ap.thermo.arw.run(
+        times, temps, statuses, energies[:ndoms], fractions[:ndoms], ndoms, file_name='benchmark', k=k,
+        grain_szie=grain_size, dimension=dimension, atom_density=atom_density, frequency=frequency,
+        simulation=False, targets=targets, use_walker1=use_walker1)
+    walker_seconds = time.time() - _start
+    _start = time.time()
+    walker = run(times, temps, statuses, energies, fractions, ndoms, grain_size, dimension=dimension,
+                 atom_density=atom_density, frequency=frequency, seed=seed)
+    array_seconds = time.time() - _start
+    ararpy_released = np.array(demo.released_per_step, dtype=np.float64) / demo.natoms
+    array_released = np.cumsum(walker.get_released_fractions().sum(axis=1))[np.asarray(statuses, dtype=bool)]
+    return {'ararpy': walker_seconds, 'array': array_seconds, 'ararpy_released': ararpy_released,
+            'array_released': array_released, 'difference': np.abs(ararpy_released - array_released).max(initial=0)}
+
+
+def get_j0_zeros(terms: int):
+    beta = (np.arange(len(_J0_ZEROS) + 1, terms + 1) - 0.25) * np.pi
+    return np.concatenate([_J0_ZEROS[:terms], beta + 1 / (8 * beta) - 31 / (384 * beta ** 3)])
+
+
+def get_release_fractions(tau, geometry: str = 'sphere', terms: int = 200):
+    """
+    Fractions released by diffusion out of a domain initially filled uniformly
+    Parameters
+    ----------
+    tau : array of dimensionless times D * t / r ** 2, r being the radius of a sphere or a
+        cylinder or the half thickness of a plane sheet
+    geometry : sphere, plane, cylinder, or cube, r being the half side of the cube, in
+        which case the dimension may be given as cube-1, cube-2 or cube-3
+    terms : terms of the series, short times use the expansions for small tau instead
+
+    Returns
+    -------
+    array of the shape of tau
+    """
+    tau = np.maximum(np.asarray(tau, dtype=np.float64), 0)
+    t = tau[..., None]
+    if geometry.startswith('cube'):
+        dimension = int(geometry[5:] or 3)
+        return 1 - (1 - get_release_fractions(tau, 'plane', terms)) ** dimension
+    if geometry == 'sphere':
+        n = np.arange(1, terms + 1)
+        series = 1 - 6 / np.pi ** 2 * (np.exp(-n ** 2 * np.pi ** 2 * t) / n ** 2).sum(axis=-1)
+        short, limit = 6 * np.sqrt(tau / np.pi) - 3 * tau, 0.1
+    elif geometry == 'plane':
+        n = 2 * np.arange(terms) + 1
+        series = 1 - 8 / np.pi ** 2 * (np.exp(-n ** 2 * np.pi ** 2 * t / 4) / n ** 2).sum(axis=-1)
+        short, limit = 2 * np.sqrt(tau / np.pi), 0.2
+    elif geometry == 'cylinder':
+        alpha = get_j0_zeros(terms)
+        series = 1 - 4 * (np.exp(-alpha ** 2 * t) / alpha ** 2).sum(axis=-1)
+        short, limit = 4 * np.sqrt(tau / np.pi) - tau - np.sqrt(tau ** 3 / np.pi) / 3, 0.001
+    else:
+        raise ValueError(f"Unknown geometry: {geometry}, expected one of {GEOMETRIES}")
+    return np.clip(np.where(tau < limit, short, series), 0, 1)
+
+
+def get_shells(sides, cells):
+    """
+    Cells of the distance to the centre of nested domains, each domain having cells of its
+    own in proportion to the thickness of its shell, at least two
+    Parameters
+    ----------
+    sides : array of shape (models, ndoms), sides of the domains from the outer one to the inner ones
+    cells : number of cells of each model
+
+    Returns
+    -------
+    edges : array of shape (models, cells + 1), distances of the faces of the cells, from the centre
+    domains : int array of shape (models, cells), domain of each cell
+    """
+    models, ndoms = sides.shape
+    edges, domains = np.zeros((models, cells + 1)), np.zeros((models, cells), dtype=np.int64)
+    for index in range(models):
+        bounds = np.append(sides[index] / 2, 0)
+        counts = np.maximum(np.round((bounds[:-1] - bounds[1:]) / max(bounds[0], 1e-12) * cells), 2).astype(int)
+        counts[np.argmax(counts)] += cells - counts.sum()
+        edges[index] = np.concatenate(
+            [np.linspace(bounds[i], bounds[i + 1], counts[i] + 1)[:-1] for i in range(ndoms)] + [[0]])[::-1]
+        domains[index] = np.repeat(np.arange(ndoms), counts)[::-1]
+    return edges, domains
+
+
+def forward(times, temps, statuses, energies, fractions, grain_size, dimension=3, atom_density=1e10,
+            frequency=1e13, step_length=STEP_LENGTH, geometry: str = 'cube', cells: int = 48):
+    """
+    Released fractions of multi-domain models through a heating schedule
+    Parameters
+    ----------
+    times, temps, statuses : schedule of run, see run
+    energies, fractions : arrays of shape (..., ndoms), activation energies in J/mol and
+        relative sizes of the nested domains of one or many models, as for ArrayWalker
+    grain_size, dimension, atom_density, frequency, step_length : domains and diffusion
+        coefficients, the same as for ArrayWalker
+    geometry : cube for the domains of ArrayWalker, or nested spheres, cylinders or plane sheets
+    cells : cells of the distance to the centre
+
+    Returns
+    -------
+    released : array of shape (..., steps), cumulative fractions of all gas released at each step
+    measured : array of shape (..., steps), cumulative fractions of the gas of measured steps,
+        normalized to the measured gas as the targets of run_walker, pumping phases repeat
+        the previous value
+    """
+    if geometry not in GEOMETRIES:
+        raise ValueError(f"Unknown geometry: {geometry}, expected one of {GEOMETRIES}")
+    energies = np.asarray(energies, dtype=np.float64)
+    fractions = np.asarray(fractions, dtype=np.float64)
+    shape = energies.shape[:-1]
+    energies, fractions = energies.reshape(-1, energies.shape[-1]), fractions.reshape(-1, fractions.shape[-1])
+    order = np.argsort(-fractions, axis=-1, kind='stable')
+    energies = np.take_along_axis(energies, order, axis=-1)
+    sides = np.floor(grain_size * np.take_along_axis(fractions, order, axis=-1))
+    # Atoms of each domain as get_domains
+    densities = np.where(order == 2, atom_density * 5 / 4, atom_density)
+    atoms = densities ** (dimension / 3) * (sides * 1e-4) ** dimension
+    atoms[:, :-1] *= 1 - (sides[:, 1:] / np.where(sides[:, :-1] > 0, sides[:, :-1], 1)) ** dimension
+    weights = atoms / atoms.sum(axis=-1, keepdims=True)
+
+    d = {'cube': dimension, 'sphere': 3, 'cylinder': 2, 'plane': 1}[geometry]
+    edges, domains = get_shells(sides, cells)
+    volumes = edges[:, 1:] ** d - edges[:, :-1] ** d
+    centres = (edges[:, 1:] + edges[:, :-1]) / 2
+    # Exchange between neighbouring cells and loss through the outer face, symmetric in D * n / V
+    exchange = np.zeros((len(sides), cells, cells))
+    conductance = d * edges[:, 1:-1] ** (d - 1) / np.diff(centres, axis=-1)
+    exchange[:, np.arange(cells - 1), np.arange(1, cells)] = conductance
+    exchange[:, np.arange(1, cells), np.arange(cells - 1)] = conductance
+    exchange[:, np.arange(cells), np.arange(cells)] = -exchange.sum(axis=-1)
+    exchange[:, -1, -1] -= d * edges[:, -1] ** (d - 1) / (edges[:, -1] - centres[:, -1])
+    shell_volumes = np.zeros(sides.shape)
+    np.add.at(shell_volumes, (np.arange(len(sides))[:, None], domains), volumes)
+    gas = np.take_along_axis(weights / shell_volumes, domains, axis=-1) * volumes
+
+    durations = np.maximum(np.diff(np.asarray(times, dtype=np.float64), prepend=0), 0)
+    kelvin = np.asarray(temps, dtype=np.float64) + 273.15
+    # D of each domain at each step in μm2/s, shape (models, ndoms, steps)
+    coefficients = frequency * step_length ** 2 / (2 * dimension) * np.exp(-energies[..., None] / (R * kelvin))
+    released = np.zeros((len(sides), len(durations)))
+    for index, duration in enumerate(durations):
+        root = np.sqrt(np.take_along_axis(coefficients[..., index], domains, axis=-1) / volumes)
+        eigenvalues, vectors = np.linalg.eigh(root[:, :, None] * exchange * root[:, None, :])
+        modes = np.einsum('mji,mj->mi', vectors, root * gas) * np.exp(eigenvalues * duration)
+        gas = np.einsum('mij,mj->mi', vectors, modes) / root
+        released[:, index] = 1 - gas.sum(axis=-1)
+    if geometry == 'cube' and d > 1:
+        # From a ball to a cube of the same dimensionless time
+        tau = np.logspace(-10, 2, 4000)
+        ball = get_release_fractions(tau, {2: 'cylinder', 3: 'sphere'}[d])
+        released = get_release_fractions(np.interp(released, ball, tau), f"cube-{d}")
+    released = np.clip(released, 0, 1).reshape(*shape, len(durations))
+    steps = np.diff(released, axis=-1, prepend=0) * np.asarray(statuses, dtype=bool)
+    measured = np.cumsum(steps, axis=-1)
+    measured = measured / np.where(measured[..., -1:] > 0, measured[..., -1:], 1)
+    return released, measured
+
+
+def screen(targets, times, temps, statuses, energies, fractions, **kwargs):
+    """
+    Misfits of candidate domain models, the largest distance of the measured fractions of a
+    model to the targets over the measured steps, comparable to epsilon of the walkers
+    Parameters
+    ----------
+    targets : cumulative released fractions of the schedule
+    energies, fractions : arrays of shape (models, ndoms)
+    kwargs : other parameters of forward
+
+    Returns
+    -------
+    misfits : array of shape (models, )
+    measured : array of shape (models, steps)
+    """
+    released, measured = forward(times, temps, statuses, energies, fractions, **kwargs)
+    statuses = np.asarray(statuses, dtype=bool)
+    misfits = np.abs(measured - np.asarray(targets, dtype=np.float64))[..., statuses].max(axis=-1, initial=0)
+    return misfits, measured
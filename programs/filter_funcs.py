@@ -0,0 +1,419 @@
+"""
+Compiled input filters.
+
+An input filter is a flat list of row and column numbers and options, and
+ap.files.raw_file.get_raw_data interprets it again for every cycle of every step, reading
+the isotope values cell by cell. FilterPlan compiles a filter once into the offsets of the
+isotope block, the number of cycles and the parser of file names, and the values of all
+cycles of a step are then taken from the sheet at once by array indexing. Qtegra exported
+xls files, whose layout is fixed, are read row by row with a precompiled pattern of their
+dates and a getter of the isotope columns, and sequence files are read by sequence_funcs.
+
+Plans are cached per filter file and compiled again when the file changes.
+"""
+import codecs
+import mmap
+import os
+import re
+import threading
+from datetime import datetime
+from operator import itemgetter
+import chardet
+import numpy as np
+import dateutil.parser as datetime_parser
+from parse import compile as compile_parser
+from xlrd import open_workbook
+from . import ap, sequence_funcs
+
+# Reading order of the isotopic data index of a filter: time and intensity of Ar36, Ar37, ...
+ISOTOPE_ORDER = [18, 16, 14, 12, 10, 8, 6, 4, 2, 0]
+# Filter types, input_filter[1]
+HANDLERS = ['txt', 'excel', 'Qtegra Exported XLS', 'Seq']
+# Date and time of the header of a step of Qtegra exported xls, 6/8/2019  8:20:51 PM
+QTEGRA_DATETIME = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\s+([AP]M))?',
+                             re.IGNORECASE)
+# Cycle index, time and intensity of Ar36, Ar37, ..., Ar40 of a row of Qtegra exported xls,
+# whose columns are time, H2: Ar40, H1: Ar39, AX: Ar38, L1: Ar37, L2: Ar36
+QTEGRA_COLUMNS = [0, 1, 6, 1, 5, 1, 4, 1, 3, 1, 2]
+
+
+class FilterPlan:
+    """
+    Input filter compiled for reading raw files
+    """
+
+    def __init__(self, input_filter: list):
+        self.input_filter = input_filter
+        self.handler = HANDLERS[int(input_filter[1])] if 0 <= int(input_filter[1]) < len(HANDLERS) else None
+        self.extension = str(input_filter[0]).strip().lower()
+        self.unit = str(input_filter[30])
+        if self.handler == 'Qtegra Exported XLS':  # the layout is fixed, the filter is not read
+            self.datetime_pattern = QTEGRA_DATETIME
+            self.get_cycle = itemgetter(*QTEGRA_COLUMNS)
+        if self.handler not in ['txt', 'excel']:
+            return
+        self.separator = ['\t', ';', " ", ",", input_filter[3]][int(input_filter[2])] \
+            if self.handler == 'txt' else None
+        self.sheet = input_filter[4] - 1 if input_filter[4] != 0 else 0
+        self.header = input_filter[5]
+        self.orientation = int(input_filter[6])
+        # Cycles read per step, ararpy skips input_filter[29] turns of a loop of 2000 between cycles
+        self.cycles = min(max(input_filter[7], 1), 2000 // (max(input_filter[29], 0) + 1))
+        self.cycle_step = input_filter[28] + input_filter[29]
+        self.step_rows = input_filter[32]
+        isotopic_data_index = input_filter[8:28]
+        if self.orientation == 0:  # vertical, rows of cycles
+            self.row_offsets = np.array([isotopic_data_index[i] for i in ISOTOPE_ORDER])
+            self.columns = np.array([isotopic_data_index[i + 1] - 1 for i in ISOTOPE_ORDER])
+        else:  # horizontal, columns of cycles
+            self.row_offsets = np.zeros(len(ISOTOPE_ORDER), dtype=int)
+            self.columns = np.array([isotopic_data_index[i + 1] - 1 for i in ISOTOPE_ORDER])
+        self.scale = float(input_filter[31])
+        self.scaled = np.array([False, True] * 5)  # intensities are multiplied by the scale factor
+        self.sample_info_index = input_filter[33:65]
+        self.optional_info_index = input_filter[37:-6]
+        self.check_box_index = input_filter[-6:]
+        self.timezone = self.sample_info_index[3] if self.sample_info_index[3] != "" else "utc"
+        self.file_name_parser = compile_parser(self.sample_info_index[0]) \
+            if self.check_box_index[1] and self.sample_info_index[0].strip() != "" else None
+
+    def get_cells(self, idx: int):
+        """
+        Rows and columns of the isotope values of all cycles of a step, (cycles, 10)
+        """
+        cycles = np.arange(self.cycles)[:, np.newaxis]
+        if self.orientation == 0:
+            rows = self.cycle_step * cycles + self.header + idx - 1 + self.row_offsets
+            columns = np.broadcast_to(self.columns, rows.shape)
+        elif self.orientation == 1:
+            columns = self.cycle_step * cycles + self.columns
+            rows = np.full(columns.shape, self.header + idx)
+        else:
+            raise ValueError(f"{self.input_filter[6]} not in [0, 1]")
+        return rows, columns
+
+
+_plans = {}  # filter path: ((modification time, size), plan)
+_plans_lock = threading.Lock()
+
+
+def get_filter_plan(input_filter_path: str):
+    """
+    Compiled plan of an input filter file, taken from the cache unless the file has changed
+    """
+    stat = os.stat(input_filter_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _plans_lock:
+        item = _plans.get(input_filter_path)
+        if item is not None and item[0] == version:
+            return item[1]
+    plan = FilterPlan(ap.files.basic.read(input_filter_path))
+    with _plans_lock:
+        _plans[input_filter_path] = (version, plan)
+    return plan
+
+
+def invalidate_filter_plan(input_filter_path: str):
+    with _plans_lock:
+        _plans.pop(input_filter_path, None)
+
+
+class Sheet:
+    """
+    Rows of a sheet with an array of cells padded by None, for indexing many cells at once
+    """
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.lengths = np.array([len(row) if isinstance(row, (list, tuple)) else 0 for row in rows], dtype=int)
+        width = int(self.lengths.max(initial=0))
+        self.cells = np.empty((len(rows), width), dtype=object)
+        self.cells[:] = [row if length == width else [*(row if length else []), *[None] * (width - length)]
+                         for row, length in zip(rows, self.lengths.tolist())]
+
+    def take(self, rows, columns):
+        """
+        Values of cells, with negative indexes counted from the end as for lists
+        Returns
+        -------
+        values : object array
+        valid : bool array, False for cells out of range
+        """
+        rows = np.where(rows < 0, rows + len(self.rows), rows)
+        valid = (rows >= 0) & (rows < len(self.rows))
+        lengths = np.append(self.lengths, 0)[np.where(valid, rows, -1)]
+        columns = np.where(columns < 0, columns + lengths, columns)
+        valid &= (columns >= 0) & (columns < lengths)
+        values = np.full(rows.shape, None, dtype=object)
+        values[valid] = self.cells[rows[valid], columns[valid]]
+        return values, valid
+
+
+def read_cycles(sheet: Sheet, plan: FilterPlan, idx: int):
+    """
+    Cycles of a step as ap.files.raw_file.get_raw_data reads them, cycles whose values cannot
+    be read are filled with None
+    """
+    rows, columns = plan.get_cells(idx)
+    values, valid = sheet.take(rows, columns)
+    try:
+        if not valid.all():
+            raise ValueError
+        values = values.astype(float)
+    except (TypeError, ValueError):
+        data = np.full(values.shape, np.nan)
+        failed = ~valid.all(axis=1)
+        for cycle in np.flatnonzero(~failed):
+            try:
+                data[cycle] = [float(value) for value in values[cycle]]
+            except ValueError:
+                failed[cycle] = True
+    else:
+        data, failed = values, np.zeros(len(values), dtype=bool)
+    data[:, plan.scaled] = data[:, plan.scaled] * plan.scale
+    return [[str(cycle + 1), *([None] * 10 if failed[cycle] else values)]
+            for cycle, values in enumerate(data.tolist())]
+
+
+def datetime_parse(string, f):
+    try:
+        return datetime.strptime(string, f)
+    except ValueError as v:
+        if f.strip() == "":
+            return datetime_parser.parse(string)
+        elif len(v.args) > 0 and v.args[0].startswith('unconverted data remains: '):
+            string = string[:-(len(v.args[0]) - 26)]
+            return datetime.strptime(string, f)
+        else:
+            raise
+
+
+def get_raw_data(file_contents: list, plan: FilterPlan, file_name: str = ""):
+    """
+    Same as ap.files.raw_file.get_raw_data with a compiled filter
+    """
+    get_item = ap.calc.arr.get_item
+    step_list = []
+    idx = step_index = 0
+    sample_info_index = plan.sample_info_index
+    check_box_index = plan.check_box_index
+    sheet = Sheet(file_contents[plan.sheet])
+    while True:  # measurement steps loop
+        base = [1, 1 - idx, 1]
+        # Zero datetime
+        try:
+            if check_box_index[2]:  # date in one string
+                zero_date = datetime_parse(get_item(file_contents, sample_info_index[16:19], base=base),
+                                           sample_info_index[1])
+            else:
+                zero_date = datetime(year=get_item(file_contents, sample_info_index[16:19], base=1),
+                                     month=get_item(file_contents, sample_info_index[22:25], base=base),
+                                     day=get_item(file_contents, sample_info_index[28:31], base=base))
+            if check_box_index[3]:  # time in one string
+                zero_time = datetime_parse(get_item(file_contents, sample_info_index[19:22], base=base),
+                                           sample_info_index[2])
+            else:
+                zero_time = datetime(year=2020, month=12, day=31,
+                                     hour=get_item(file_contents, sample_info_index[19:22], base=base),
+                                     minute=get_item(file_contents, sample_info_index[25:28], base=base),
+                                     second=get_item(file_contents, sample_info_index[31:34], base=base))
+            zero_datetime = datetime(
+                zero_date.year, zero_date.month, zero_date.day, zero_time.hour, zero_time.minute, zero_time.second)
+            zero_datetime = ap.calc.basic.utc_dt(zero_datetime, tz=plan.timezone).isoformat(timespec='seconds')
+        except (TypeError, ValueError, IndexError):
+            zero_datetime = datetime(1970, 1, 1, 0, 0, 0).isoformat(timespec='seconds')
+
+        # Experiment name
+        try:
+            experiment_name = get_item(file_contents, sample_info_index[4:7], default="", base=base)
+        except (TypeError, ValueError, IndexError):
+            experiment_name = "ExpName"
+
+        # Step name, when it cannot be read the end of the file has been reached
+        step_name = get_item(file_contents, sample_info_index[7:10], default="", base=base) \
+            if plan.input_filter[7] > 0 else ""
+        if plan.file_name_parser is not None:
+            _res = plan.file_name_parser.parse(file_name)
+            if _res is not None:
+                experiment_name = _res.named.get("en", experiment_name)
+                step_index = _res.named.get("sn", step_name)
+                if step_index.isnumeric():
+                    step_name = f"{experiment_name}-{int(step_index):02d}"
+                else:
+                    step_name = f"{experiment_name}-{step_index}"
+        if step_name == "":
+            raise ValueError(f"Step name not found")
+
+        options = ap.files.raw_file.get_sample_info(file_contents, plan.optional_info_index, default="", base=base)
+        step_list.append([[step_name, zero_datetime, experiment_name, options], *read_cycles(sheet, plan, idx)])
+        idx = plan.step_rows * len(step_list)
+        if not check_box_index[0] or len(step_list) >= 500:  # multiple sequences
+            break
+    return step_list
+
+
+def get_file_name(file):
+    """
+    Path of a file given by its path or by a binary file handle
+    """
+    return file if isinstance(file, str) else str(getattr(file, 'name', ''))
+
+
+def read_lines(f, separator, chunk_size: int = 1048576):
+    """
+    Lines of a text file handle split into fields as ap.files.raw_file.open_raw_txt does,
+    detecting the encoding and decoding the file chunk by chunk
+    """
+    f.seek(0)
+    detector = chardet.UniversalDetector()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        detector.feed(chunk)
+        if detector.done:
+            break
+    encoding = detector.close()["encoding"]
+    f.seek(0)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    lines, rest = [], ""
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        *_lines, rest = (rest + decoder.decode(chunk)).split('\r\n')
+        lines.extend([line.strip().split(separator) for line in _lines])
+    lines.extend([line.strip().split(separator) for line in (rest + decoder.decode(b'', final=True)).split('\r\n')])
+    return lines
+
+
+def check_extension(file_path, plan: FilterPlan):
+    if os.path.splitext(file_path)[1][1:].lower() != plan.extension:
+        raise ValueError("The file does not comply with the extension in the given filter.")
+
+
+def open_raw_txt(file, plan: FilterPlan):
+    file_path = get_file_name(file)
+    check_extension(file_path, plan)
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            lines = read_lines(f, plan.separator)
+    else:
+        lines = read_lines(file, plan.separator)
+    file_name = os.path.basename(file_path).rstrip(os.path.splitext(file_path)[-1])
+    return {'data': get_raw_data([lines], plan, file_name=file_name)}
+
+
+def read_workbook(file):
+    """
+    Workbook of an xls file given by its path or by a binary file handle
+    """
+    if isinstance(file, str):
+        return open_workbook(file)
+    try:  # workbooks are read from a memory map of the file as xlrd does for paths
+        contents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):  # in-memory files
+        file.seek(0)
+        return open_workbook(file_contents=file.read())
+    with contents:
+        return open_workbook(file_contents=contents)
+
+
+def open_raw_xls(file, plan: FilterPlan):
+    file_path = get_file_name(file)
+    check_extension(file_path, plan)
+    wb = read_workbook(file)
+    contents = [[sheet.row_values(row) for row in range(sheet.nrows)] for sheet in wb.sheets()[:100]]
+    contents.extend([[]] * (100 - len(contents)))
+    file_name = os.path.basename(file_path).rstrip(os.path.splitext(file_path)[-1])
+    return {'data': get_raw_data(contents, plan, file_name=file_name)}
+
+
+def parse_qtegra_datetime(string: str, plan: FilterPlan):
+    """
+    Date and time of the header of a step of Qtegra exported xls in ISO format, strings the
+    pattern does not match are parsed by strptime as ararpy does
+    """
+    match = plan.datetime_pattern.fullmatch(string)
+    if match is None:
+        f = '%m/%d/%Y  %I:%M:%S %p' if "M" in string.upper() else '%m/%d/%Y  %H:%M:%S'
+        return datetime.strptime(string, f).isoformat(timespec='seconds')
+    month, day, year, hour, minute, second, noon = match.groups()
+    hour = int(hour)
+    if noon is not None:
+        if not 1 <= hour <= 12:
+            raise ValueError(f"time data {string!r} does not match format '%m/%d/%Y  %I:%M:%S %p'")
+        hour = hour % 12 + (12 if noon.upper() == 'PM' else 0)
+    return datetime(int(year), int(month), int(day), hour, int(minute), int(second)).isoformat(timespec='seconds')
+
+
+def open_qtegra_exported_xls(file, plan: FilterPlan):
+    """
+    Same as ap.files.raw_file.open_qtegra_exported_xls, reading the rows of the first sheet
+    at once instead of cell by cell
+    """
+    try:
+        sheet = read_workbook(file).sheet_by_index(0)
+        value = []  # rows of at least two cells, without empty cells
+        for row in range(sheet.nrows):
+            row_set = [cell for cell in sheet.row_values(row) if cell != '']
+            if len(row_set) > 1:
+                value.append(row_set)
+        # rows starting with a float (1.0, 2.0, ...) are the headers of steps
+        starts = [index for index, row in enumerate(value) if isinstance(row[0], float)]
+        for index in starts:
+            value[index][0] = int(value[index][0])
+            value[index][1] = parse_qtegra_datetime(value[index][1], plan)
+        stops = [*starts[1:], len(value) + 1]
+        step_list = [[value[start][0:4], *[list(plan.get_cycle(row)) for row in value[start + 2:max(stop - 7, 0)]]]
+                     for start, stop in zip(starts, stops)]
+    except Exception as e:
+        raise ValueError('Error in opening the original file: %s' % str(e))
+    return {'data': step_list}
+
+
+def open_raw_seq(file, plan: FilterPlan):
+    """
+    Same as ap.files.raw_file.open_raw_seq, reading both versions of .seq files by
+    sequence_funcs.load instead of unpickling them
+    """
+    if not isinstance(file, str):
+        file.seek(0)
+    sequences = sequence_funcs.load(file)
+    name_list = []
+    for seq in sequences:
+        while seq.name in name_list:
+            seq.name = f"{seq.name}-{seq.index}"
+        name_list.append(seq.name)
+    return {'sequences': sequences}
+
+
+def open_file(file, plan: FilterPlan):
+    """
+    Same as ap.files.raw_file.open_file with a compiled filter
+    Parameters
+    ----------
+    file : path or binary file handle of a raw file, handles are read from the start
+    plan : FilterPlan
+    """
+    if not plan.input_filter:
+        raise ValueError("Input filter is empty array.")
+    if plan.handler == 'txt':
+        return open_raw_txt(file, plan)
+    if plan.handler == 'excel':
+        return open_raw_xls(file, plan)
+    if plan.handler == 'Qtegra Exported XLS':
+        return open_qtegra_exported_xls(file, plan)
+    if plan.handler == 'Seq':
+        return open_raw_seq(file, plan)
+    raise FileNotFoundError("Wrong File.")
+
+
+def to_raw(file, plan: FilterPlan):
+    """
+    Same as ap.smp.raw.to_raw for a single file with a compiled filter, file is a path or
+    a binary file handle
+    """
+    file_path = get_file_name(file)
+    file_name = str(os.path.split(file_path)[-1]).split('.')[0]
+    res = open_file(file, plan)
+    data = res.get('data', None)
+    sequences = res.get('sequences', None)
+    sequence_num = len(data) if data is not None else len(sequences)
+    fitting_method = [2, 0, 2, 2, 2]  # default fitting methods of isotopes
+    return ap.RawData(name=file_name, data=data, isotopic_num=10, sequence_num=sequence_num, source=[file_path],
+                      sequence=sequences, unit=plan.unit, fitting_method=[*fitting_method])
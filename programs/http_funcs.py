@@ -1,15 +1,261 @@
+import hashlib
 import pickle
 import uuid
 import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from django.conf import settings
 from django.http import JsonResponse, HttpResponse
 from django.core.cache import cache
+from django_redis import get_redis_connection
 from django.shortcuts import render, redirect
 from django.views import View
 from django.contrib import messages
 from calc import models
 from . import ap, log_funcs
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 DEFAULT_CACHE_TIMEOUT = 86400
+SAMPLE_LRU_MAX_BYTES = getattr(settings, 'SAMPLE_LRU_MAX_BYTES', 268435456)
+# 'pickle': one pickle per sample, 'components': one Redis hash field per sample attribute
+SAMPLE_CACHE_MODE = getattr(settings, 'SAMPLE_CACHE_MODE', 'pickle')
+# Compression of cached objects, 'zstd', 'lz4', 'zlib' or 'none', zlib is used if the module is not installed
+CACHE_CODEC = getattr(settings, 'CACHE_CODEC', 'zstd')
+
+# Sample attributes holding the values shown in each table component
+TABLE_VALUE_ATTRS = {
+    '1': ['SampleIntercept'], '2': ['BlankIntercept'], '3': ['CorrectedValues'], '4': ['DegasValues'],
+    '5': ['PublishValues'], '6': ['ApparentAgeValues'], '7': ['IsochronValues', 'IsochronMark'],
+    '8': ['TotalParam'],
+}
+# Sample attributes describing sequences and isochron selections
+SEQUENCE_ATTRS = [
+    'SequenceName', 'SequenceValue', 'IsochronMark',
+    'SelectedSequence1', 'SelectedSequence2', 'UnselectedSequence',
+]
+
+
+class SampleLRUCache:
+    """
+    In-process LRU of live (unpickled) Sample and RawData instances, keyed by cache key.
+
+    Each entry remembers the version stamp that was stored in Redis together with the
+    pickled object. A request only deserializes the object again when the stamp in Redis
+    differs, i.e. another worker has written a newer version. Entries are weighted by
+    their pickled size, and the least recently used ones are evicted once the memory
+    budget is exceeded.
+
+    A request takes an entry out of the cache, so that concurrent requests never share a
+    live instance, and gives it back when it ends without having changed it, see
+    checkout and checkin. Whether it has been changed is marked by the handlers, see
+    ArArView.mark_dirty.
+    """
+
+    def __init__(self, max_bytes: int = SAMPLE_LRU_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # cache_key: [version, obj, size]
+        self._lock = threading.RLock()
+
+    def take(self, cache_key, version):
+        """
+        Remove and return the entry of cache_key if it has the given version
+        Returns
+        -------
+        tuple of obj and size, or None
+        """
+        with self._lock:
+            item = self._items.get(cache_key)
+            if item is None or version is None or item[0] != version:
+                self.misses += 1
+                return None
+            self.discard(cache_key)
+            self.hits += 1
+            return item[1], item[2]
+
+    def put(self, cache_key, version, obj, size: int):
+        with self._lock:
+            self.discard(cache_key)
+            if version is None or size > self.max_bytes:
+                return
+            self._items[cache_key] = [version, obj, size]
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, _size) = self._items.popitem(last=False)
+                self.current_bytes -= _size
+                self.evictions += 1
+
+    def give_back(self, cache_key, version, obj, size: int):
+        """
+        Put an entry taken by a request back, unless a newer one has been put meanwhile
+        """
+        with self._lock:
+            if cache_key not in self._items:
+                self.put(cache_key, version, obj, size)
+
+    def version(self, cache_key):
+        with self._lock:
+            item = self._items.get(cache_key)
+            return None if item is None else item[0]
+
+    def size(self, cache_key):
+        with self._lock:
+            item = self._items.get(cache_key)
+            return 0 if item is None else item[2]
+
+    def discard(self, cache_key):
+        with self._lock:
+            item = self._items.pop(cache_key, None)
+            if item is not None:
+                self.current_bytes -= item[2]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0, 'entries': len(self._items),
+                'bytes': self.current_bytes, 'max_bytes': self.max_bytes,
+            }
+
+
+sample_lru = SampleLRUCache()
+
+
+class CacheCodec:
+    """
+    Serialization of cached objects.
+
+    Objects are pickled with protocol 5, so that numpy arrays are taken out of the pickle
+    stream as raw buffers instead of being copied into it, then the pickle and the buffers
+    are compressed together. Every value starts with a header of magic bytes, format
+    version, compressor id and uncompressed size, values without the header are plain
+    pickles written before the codec was introduced and are still readable. Values are
+    decompressed into a bytearray, so that decoded arrays are writable like unpickled ones.
+    """
+
+    magic = b'WAC'
+    version = 1
+    header = struct.Struct('>3sBBQ')  # magic, version, compressor id, uncompressed size
+    length = struct.Struct('>I')
+    compressors = {
+        0: ('none', lambda data: data, lambda data: data),
+        1: ('zlib', lambda data: zlib.compress(data, 6), zlib.decompress),
+    }
+    if zstandard is not None:
+        compressors[2] = ('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                          lambda data: zstandard.ZstdDecompressor().decompress(data))
+    if lz4 is not None:
+        compressors[3] = ('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+    def __init__(self, name: str = CACHE_CODEC):
+        ids = {value[0]: key for key, value in self.compressors.items()}
+        self.compressor_id = ids.get(name, 1)
+        self.name = self.compressors[self.compressor_id][0]
+
+    def get_frame(self, obj) -> bytes:
+        """
+        Uncompressed frame of the pickle and the buffers of obj
+        """
+        buffers = []
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        parts = [data, *[buffer.raw() for buffer in buffers]]
+        return b''.join([self.length.pack(len(parts)), *[self.length.pack(len(part)) for part in parts], *parts])
+
+    def fingerprint(self, obj) -> bytes:
+        """
+        Content hash of obj, the same as the one returned by encode
+        """
+        return hashlib.blake2b(self.get_frame(obj), digest_size=16).digest()
+
+    def encode(self, obj):
+        """
+        Returns
+        -------
+        tuple of the encoded value and the fingerprint of obj
+        """
+        frame = self.get_frame(obj)
+        compress = self.compressors[self.compressor_id][1]
+        value = self.header.pack(self.magic, self.version, self.compressor_id, len(frame)) + compress(frame)
+        return value, hashlib.blake2b(frame, digest_size=16).digest()
+
+    def dumps(self, obj) -> bytes:
+        return self.encode(obj)[0]
+
+    def loads(self, value: bytes):
+        if not self.is_encoded(value):
+            return pickle.loads(value)
+        _, version, compressor_id, _ = self.header.unpack_from(value)
+        if version > self.version or compressor_id not in self.compressors:
+            raise ValueError(f"Unsupported cache value, format version {version}, compressor id {compressor_id}")
+        frame = memoryview(bytearray(self.compressors[compressor_id][2](value[self.header.size:])))
+        count = self.length.unpack_from(frame)[0]
+        lengths = [self.length.unpack_from(frame, self.length.size * (i + 1))[0] for i in range(count)]
+        parts, start = [], self.length.size * (count + 1)
+        for each in lengths:
+            parts.append(frame[start:start + each])
+            start += each
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+    def is_encoded(self, value: bytes) -> bool:
+        return len(value) >= self.header.size and value[:3] == self.magic
+
+    def raw_size(self, value: bytes) -> int:
+        """
+        Uncompressed size of an encoded value
+        """
+        if not self.is_encoded(value):
+            return len(value)
+        return self.header.unpack_from(value)[3]
+
+
+cache_codec = CacheCodec()
+
+
+def get_sample_template(initialized: bool) -> bytes:
+    """
+    Uncompressed encoding of an empty sample, initialized by ap.smp.initial.initial
+    without its Doi if initialized is True
+    """
+    sample = ap.smp.Sample()
+    if initialized:
+        ap.smp.initial.initial(sample)
+        sample.Doi = ""
+    return template_codec.dumps(sample)
+
+
+def new_sample(initialized: bool = True):
+    """
+    Copy of the template sample of the worker, which is decoded about four times faster
+    than ap.smp.initial.initial builds a new sample. Initialized copies get a new Doi.
+    """
+    sample = template_codec.loads(sample_templates[initialized])
+    if initialized:
+        sample.Doi = uuid.uuid4().hex
+    return sample
+
+
+template_codec = CacheCodec('none')
+sample_templates = {initialized: get_sample_template(initialized) for initialized in [False, True]}
+
+
+def log_cache_size(cache_key, raw_size: int, stored_size: int):
+    log_funcs.write_log(
+        '-', 'DEBUG', f"Cache {cache_key} written with {cache_codec.name}: "
+                      f"{raw_size} bytes, {stored_size} bytes stored", ignore=True)
 
 
 def get_ip(request):
@@ -52,20 +298,124 @@ def is_ajax(request):
     return request.META.get("HTTP_X_REQUESTED_WITH") == "XMLHttpRequest"
 
 
-def create_cache(obj, cache_key=''):
+class StaleVersionError(ValueError):
+    pass
+
+
+def create_cache(obj, cache_key='', dirty=None, lease=None):
     """
     Create (leave key default) or update cache (give key). This is used to link sample
     instance with cache key, which is an unique identifier for this object in the cache.
     The cache key will also be sent to user so that changes from front can be identified.
+
+    In 'components' mode, samples are stored in a Redis hash with one field per attribute,
+    and dirty, a list of component ids or attribute names, limits the write to the fields
+    that have been changed. All fields are written if dirty is None.
+
+    lease is the one returned by checkout with obj, if given StaleVersionError is raised
+    instead of writing when another request has cached a new version since the checkout.
     """
     if not cache_key:
         cache_key = create_cache_key()
-    cache_value = pickle.dumps(obj)
-    # cache_value = basic_funcs.getJsonDumps(sample)
-    cache.set(cache_key, cache_value, timeout=DEFAULT_CACHE_TIMEOUT)
+    if lease is not None and cache.get(get_version_key(cache_key)) != lease[0]:
+        raise StaleVersionError(f"{cache_key} has been changed since version {lease[0]}")
+    # A new version stamp tells other workers that their live instances are out of date
+    version = create_cache_key()
+    if SAMPLE_CACHE_MODE == 'components' and isinstance(obj, ap.Sample):
+        _, size = write_fields(obj, cache_key, dirty)
+        cache.set(get_version_key(cache_key), version, timeout=DEFAULT_CACHE_TIMEOUT)
+    else:
+        cache_value = cache_codec.dumps(obj)
+        # cache_value = basic_funcs.getJsonDumps(sample)
+        cache.set_many({cache_key: cache_value, get_version_key(cache_key): version}, timeout=DEFAULT_CACHE_TIMEOUT)
+        size = cache_codec.raw_size(cache_value)
+        log_cache_size(cache_key, size, len(cache_value))
+    sample_lru.put(cache_key, version, obj, size)
     return cache_key
 
 
+def get_fields_key(cache_key):
+    """
+    Redis key of the hash holding the attributes of a sample in 'components' mode
+    """
+    return cache.make_key(f"{cache_key}:fields")
+
+
+def get_field_names(obj, dirty):
+    """
+    Convert component ids in dirty to the names of sample attributes
+    """
+    ids = {str(getattr(attr, 'id', '')): name for name, attr in obj.__dict__.items()
+           if isinstance(attr, (ap.Plot, ap.Table, ap.ArArBasic))}
+    names = {ids.get(str(each), str(each)) for each in dirty}
+    return [name for name in names if name in obj.__dict__]
+
+
+def get_dirty_fields(diff_keys, *names):
+    """
+    Fields to be written back after a change, diff_keys are keys of get_diff_smp results.
+    Table components take the sample attributes holding their values with them.
+    """
+    fields = list(names)
+    for key in diff_keys:
+        fields.append(key)
+        fields.extend(TABLE_VALUE_ATTRS.get(str(key), []))
+    return fields
+
+
+def write_fields(obj, cache_key, dirty=None):
+    """
+    Write attributes of obj to its Redis hash, only those in dirty if the hash exists.
+    The hash keeps the fingerprint and size of every field in its '__fields__' entry, only
+    the fields in dirty are encoded, and those whose fingerprint is unchanged are skipped.
+    Returns
+    -------
+    tuple, sizes in bytes of the fields written and of all fields of the stored object
+    """
+    conn = get_redis_connection('default')
+    fields_key = get_fields_key(cache_key)
+    index = conn.hget(fields_key, '__fields__') if dirty is not None else None
+    fields = {} if index is None else cache_codec.loads(index)  # name: (fingerprint, size)
+    names = list(obj.__dict__.keys()) if index is None else get_field_names(obj, dirty)
+    values = {}
+    for name in names:
+        value, fingerprint = cache_codec.encode(getattr(obj, name))
+        if fields.get(name, (None, 0))[0] != fingerprint:
+            values[name] = value
+            fields[name] = (fingerprint, cache_codec.raw_size(value))
+    size = sum(cache_codec.raw_size(value) for value in values.values())
+    log_cache_size(cache_key, size, sum(len(value) for value in values.values()))
+    pipe = conn.pipeline()
+    if index is None:
+        values['__class__'] = cache_codec.dumps(type(obj))
+        pipe.delete(fields_key)
+    if values:
+        values['__fields__'] = cache_codec.dumps(fields)
+        pipe.hset(fields_key, mapping=values)
+    pipe.expire(fields_key, DEFAULT_CACHE_TIMEOUT)
+    pipe.execute()
+    if index is None:
+        cache.delete(cache_key)  # a whole pickle written in the other mode is out of date now
+    return size, sum(each[1] for each in fields.values())
+
+
+def read_fields(cache_key):
+    """
+    Rebuild an object from its Redis hash.
+    Returns
+    -------
+    tuple, object or None if the hash does not exist, and size in bytes
+    """
+    fields = get_redis_connection('default').hgetall(get_fields_key(cache_key))
+    if b'__class__' not in fields:
+        return None, 0
+    cls = cache_codec.loads(fields.pop(b'__class__'))
+    fields.pop(b'__fields__', None)
+    obj = cls.__new__(cls)
+    obj.__dict__.update({name.decode('utf-8'): cache_codec.loads(value) for name, value in fields.items()})
+    return obj, sum(cache_codec.raw_size(value) for value in fields.values())
+
+
 def create_cache_key():
     """
     Create UUID as a cache_key for each opened sample instance using uuid module.
@@ -76,21 +426,71 @@ def create_cache_key():
     return str(uuid.uuid4().hex)
 
 
+def get_version_key(cache_key):
+    """
+    Key of the version stamp written together with the cached object
+    """
+    return f"{cache_key}:version"
+
+
 def touch_cache(cache_key=''):
+    cache.touch(get_version_key(cache_key), timeout=DEFAULT_CACHE_TIMEOUT, version=None)
+    if SAMPLE_CACHE_MODE == 'components':
+        get_redis_connection('default').expire(get_fields_key(cache_key), DEFAULT_CACHE_TIMEOUT)
     return cache.touch(cache_key, timeout=DEFAULT_CACHE_TIMEOUT, version=None)
 
 
 def cache_load(cache_key):
     """
+    Load the object linked with the cache key. The live instance in the per-worker LRU
+    is returned if its version is still the latest one in the cache, otherwise it is
+    decoded from the cache. The instance belongs to the caller, it is cached again by
+    create_cache, or by checkin if it has not been changed.
     Parameters
     ----------
     cache_key
 
     Returns
     -------
+    Sample or RawData instance, None if the key does not exist
+    """
+    return checkout(cache_key)[0]
+
 
+def checkout(cache_key):
+    """
+    Returns
+    -------
+    tuple of the object, None if the key does not exist, and a lease of its version and
+    size to be passed to checkin
+    """
+    version = cache.get(get_version_key(cache_key))
+    item = sample_lru.take(cache_key, version)
+    if item is not None:
+        obj, size = item
+        return obj, (version, size)
+    if SAMPLE_CACHE_MODE == 'components':
+        obj, size = read_fields(cache_key)
+        if obj is not None:
+            return obj, (version, size)
+    cache_value = cache.get(cache_key)
+    if cache_value is None:
+        return None, None
+    return cache_codec.loads(cache_value), (version, cache_codec.raw_size(cache_value))
+
+
+def checkin(cache_key, obj, lease, changed=False):
+    """
+    Give an object that has not been written back to the LRU again, if it is still the
+    latest version. changed tells that the request has changed the object, in which case
+    it is dropped, as it differs from the version in the cache.
     """
-    return pickle.loads(cache.get(cache_key))
+    if changed or obj is None or lease is None or sample_lru.version(cache_key) is not None:
+        return
+    version, size = lease
+    if version is None or cache.get(get_version_key(cache_key)) != version:
+        return
+    sample_lru.give_back(cache_key, version, obj, size)
 
 
 def set_mysql(request, mysql, fingerprint, file_path="", cache_key=""):
@@ -148,8 +548,7 @@ def open_last_object(request):
             raise IndexError
     except (BaseException, Exception):
         # print('No file found in cache!')
-        sample = ap.Sample()
-        ap.smp.initial.initial(sample)
+        sample = new_sample()
         cache_key = create_cache(sample, cache_key=cache_key)
     return open_object_file(request, sample, web_file_path='', cache_key=cache_key)
 
@@ -181,7 +580,9 @@ class ArArView(View):
         self.body = {}
         self.content = {}
         self.cache_key = ''
-        self.sample = ...
+        self._sample = ...  # loaded from cache on first access
+        self._sample_lease = None
+        self.dirty = set()  # fields of the sample changed by the handler, see mark_dirty
 
         # response
         self.error_msg = ""
@@ -193,6 +594,30 @@ class ArArView(View):
         # log_funcs.set_info_log(self.ip, '001', 'info', 'Open raw file')
         # print(f"{self.ip}, {self.request}")
 
+    @property
+    def sample(self):
+        if self._sample is ... and self.cache_key:
+            sample, self._sample_lease = checkout(self.cache_key)
+            self._sample = new_sample(initialized=False) if sample is None else sample
+        return self._sample
+
+    @sample.setter
+    def sample(self, value):
+        self._sample = value
+        self._sample_lease = None  # not the instance that has been checked out
+
+    def mark_dirty(self, *fields):
+        """
+        Record fields of the sample, component ids or attribute names, that the handler
+        changes. Marked samples are not given back to the LRU when the request ends, so a
+        handler changing the sample without writing it back with create_cache must mark it.
+        """
+        self.dirty.update(str(each) for each in fields)
+
+    @property
+    def sample_loaded(self):
+        return self._sample is not ...
+
     def setup(self, request, *args, **kwargs):
         if hasattr(self, "get") and not hasattr(self, "head"):
             self.head = self.get
@@ -230,7 +655,7 @@ class ArArView(View):
         try:
             self.body = ap.smp.json.loads(request.body.decode('utf-8'))
             self.cache_key = str(self.body['cache_key'])  # Key to obtain sample from cache
-            self.sample = pickle.loads(cache.get(self.cache_key, default=pickle.dumps(ap.smp.Sample())))
+            # The sample itself is loaded on first access of self.sample
             touch_cache(self.cache_key)  # Update cache time
         except KeyError:
             print("No cache key in request body")
@@ -261,7 +686,13 @@ class ArArView(View):
         method = func.__name__
         path = request.path
         log_funcs.write_log(self.ip, 'INFO', f"Received request: {method}, {path}")
-        return func(request, *args, **kwargs)
+        try:
+            return func(request, *args, **kwargs)
+        finally:
+            # Keep the live instance for the next request unless the handler has written it
+            # back or changed it without writing it back
+            if self.sample_loaded and self.cache_key:
+                checkin(self.cache_key, self._sample, self._sample_lease, changed=bool(self.dirty))
 
     def JsonResponse(self, data, status=200, **kwargs):
         if self.error_msg != "":
@@ -281,7 +712,8 @@ class ArArView(View):
         if msg is not None:
             return log_funcs.write_log(self.ip, level, msg, kwargs)
         try:
-            kwargs.update({"sample_name": self.sample.name()})
+            # Logging never loads the sample
+            kwargs.update({"sample_name": self._sample.name()})
         except (Exception, BaseException):
             pass
         for msg in messages.get_messages(self.request):
@@ -0,0 +1,172 @@
+"""
+Background jobs for long recalculations.
+
+Jobs run in a process pool of the web worker, their state is kept in the cache (Redis) as
+a job table, so that the request returns a job id at once and the client polls the state,
+the progress of each stage and finally the difference of components.
+
+Jobs on a cached sample write it back only if no request has cached a new version of it
+while the job ran, otherwise the job runs again on the new version.
+"""
+import time
+import traceback
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from . import ap, calc_funcs, diff_funcs, http_funcs, log_funcs
+
+# Run recalculations as background jobs when the request does not say, and pool size
+ASYNC_JOBS = getattr(settings, 'ASYNC_JOBS', False)
+JOB_WORKERS = getattr(settings, 'JOB_WORKERS', 2)
+# Runs of a job on a sample changed by other requests meanwhile before it fails
+JOB_ATTEMPTS = getattr(settings, 'JOB_ATTEMPTS', 3)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+    return _executor
+
+
+def get_job_key(job_id):
+    return f"job:{job_id}"
+
+
+def get_job(job_id):
+    """
+    Returns
+    -------
+    dict of the job state, None if the job does not exist
+    """
+    return cache.get(get_job_key(job_id))
+
+
+def update_job(job_id, **kwargs):
+    job = get_job(job_id) or {}
+    job.update(kwargs, updated=time.time())
+    cache.set(get_job_key(job_id), job, timeout=http_funcs.DEFAULT_CACHE_TIMEOUT)
+    return job
+
+
+def is_async(content: dict):
+    """
+    Whether a request asks for a background job, content is the request body or its content
+    """
+    return bool(content.get('async', ASYNC_JOBS))
+
+
+def submit_job(name, func, *args, cache_key=''):
+    """
+    Add a job to the queue.
+    Parameters
+    ----------
+    name : job name shown in the state
+    func : module-level function called as func(job_id, *args) in the pool, its return
+        value is saved as the result of the job
+    args : arguments of func, they must be picklable
+    cache_key : key of the sample the job works on
+
+    Returns
+    -------
+    str, job id
+    """
+    job_id = uuid.uuid4().hex
+    update_job(job_id, id=job_id, name=name, cache_key=cache_key, status='queued', stage='',
+               progress=[0, 0], stages=[], result=None, error='', created=time.time())
+    get_executor().submit(run_job, job_id, func, *args)
+    return job_id
+
+
+def run_job(job_id, func, *args):
+    update_job(job_id, status='running', started=time.time())
+    try:
+        result = func(job_id, *args)
+    except (Exception, BaseException) as e:
+        log_funcs.write_log('-', 'ERROR', f"Job {job_id} failed: {traceback.format_exc()}", ignore=True)
+        update_job(job_id, status='failed', error=f"{type(e).__name__}: {e}", finished=time.time())
+    else:
+        update_job(job_id, status='finished', result=result, finished=time.time())
+
+
+def get_progress(job_id):
+    """
+    Progress callback of calc_funcs.recalculate updating the job state after each stage
+    """
+    def progress(step, done, total):
+        job = get_job(job_id) or {}
+        update_job(job_id, stage=step, progress=[done, total], stages=[*job.get('stages', []), step])
+    return progress
+
+
+def run_on_sample(job_id, cache_key, func):
+    """
+    Call func(sample) on the latest version of a cached sample and cache the sample again,
+    func is called again on the new version if the sample has been changed meanwhile
+    Returns
+    -------
+    return value of func
+    """
+    for attempt in range(JOB_ATTEMPTS):
+        sample, lease = http_funcs.checkout(cache_key)
+        if sample is None:
+            raise ValueError(f"Sample {cache_key} not found in the cache")
+        result = func(sample)
+        try:
+            http_funcs.create_cache(sample, cache_key, lease=lease)
+        except http_funcs.StaleVersionError:
+            update_job(job_id, stage='restart', attempts=attempt + 1)
+        else:
+            calc_funcs.clear_dirty(cache_key)
+            return result
+    raise http_funcs.StaleVersionError(
+        f"Sample {cache_key} has been changed by other requests during {JOB_ATTEMPTS} runs of the job")
+
+
+def recalculation_job(job_id, cache_key, steps, monte_carlo, others):
+    """
+    Background version of ButtonsResponseObjectView.recalculation
+    Returns
+    -------
+    dict, evaluated steps and difference of components
+    """
+    def recalculation(sample):
+        snapshot = diff_funcs.ComponentSnapshot(sample)
+        evaluated = calc_funcs.recalculate(sample, steps, monte_carlo=monte_carlo, progress=get_progress(job_id),
+                                           **others)
+        ap.smp.table.update_table_data(sample)  # Update data of tables after re-calculation
+        return {'steps': evaluated, 'res': ap.smp.json.dumps(snapshot.get_diff())}
+    return run_on_sample(job_id, cache_key, recalculation)
+
+
+def set_params_job(job_id, cache_key, params, param_type, rows):
+    """
+    Background version of ParamsSettingView.set_params, the steps reading the changed params
+    are recalculated in the same job
+    """
+    def set_params(sample):
+        snapshot = diff_funcs.ComponentSnapshot(sample)
+        total_params = list(sample.TotalParam)
+        sample.set_params(params, param_type, rows)
+        update_job(job_id, stage='set_params')
+        steps = [*calc_funcs.get_dirty(cache_key), *calc_funcs.get_param_steps(total_params, sample.TotalParam)]
+        steps = calc_funcs.recalculate(sample, steps, progress=get_progress(job_id))
+        ap.smp.table.update_table_data(sample)
+        return {'steps': steps, 'changed_components': ap.smp.json.dumps(snapshot.get_diff())}
+    return run_on_sample(job_id, cache_key, set_params)
+
+
+def raw_data_submit_job(job_id, sample, cache_key):
+    """
+    Background calculation of a sample created from raw data, the sample is cached with cache_key
+    """
+    steps = calc_funcs.recalculate(sample, ['initial'], progress=get_progress(job_id))
+    ap.smp.table.update_table_data(sample)  # Update table after submission row data and calculation
+    http_funcs.create_cache(sample, cache_key)
+    return {'steps': steps, 'cache_key': cache_key}
@@ -0,0 +1,203 @@
+"""
+Reading raw data files.
+
+ap.smp.raw.to_raw parses the given files one after another. Here each file is parsed by a
+worker of a process pool with the compiled plan of its input filter (filter_funcs), and
+the raw data of the files are concatenated in the order of the files, so that sequences
+are numbered and renamed as ararpy does.
+
+Parsed files are kept on disk by RawFileCache, keyed by the hashes of the file and of its
+input filter, so that submitting the same files again skips parsing.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from . import ap, filter_funcs, log_funcs, upload_funcs
+from .http_funcs import cache_codec
+
+# Number of processes parsing raw files, None for the number of processors, 0 or 1 to parse
+# the files in the web worker
+RAW_WORKERS = getattr(settings, 'RAW_WORKERS', None)
+# Directory and size limit of parsed raw files kept on disk
+RAW_CACHE_DIR = getattr(settings, 'RAW_CACHE_DIR', os.path.join(settings.PRIVATE_DIR, 'raw_cache'))
+RAW_CACHE_MAX_BYTES = getattr(settings, 'RAW_CACHE_MAX_BYTES', 1073741824)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Pool parsing raw files, None if files are parsed in the web worker
+    """
+    global _executor
+    if RAW_WORKERS is not None and RAW_WORKERS <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=RAW_WORKERS)
+    return _executor
+
+
+def read_file(file_path: str, plan):
+    """
+    Parameters
+    ----------
+    file_path : path of a raw file
+    plan : filter_funcs.FilterPlan of its input filter
+
+    Returns
+    -------
+    RawData of a single file and the time of parsing in seconds
+    """
+    start = time.perf_counter()
+    raw = filter_funcs.to_raw(file_path, plan)
+    return raw, time.perf_counter() - start
+
+
+class RawFileCache:
+    """
+    Parsed raw files on disk, keyed by the SHA-256 of the file and of the input filter, and
+    the file name.
+    Values are RawData of single files encoded by http_funcs.cache_codec. The modification
+    time of a file is its last use, and the least recently used files are removed once the
+    total size exceeds max_bytes.
+    """
+
+    suffix = '.raw'
+
+    def __init__(self, directory: str = RAW_CACHE_DIR, max_bytes: int = RAW_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, file_path: str, input_filter_path: str):
+        # Filters may read sample information from the file name, so it is part of the key
+        name = hashlib.sha256(os.path.basename(file_path).encode('utf-8')).hexdigest()[:16]
+        return f"{upload_funcs.get_file_hash(file_path)}-{upload_funcs.get_file_hash(input_filter_path)}-{name}"
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        RawData, None if the key is not cached or the file cannot be read
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                raw = cache_codec.loads(f.read())
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return raw
+
+    def put(self, key, raw):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(key)
+        temp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, 'wb') as f:
+            f.write(cache_codec.dumps(raw))
+        os.replace(temp, path)
+        self.evict()
+
+    def get_entries(self):
+        """
+        Cached files as (last use, size, path), least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return sorted(entries)
+
+    def evict(self):
+        with self._lock:
+            entries = self.get_entries()
+            total = sum([size for _, size, _ in entries])
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        entries = self.get_entries()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0, 'entries': len(entries),
+            'bytes': sum([size for _, size, _ in entries]), 'max_bytes': self.max_bytes,
+        }
+
+
+raw_file_cache = RawFileCache()
+
+
+def to_raw(file_path: list, input_filter_path: list, ip='-'):
+    """
+    Same as ap.smp.raw.to_raw for lists of files, with files parsed in parallel
+    Parameters
+    ----------
+    file_path : list of paths of raw files
+    input_filter_path : list of paths of input filters, one for each file
+    ip : client address written in the log with the time of parsing each file
+
+    Returns
+    -------
+    RawData
+    """
+    if not isinstance(file_path, list) or not isinstance(input_filter_path, list) \
+            or len(file_path) != len(input_filter_path):
+        raise ValueError("File path and input filter should be both list with a same length.")
+    start = time.perf_counter()
+    keys = [raw_file_cache.get_key(file, input_filter_path[index]) for index, file in enumerate(file_path)]
+    results = [None] * len(file_path)
+    for index, file in enumerate(file_path):
+        _start = time.perf_counter()
+        raw = raw_file_cache.get(keys[index])
+        if raw is not None:
+            raw.source = [file]  # the same file may have been uploaded to another directory
+            results[index] = (raw, time.perf_counter() - _start)
+    missing = [index for index, res in enumerate(results) if res is None]
+    # Filters are compiled here and sent to the workers, so that plans are invalidated in one place
+    plans = [filter_funcs.get_filter_plan(input_filter_path[index]) for index in missing]
+    executor = get_executor() if len(missing) > 1 else None
+    if executor is None:
+        parsed = [read_file(file_path[index], plan) for index, plan in zip(missing, plans)]
+    else:
+        parsed = list(executor.map(read_file, [file_path[index] for index in missing], plans))
+    for index, res in zip(missing, parsed):
+        results[index] = res
+        try:
+            raw_file_cache.put(keys[index], res[0])
+        except OSError as e:
+            log_funcs.write_log(ip, 'WARNING', f"Parsed raw file not cached: {e}", ignore=True)
+    for index, (file, (raw, elapsed)) in enumerate(zip(file_path, results)):
+        log_funcs.write_log(ip, 'INFO', f"{'Parse' if index in missing else 'Load cached'} raw file: "
+                                        f"{os.path.basename(file)}, {len(raw.sequence)} sequences, "
+                                        f"{elapsed * 1000:.1f} ms", ignore=True)
+    raw = ap.smp.raw.concatenate([raw for raw, _ in results])
+    log_funcs.write_log(ip, 'INFO', f"Parse {len(file_path)} raw files: {len(raw.sequence)} sequences, "
+                                    f"{(time.perf_counter() - start) * 1000:.1f} ms", ignore=True)
+    return raw
@@ -0,0 +1,611 @@
+"""
+Batched regressions of raw data.
+
+ap.smp.raw.do_regression fits the selected cycles of each sequence and isotope one series
+at a time, and the step search of the power and exponential fits runs hundreds of small
+regressions per series. Here the cycles of all series are stacked into arrays padded with
+zeros, with a mask of valid points, and each fitting method is solved for all series of
+the same length at once. The operations of ap.calc.regression are kept in the same order,
+so that results are the same as those of the per-series functions.
+
+When points of a sequence are selected or deselected, update_regression adds or removes
+the toggled points in sums kept in the cache, and starts the curve fittings from their
+previous solutions, instead of fitting the sequence again.
+
+Whether the results of each sequence, isotope and fitting method are numbers is kept in a
+bitmap in the cache, updated with the results, so that checking the regressions before
+submitting does not go through all results.
+"""
+import hashlib
+import numpy as np
+from scipy.optimize import fsolve
+from django.core.cache import cache
+from . import ap
+from .http_funcs import DEFAULT_CACHE_TIMEOUT
+
+# Order of the fitting methods in Sequence.results, as in ap.calc.raw_funcs
+METHODS = ['linest', 'quadratic', 'exponential', 'power', 'average']
+# Series with fewer points are fitted by the per-series functions of ararpy
+MIN_POINTS = 4
+
+
+def get_series(raw, sequence_index=None, isotopic_index=None):
+    """
+    Selected points of the sequences and isotopes to be fitted, as in ap.smp.raw.do_regression
+    Returns
+    -------
+    list of (sequence, isotopic index, [[x1, y1], [x2, y2], ...])
+    """
+    series = []
+    for sequence in raw.get_sequence(index=None, flag=None):
+        if hasattr(sequence_index, '__getitem__') and sequence.index not in sequence_index:
+            continue
+        isotope = sequence.get_data_df()
+        selected = isotope[sequence.get_flag_df()[list(range(1, 11))]]
+        for index in range(5):
+            if hasattr(isotopic_index, '__getitem__') and index not in isotopic_index:
+                continue
+            series.append((sequence, index, selected[[index * 2 + 1, 2 * (index + 1)]].dropna().values.tolist()))
+    return series
+
+
+def stack(points):
+    """
+    Parameters
+    ----------
+    points : list of two dimensional lists, [[x1, y1], [x2, y2], ..., [xn, yn]] of each series
+
+    Returns
+    -------
+    x, y : arrays (number of series, max number of points) padded with zeros
+    mask : bool array of valid points, valid points come first in each row
+    """
+    size = max([len(each) for each in points], default=0)
+    x, y = np.zeros((len(points), size)), np.zeros((len(points), size))
+    mask = np.zeros((len(points), size), dtype=bool)
+    for row, each in enumerate(points):
+        try:
+            values = np.array(each, dtype=float).reshape(-1, 2)
+        except (TypeError, ValueError):
+            continue  # not numbers, left to the per-series functions
+        x[row, :len(values)], y[row, :len(values)] = values[:, 0], values[:, 1]
+        mask[row, :len(values)] = True
+    return x, y, mask
+
+
+def _pow(base, exponent):
+    # Elementwise power of floats, negative bases with fractional exponents are nan and
+    # overflows are inf, as for powers of np.float64 in the per-series functions
+    base, exponent = np.asarray(base, dtype=float), np.asarray(exponent, dtype=float)
+    with np.errstate(invalid='ignore', over='ignore'):
+        return np.where((base < 0) & (exponent != np.floor(exponent)), np.nan, np.power(base, exponent))
+
+
+def _sum(values):
+    # Sum along the last axis adding values one by one like sum() of lists
+    return np.cumsum(values, axis=-1)[..., -1]
+
+
+def _inv(a):
+    """
+    Inverse of stacked matrices, singular ones are returned as nan and flagged
+    """
+    failed = np.zeros(len(a), dtype=bool)
+    try:
+        return np.linalg.inv(a), failed
+    except np.linalg.LinAlgError:
+        inv = np.full(a.shape, np.nan)
+        for index, matrix in enumerate(a):
+            try:
+                inv[index] = np.linalg.inv(matrix)
+            except np.linalg.LinAlgError:
+                failed[index] = True
+        return inv, failed
+
+
+def linest(y, *xs):
+    """
+    Batched ap.calc.regression.linest, y = b + m1 * x1 + m2 * x2 + ...
+    Parameters
+    ----------
+    y : array (k, m), known y's of k series of m points
+    xs : arrays (k, m), known x's
+
+    Returns
+    -------
+    beta, se_beta : arrays (k, number of xs + 1)
+    r2 : array (k, )
+    failed : bool array (k, ), singular series
+    """
+    xt = np.stack([np.ones(y.shape), *xs], axis=1)  # transpose of the design matrices, (k, n, m)
+    x = xt.swapaxes(1, 2)
+    m, n = x.shape[1], x.shape[2]
+    inv_xtx, failed = _inv(np.matmul(xt, x))
+    beta = np.matmul(inv_xtx, np.matmul(xt, y[..., np.newaxis]))
+    estimate_y = np.matmul(x, beta)
+    resid = (estimate_y - y[..., np.newaxis]) ** 2
+    reg = (estimate_y - np.mean(estimate_y, axis=(1, 2), keepdims=True)) ** 2
+    ssresid = resid.sum(axis=(1, 2))
+    ssreg = reg.sum(axis=(1, 2))
+    sstotal = ssreg + ssresid
+    m_ssresid = ssresid / (m - n)
+    se_beta = (m_ssresid[:, np.newaxis] * np.diagonal(inv_xtx, axis1=1, axis2=2)) ** .5
+    r2 = np.where(sstotal != 0, ssreg / np.where(sstotal != 0, sstotal, 1), np.inf)
+    return beta[..., 0], se_beta, r2, failed
+
+
+def _get_initial_b(a0, a1, func):
+    # Initial estimate of the power or exponential curve solved through three mean points
+    points = [
+        (sum(a1[:3]) / 3, sum(a0[:3]) / 3), (sum(a1) / len(a1), sum(a0) / len(a0)),
+        (sum(a1[-3:]) / 3, sum(a0[-3:]) / 3)]
+
+    def equations(params):
+        a, b, c = params
+        return np.array([func(_x, a, b, c) - _y for _x, _y in points])
+
+    return fsolve(equations, np.array([1, 1, 1]))[1]
+
+
+def curve(y, x, method, initial=None):
+    """
+    Batched ap.calc.regression.power (y = a * x ^ b + c) or exponential (y = a * b ^ x + c).
+    b is searched for all series in step, each series stopping as the per-series search does.
+    Parameters
+    ----------
+    y, x : arrays (k, m)
+    method : 'power' or 'exponential'
+    initial : optional, array (k, ) of b to start the search from, e.g. the previous solution
+        of a series whose points have changed, nan values are estimated by fsolve
+
+    Returns
+    -------
+    intercept, se_intercept, rse_intercept, r2 : arrays (k, )
+    coeffs : array (k, 3), [a, b, c]
+    failed : bool array (k, )
+    """
+    if method == 'power':
+        func, transform = (lambda _x, a, b, c: a * _x ** b + c), (lambda _x, b: _pow(_x, b))
+    else:
+        func, transform = (lambda _x, a, b, c: a * b ** _x + c), (lambda _x, b: _pow(b, _x))
+
+    k = len(y)
+    b = np.zeros(k)
+    failed = np.zeros(k, dtype=bool)
+    for row in range(k):  # fsolve takes one system at a time
+        if initial is not None and np.isfinite(initial[row]):
+            b[row] = initial[row]
+            continue
+        try:
+            b[row] = _get_initial_b(y[row].tolist(), x[row].tolist(), func)
+        except (Exception, BaseException):
+            failed[row] = True
+
+    step = np.full(k, 0.01)
+    count = np.zeros(k, dtype=int)
+    active = ~failed
+    # Sum of squared residuals at b, known when b has just moved to b_left or b_right,
+    # whose sums are computed in the same way
+    s_b = np.zeros(k)
+    known = np.zeros(k, dtype=bool)
+    while active.any():
+        rows = np.flatnonzero(active)
+        _b, _step, _x, _y = b[rows], step[rows], x[rows], y[rows]
+        new = ~known[rows]
+        b_left, b_right = _b - _step * _b, _b + _step * _b
+        bs = np.concatenate([_b[new], b_left, b_right])
+        xs, ys = np.concatenate([_x[new], _x, _x]), np.concatenate([_y[new], _y, _y])
+        z = transform(xs, bs[:, np.newaxis])
+        beta, _, _, _failed = linest(ys, z)
+        s = _sum(_pow(beta[:, [1]] * z + beta[:, [0]] - ys, 2))
+        n_new = new.sum()
+        s_b[rows[new]] = s[:n_new]
+        s, s_left, s_right = s_b[rows], *s[n_new:].reshape(2, -1)
+        failed[rows[new]] |= _failed[:n_new]
+        _failed = failed[rows] | _failed[n_new:].reshape(2, -1).any(axis=0)
+        go_right = (s_left > s) & (s > s_right)
+        go_left = ~go_right & (s_left < s) & (s < s_right)
+        halve = ~go_right & ~go_left
+        b[rows] = np.where(go_right, b_right, np.where(
+            go_left, b_left, np.where(s_left < s_right, (_b + b_left) / 2, (_b + b_right) / 2)))
+        s_b[rows] = np.where(go_right, s_right, s_left)
+        known[rows] = ~halve
+        count[rows] += halve
+        step[rows] = np.where(halve, _step * 0.5, _step)
+        failed[rows] |= _failed
+        active[rows] = ~_failed & ~(halve & (step[rows] < 0.000001)) & (count[rows] < 100)
+
+    z = transform(x, b[:, np.newaxis])
+    beta, se_beta, _, _failed = linest(y, z)
+    failed |= _failed
+    a, sea, c, sec = beta[:, 1], se_beta[:, 1], beta[:, 0], se_beta[:, 0]
+    calculated_y = a[:, np.newaxis] * z + c[:, np.newaxis]
+    m = x.shape[1]
+    ssresid = _sum(_pow(calculated_y - y, 2))
+    ssreg = _sum(_pow(calculated_y - (_sum(calculated_y) / m)[:, np.newaxis], 2))
+    sstotal = ssreg + ssresid
+    r2 = np.where(sstotal != 0, ssreg / np.where(sstotal != 0, sstotal, 1), 1)
+    intercept = a + c if method == 'exponential' else c
+    errfz = _pow(_sum(_pow(z, 2)) / (m * _sum(_pow(z, 2)) - _pow(_sum(z), 2)), 0.5)
+    errfx = _pow(_sum(_pow(x, 2)) / (m * _sum(_pow(x, 2)) - _pow(_sum(x), 2)), 0.5)
+    se_intercept = sec / errfz * errfx
+    rse_intercept = se_intercept / intercept * 100
+    return intercept, se_intercept, rse_intercept, r2, np.stack([a, b, c], axis=1), failed
+
+
+def average(y):
+    """
+    Batched ap.calc.regression.average
+    Returns
+    -------
+    intercept, se_intercept, rse_intercept, r2 : arrays (k, )
+    coeffs : array (k, 1)
+    """
+    m = y.shape[1]
+    k0 = _sum(y) / m
+    estimate_y = np.repeat(k0[:, np.newaxis], m, axis=1)
+    ssresid = _sum(_pow(y - k0[:, np.newaxis], 2))
+    ssreg = _sum(_pow(estimate_y - (_sum(estimate_y) / m)[:, np.newaxis], 2))
+    sstotal = ssreg + ssresid
+    r2 = np.where(sstotal != 0, ssreg / np.where(sstotal != 0, sstotal, 1), 1)
+    k1 = _pow(ssresid / (m - 1), 0.5)
+    k2 = np.where(k0 != 0, k1 / np.where(k0 != 0, k0, 1) * 100, 0)
+    return k0, k1, k2, r2, k0[:, np.newaxis]
+
+
+def fit(x, y, initial=None):
+    """
+    All fitting methods of series of the same number of points
+    Parameters
+    ----------
+    x, y : arrays (k, m)
+    initial : optional, dict of initial b of the exponential and power fits, see curve
+
+    Returns
+    -------
+    dict, method: (intercept, se, rse, r2, coeffs, failed)
+    """
+    initial = initial or {}
+    with np.errstate(all='ignore'):
+        beta, se_beta, r2, failed = linest(y, x)
+        linear = (beta[:, 0], se_beta[:, 0], se_beta[:, 0] / beta[:, 0] * 100, r2, beta, failed)
+        beta, se_beta, r2, failed = linest(y, x, _pow(x, 2))
+        quadratic = (beta[:, 0], se_beta[:, 0], se_beta[:, 0] / beta[:, 0] * 100, r2, beta, failed)
+        return {
+            'linest': linear, 'quadratic': quadratic,
+            'exponential': curve(y, x, 'exponential', initial.get('exponential')),
+            'power': curve(y, x, 'power', initial.get('power')),
+            'average': (*average(y), np.zeros(len(y), dtype=bool)),
+        }
+
+
+def get_lines_results(fitted, index, y_min, y_max):
+    """
+    Results and coefficients of a series in the format of ap.calc.raw_funcs
+    Parameters
+    ----------
+    fitted : dict returned by fit
+    index : index of the series in fitted
+    y_min, y_max : range of y of the series, fittings far from it are bad
+
+    Returns
+    -------
+    (linesResults, regCoeffs), None if a fitting has failed
+    """
+    lines_results, reg_coeffs = [], []
+    for method in METHODS:
+        intercept, se, rse, r2, coeffs, failed = fitted[method]
+        if failed[index]:
+            return None
+        line_results = (intercept[index], se[index], rse[index], r2[index])
+        if any(np.isnan(line_results)) or abs(intercept[index] - y_min) > 5 * (y_max - y_min):
+            lines_results.append(['BadFitting', np.nan, np.nan, np.nan, ])
+            reg_coeffs.append([])
+        else:
+            lines_results.append(line_results)
+            reg_coeffs.append(coeffs[index].copy() if method in ['linest', 'quadratic'] else
+                              coeffs[index].tolist())
+    return lines_results, reg_coeffs
+
+
+def get_regression_results(points):
+    """
+    Same as ap.calc.raw_funcs.get_raw_data_regression_results for many series
+    Parameters
+    ----------
+    points : list of two dimensional lists, [[x1, y1], [x2, y2], ..., [xn, yn]] of each series
+
+    Returns
+    -------
+    list of (linesResults, regCoeffs) of each series
+    """
+    x, y, mask = stack(points)
+    size = mask.sum(axis=1)
+    results = [None] * len(points)
+    for m in np.unique(size[size >= MIN_POINTS]):
+        rows = np.flatnonzero(size == m)
+        _x, _y = np.ascontiguousarray(x[rows, :m]), np.ascontiguousarray(y[rows, :m])
+        fitted = fit(_x, _y)
+        y_min, y_max = _y.min(axis=1), _y.max(axis=1)
+        for index, row in enumerate(rows):
+            results[row] = get_lines_results(fitted, index, y_min[index], y_max[index])
+    for row, each in enumerate(points):
+        if results[row] is None:  # few points or failed fittings, errors are labelled by ararpy
+            results[row] = ap.calc.raw_funcs.get_raw_data_regression_results(each)[1:]
+    return results
+
+
+def set_results(sequence, index, lines_results, reg_coeffs):
+    try:
+        sequence.results[index] = lines_results
+        sequence.coefficients[index] = reg_coeffs
+    except IndexError:
+        sequence.results.insert(index, lines_results)
+        sequence.coefficients.insert(index, reg_coeffs)
+    except TypeError:
+        sequence.results = [lines_results]
+        sequence.coefficients = [reg_coeffs]
+
+
+def do_regression(raw, sequence_index=None, isotopic_index=None):
+    """
+    Same as ap.smp.raw.do_regression, with all series fitted by get_regression_results at once
+    """
+    series = get_series(raw, sequence_index, isotopic_index)
+    fitted = get_regression_results([points for *_, points in series])
+    for (sequence, index, _), (lines_results, reg_coeffs) in zip(series, fitted):
+        set_results(sequence, index, lines_results, reg_coeffs)
+
+
+class RegressionStats:
+    """
+    Sufficient statistics of the selected points of a series for the linear, quadratic and
+    average fittings: sums of powers of x and their products with y, taken about the means
+    of all points of the series to limit cancellation. When the selection changes, the terms
+    of the points that have been selected or deselected are added or removed, so an update
+    costs the number of toggled points, not the number of points.
+    """
+
+    def __init__(self, x, y, mask):
+        valid = ~np.isnan(x) & ~np.isnan(y)
+        self.x0 = float(x[valid].mean()) if valid.any() else 0.
+        self.y0 = float(y[valid].mean()) if valid.any() else 0.
+        self.digest = self.get_digest(x, y)
+        self.mask = np.zeros(len(x), dtype=bool)
+        self.sums = np.zeros(5)  # sums of u ** k, k = 0...4, u = x - x0
+        self.cross = np.zeros(3)  # sums of u ** k * v, k = 0...2, v = y - y0
+        self.squares = 0.  # sum of v ** 2
+        self.update(x, y, mask)
+
+    @staticmethod
+    def get_digest(x, y):
+        return hashlib.blake2b(x.tobytes() + y.tobytes(), digest_size=16).digest()
+
+    @property
+    def size(self):
+        return int(self.mask.sum())
+
+    def matches(self, x, y):
+        """
+        Whether the stats are of the points x, y, i.e. only their selection may have changed
+        """
+        return len(x) == len(self.mask) and self.get_digest(x, y) == self.digest
+
+    def update(self, x, y, mask):
+        """
+        Add the terms of newly selected points and remove those of deselected points
+        Returns
+        -------
+        int, number of changed points
+        """
+        flipped = np.flatnonzero(mask != self.mask)
+        if len(flipped) == 0:
+            return 0
+        sign = np.where(mask[flipped], 1., -1.)
+        u, v = x[flipped] - self.x0, y[flipped] - self.y0
+        powers = u[:, np.newaxis] ** np.arange(5)
+        self.sums += np.matmul(sign, powers)
+        self.cross += np.matmul(sign, powers[:, :3] * v[:, np.newaxis])
+        self.squares += float(np.dot(sign, v * v))
+        self.mask = mask.copy()
+        return len(flipped)
+
+    def linest(self, degree):
+        """
+        Same as ap.calc.regression.linest (degree 1) or quadratic (degree 2) of the selected points
+        Returns
+        -------
+        intercept, se_intercept, rse_intercept, r2, beta
+        """
+        p = degree + 1
+        inv = np.linalg.inv(self.sums[np.add.outer(np.arange(p), np.arange(p))])
+        c = np.matmul(inv, self.cross[:p])
+        n = self.sums[0]
+        fitted = np.dot(c, self.cross[:p])  # sum of squares of fitted v
+        ssresid = max(self.squares - fitted, 0.)
+        ssreg = fitted - self.cross[0] ** 2 / n
+        sstotal = ssreg + ssresid
+        # Coefficients of x from those of u = x - x0
+        a = np.array([[1, -self.x0, self.x0 ** 2], [0, 1, -2 * self.x0], [0, 0, 1]])[:p, :p]
+        beta = np.matmul(a, c)
+        beta[0] += self.y0
+        se_beta = (ssresid / (n - p) * np.diagonal(np.matmul(np.matmul(a, inv), a.T))) ** .5
+        r2 = ssreg / sstotal if sstotal != 0 else np.inf
+        return beta[0], se_beta[0], se_beta[0] / beta[0] * 100, r2, beta
+
+    def average(self):
+        """
+        Same as ap.calc.regression.average of the selected points
+        """
+        n = self.sums[0]
+        k0 = self.y0 + self.cross[0] / n
+        ssresid = max(self.squares - self.cross[0] ** 2 / n, 0.)
+        k1 = (ssresid / (n - 1)) ** .5
+        k2 = k1 / k0 * 100 if k0 != 0 else 0
+        return k0, k1, k2, 0 if ssresid != 0 else 1, np.array([k0])
+
+
+def get_stats_key(cache_key, sequence_index):
+    return f"{cache_key}:regression:{sequence_index}"
+
+
+def get_points(sequence, index):
+    """
+    x, y of all cycles of an isotope and the mask of the points fitted by ap.smp.raw.do_regression
+    """
+    data = sequence.get_data_df()[[index * 2 + 1, 2 * (index + 1)]].astype(float).values
+    flag = sequence.get_flag_df()[[index * 2 + 1, 2 * (index + 1)]].values.astype(bool)
+    x, y = data[:, 0], data[:, 1]
+    return x, y, flag.all(axis=1) & ~np.isnan(x) & ~np.isnan(y)
+
+
+def _get_single(results):
+    # Results of a single series in the format of fit
+    *values, coeffs = results
+    return (*[np.array([value]) for value in values], [coeffs], np.zeros(1, dtype=bool))
+
+
+def fit_stats(stats, x, y, coefficients=None):
+    """
+    All fitting methods of the selected points of an isotope, the linear, quadratic and
+    average fittings are solved from stats. The search of the exponential and power fittings
+    starts from b of the previous coefficients if they are given, the fsolve estimate is
+    taken for those that have been labelled as bad fittings.
+    Parameters
+    ----------
+    stats : RegressionStats of the selected points
+    x, y : selected points
+    coefficients : optional, previous regCoeffs of the isotope, see set_results
+
+    Returns
+    -------
+    (linesResults, regCoeffs)
+    """
+    points = np.stack([x, y], axis=1).tolist()
+    if stats.size < MIN_POINTS:
+        return ap.calc.raw_funcs.get_raw_data_regression_results(points)[1:]
+    initial = {}
+    for method in ['exponential', 'power']:
+        try:
+            coeffs = list(coefficients[METHODS.index(method)])
+        except (TypeError, IndexError):
+            coeffs = []
+        initial[method] = np.array([coeffs[1] if len(coeffs) == 3 else np.nan], dtype=float)
+    results = None
+    try:
+        with np.errstate(all='ignore'):
+            fitted = {
+                'linest': _get_single(stats.linest(1)), 'quadratic': _get_single(stats.linest(2)),
+                'exponential': curve(y[np.newaxis], x[np.newaxis], 'exponential', initial['exponential']),
+                'power': curve(y[np.newaxis], x[np.newaxis], 'power', initial['power']),
+                'average': _get_single(stats.average()),
+            }
+        results = get_lines_results(fitted, 0, y.min(), y.max())
+    except np.linalg.LinAlgError:
+        pass
+    if results is None:  # failed fittings, errors are labelled by ararpy
+        return ap.calc.raw_funcs.get_raw_data_regression_results(points)[1:]
+    return results
+
+
+def update_regression(raw, sequence_index, cache_key):
+    """
+    Regression of a sequence after points have been selected or deselected. The statistics
+    of each isotope are kept in the cache with the raw data and updated with the toggled
+    points; the linear, quadratic and average fittings are solved from them, and the
+    exponential and power fittings are searched again from their previous coefficients.
+    Isotopes with unchanged points keep their results.
+    Parameters
+    ----------
+    raw : RawData
+    sequence_index : index of the sequence in raw.sequence
+    cache_key : cache key of the raw data
+    """
+    sequence = raw.sequence[sequence_index]
+    key = get_stats_key(cache_key, sequence_index)
+    all_stats = cache.get(key) or {}
+    for index in range(5):
+        try:
+            x, y, mask = get_points(sequence, index)
+        except (TypeError, ValueError):  # not numbers, errors are labelled by ararpy
+            do_regression(raw, sequence_index=[sequence.index], isotopic_index=[index])
+            continue
+        stats = all_stats.get(index)
+        # Previous coefficients are of other points if the points themselves have changed
+        warm = stats is None or stats.matches(x, y)
+        if not warm or stats is None:
+            stats = all_stats[index] = RegressionStats(x, y, mask)
+        elif stats.update(x, y, mask) == 0 and len(sequence.results) > index:
+            continue
+        coefficients = sequence.coefficients[index] if warm and len(sequence.coefficients or []) > index else None
+        set_results(sequence, index, *fit_stats(stats, x[mask], y[mask], coefficients))
+    cache.set(key, all_stats, timeout=DEFAULT_CACHE_TIMEOUT)
+    set_validity(raw, cache_key, sequence_index=[sequence_index])
+
+
+def get_validity_key(cache_key):
+    return f"{cache_key}:regression:valid"
+
+
+def get_validity(sequence):
+    """
+    Whether all values of the results of each isotope and fitting method of a sequence are
+    numbers, bool array of shape (5, methods)
+    """
+    valid = np.zeros((5, len(METHODS)), dtype=bool)
+    results = sequence.results or []
+    for index in range(min(len(results), 5)):
+        for method, res in enumerate(results[index][:len(METHODS)]):
+            valid[index, method] = all([isinstance(i, (float, int)) for i in res])
+    return valid
+
+
+def set_validity(raw, cache_key, sequence_index=None):
+    """
+    Update the validity bitmap of raw in the cache, sequences x isotopes x methods
+    Parameters
+    ----------
+    raw : RawData
+    cache_key : cache key of the raw data
+    sequence_index : indexes of sequences in raw.sequence whose results have changed, all
+        sequences if None
+
+    Returns
+    -------
+    bitmap, bool array
+    """
+    bitmap = cache.get(get_validity_key(cache_key)) if sequence_index is not None else None
+    if bitmap is None or len(bitmap) > len(raw.sequence):
+        bitmap, sequence_index = np.zeros((0, 5, len(METHODS)), dtype=bool), []
+    # Sequences appended since the last update, imported or estimated blanks
+    bitmap = np.concatenate([bitmap, np.array(
+        [get_validity(seq) for seq in raw.sequence[len(bitmap):]], dtype=bool).reshape(-1, 5, len(METHODS))])
+    for index in sequence_index:
+        bitmap[index] = get_validity(raw.sequence[index])
+    cache.set(get_validity_key(cache_key), bitmap, timeout=DEFAULT_CACHE_TIMEOUT)
+    return bitmap
+
+
+def get_failed(raw, cache_key, names=None):
+    """
+    Regressions of the selected fitting methods whose results are not numbers, read from the
+    validity bitmap
+    Parameters
+    ----------
+    raw : RawData
+    cache_key : cache key of the raw data
+    names : optional, names of the sequences to check, all sequences if None
+
+    Returns
+    -------
+    list of [sequence index, sequence name, isotope], removed sequences are not included
+    """
+    bitmap = cache.get(get_validity_key(cache_key))
+    if bitmap is None or len(bitmap) != len(raw.sequence):
+        bitmap = set_validity(raw, cache_key, sequence_index=[])
+    methods = np.array([[int(i) for i in seq.fitting_method] for seq in raw.sequence], dtype=int).reshape(-1, 5)
+    checked = np.array([not seq.is_removed and (names is None or seq.name in names) for seq in raw.sequence], dtype=bool)
+    in_range = (methods >= 0) & (methods < len(METHODS))
+    valid = bitmap[np.arange(len(methods))[:, np.newaxis], np.arange(5), np.clip(methods, 0, len(METHODS) - 1)]
+    failed = checked[:, np.newaxis] & ~(valid & in_range)
+    return [[raw.sequence[i].index, raw.sequence[i].name, f"Ar{36 + ar}"] for i, ar in zip(*np.nonzero(failed))]
@@ -0,0 +1,309 @@
+"""
+Exported sequences.
+
+Sequences used to be exported as pickles of ap.Sequence, which are large, slow to load and
+unsafe to load from uploaded files. Version 2 of .seq files is a numpy .npz archive:
+
+- header, JSON of the format, the version and the attributes of each sequence;
+- results and coefficients of the regressions of each sequence, isotope and fitting method,
+  as float arrays of shape (sequences, 5, methods, length) padded with NaN, with the number
+  of methods and the lengths of the rows (pack);
+- data, flag and offsets, the cycles of all sequences stacked into arrays, the cycles of
+  sequence i being rows offsets[i] to offsets[i + 1];
+- cycles, JSON of the labels of the cycles of each sequence.
+
+Members of an .npz archive are read only when accessed, so that reading the results only
+does not read or decompress the cycles. Results that are not numbers, for example the
+messages of failed regressions, and cycles that are not numbers are kept in the JSON
+members.
+
+The same cycle arrays are used to send the raw data of a run to extrapolate.html one
+sequence at a time: the page is rendered with a summary of the run, the sequences without
+their cycles, and the cycles of a sequence are requested when it is shown, as JSON rows or
+as base64 little-endian float64 values.
+"""
+import base64
+import copy
+import io
+import json
+import pickle
+import numpy as np
+from django.conf import settings
+from . import ap
+
+FORMAT = 'webarar-sequences'
+VERSION = 2
+# Legacy .seq files are pickles of sequences, loaded by SequenceUnpickler, set False to
+# refuse them
+SEQUENCE_PICKLE_IMPORT = getattr(settings, 'SEQUENCE_PICKLE_IMPORT', True)
+# Whether imported blanks are read without their cycles by default
+SEQUENCE_IMPORT_RESULTS_ONLY = getattr(settings, 'SEQUENCE_IMPORT_RESULTS_ONLY', False)
+
+_NUMBER = (int, float, np.integer, np.floating)
+# Globals other than ararpy classes that legacy .seq files may refer to
+# The multiarray module is numpy.core in numpy 1 and numpy._core in numpy 2, pickles of both are read
+_MULTIARRAY = np.empty(0).__reduce__()[0].__module__
+_PICKLE_ALIASES = {'numpy.core.multiarray': _MULTIARRAY, 'numpy._core.multiarray': _MULTIARRAY}
+_PICKLE_GLOBALS = {
+    ('numpy', 'ndarray'), ('numpy', 'dtype'), (_MULTIARRAY, '_reconstruct'), (_MULTIARRAY, 'scalar'),
+    ('builtins', 'set'), ('builtins', 'frozenset'), ('builtins', 'complex'), ('builtins', 'bytearray'),
+    ('collections', 'OrderedDict'), ('datetime', 'datetime'), ('datetime', 'date'), ('datetime', 'timedelta'),
+    ('ararpy.smp.sample', 'Sequence'), ('ararpy.smp.sample', 'RawData'),
+    ('ararpy.smp.sample', 'ArArBasic'), ('ararpy.smp.sample', 'ArArData'),
+}
+
+
+class SequenceUnpickler(pickle.Unpickler):
+    """
+    Unpickler of legacy .seq files, which only loads the globals in _PICKLE_GLOBALS,
+    so that an uploaded pickle cannot import or call anything else
+    """
+
+    def find_class(self, module, name):
+        module = _PICKLE_ALIASES.get(module, module)
+        if (module, name) in _PICKLE_GLOBALS:
+            obj = super().find_class(module, name)
+            # Names imported into the module from elsewhere are not what the allowlist means
+            if getattr(obj, '__module__', None) == module:
+                return obj
+        raise pickle.UnpicklingError(f"Global {module}.{name} is not allowed in sequence files")
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def _to_array(obj):
+    return np.frombuffer(json.dumps(obj, default=_default).encode('utf-8'), dtype=np.uint8)
+
+
+def _from_array(arr):
+    return json.loads(arr.tobytes().decode('utf-8'))
+
+
+def _is_numbers(row, length=None):
+    return isinstance(row, (list, tuple, np.ndarray)) and (length is None or len(row) == length) \
+        and all([isinstance(i, _NUMBER) and not isinstance(i, bool) for i in row])
+
+
+def get_cycles(seq):
+    """
+    Cycles of a sequence as arrays
+    Returns
+    -------
+    labels, data, flag, or None if the cycles are not rows of a label followed by numbers
+    of the same length, with flags of the same shape
+    """
+    data, flag = seq.data, seq.flag
+    if not isinstance(data, list) or not isinstance(flag, list) or len(data) != len(flag):
+        return None
+    if len(data) == 0:
+        return [], np.zeros((0, 0)), np.zeros((0, 0), dtype=bool)
+    width = len(data[0])
+    if width == 0 or any([len(row) != width or not _is_numbers(row[1:]) for row in data]):
+        return None
+    if any([len(row) != width or row[0] != data[i][0] or not all([isinstance(j, (bool, np.bool_)) for j in row[1:]])
+            for i, row in enumerate(flag)]):
+        return None
+    labels = [row[0] for row in data]
+    return labels, np.array([row[1:] for row in data], dtype=float), np.array([row[1:] for row in flag], dtype=bool)
+
+
+def pack(items: list):
+    """
+    Regression results or coefficients of sequences as arrays
+    Parameters
+    ----------
+    items : for each sequence, a list of five isotopes of lists of rows of numbers, one row
+        for each fitting method
+
+    Returns
+    -------
+    methods : int array of shape (sequences, 5), number of methods of each isotope, -1 for
+        missing isotopes
+    lengths : int array of shape (sequences, 5, methods), length of each row
+    values : float array of shape (sequences, 5, methods, length), padded with NaN
+    irregular : list of [sequence, isotope, method, row] of rows that are not numbers
+    """
+    n = len(items)
+    methods = np.array([[len(each[ar]) if ar < len(each) else -1 for ar in range(5)] for each in items],
+                       dtype=np.int16).reshape(n, 5)
+    rows = [(i, ar, m, row) for i, each in enumerate(items) for ar in range(min(len(each), 5))
+            for m, row in enumerate(each[ar])]
+    irregular = [[i, ar, m, row] for i, ar, m, row in rows if not _is_numbers(row)]
+    rows = [(i, ar, m, row) for i, ar, m, row in rows if _is_numbers(row)]
+    width = max([len(row) for *_, row in rows], default=0)
+    lengths = np.full((n, 5, max(int(methods.max(initial=0)), 1)), -1, dtype=np.int16)
+    values = np.full(lengths.shape + (max(width, 1),), np.nan)
+    for i, ar, m, row in rows:
+        lengths[i, ar, m] = len(row)
+        values[i, ar, m, :len(row)] = row
+    return methods, lengths, values, irregular
+
+
+def unpack(methods, lengths, values, irregular, cast=list):
+    """
+    Inverse of pack, rows of numbers are converted by cast
+    """
+    lengths, values = lengths.tolist(), values.tolist()
+    items = [[[cast(values[i][ar][m][:lengths[i][ar][m]]) for m in range(methods[i, ar])]
+              for ar in range(5) if methods[i, ar] >= 0] for i in range(len(methods))]
+    for i, ar, m, row in irregular:
+        items[i][ar][m] = row
+    return items
+
+
+def dumps(sequences: list):
+    """
+    Parameters
+    ----------
+    sequences : list of Sequence
+
+    Returns
+    -------
+    bytes of a version 2 .seq file
+    """
+    methods, lengths, results, irregular = pack([seq.results for seq in sequences])
+    coefficients = pack([seq.coefficients for seq in sequences])
+    header, cycles, data, flag, offsets = [], [], [], [], [0]
+    for seq in sequences:
+        header.append({k: v for k, v in vars(seq).items() if k not in ['data', 'flag', 'results', 'coefficients']})
+        arrays = get_cycles(seq) if seq.data is not None else None
+        if seq.data is None:
+            cycles.append(None)
+        elif arrays is None:
+            cycles.append({'data': seq.data, 'flag': seq.flag})
+        else:
+            cycles.append({'labels': arrays[0], 'width': arrays[1].shape[1]})
+            data.append(arrays[1])
+            flag.append(arrays[2])
+        offsets.append(offsets[-1] + (0 if arrays is None else len(arrays[1])))
+    width = max([each.shape[1] for each in data], default=0)
+    data = [np.pad(each, ((0, 0), (0, width - each.shape[1])), constant_values=np.nan) for each in data]
+    flag = [np.pad(each, ((0, 0), (0, width - each.shape[1]))) for each in flag]
+    f = io.BytesIO()
+    np.savez_compressed(
+        f, header=_to_array({'format': FORMAT, 'version': VERSION, 'sequences': header,
+                             'irregular': irregular, 'irregular_coefficients': coefficients[3]}),
+        methods=methods, lengths=lengths, results=results,
+        coefficient_methods=coefficients[0], coefficient_lengths=coefficients[1], coefficients=coefficients[2],
+        data=np.concatenate(data) if data else np.zeros((0, width)),
+        flag=np.concatenate(flag) if flag else np.zeros((0, width), dtype=bool),
+        offsets=np.array(offsets, dtype=np.int64), cycles=_to_array(cycles),
+    )
+    return f.getvalue()
+
+
+def dump(sequences: list, file_path: str):
+    with open(file_path, 'wb') as f:
+        f.write(dumps(sequences))
+
+
+def is_archive(file):
+    """
+    Whether an opened binary file is an .npz archive, the position of the file is kept
+    """
+    position = file.tell()
+    magic = file.read(4)
+    file.seek(position)
+    return magic == b'PK\x03\x04'
+
+
+def load(file, results_only: bool = False):
+    """
+    Read sequences from a .seq file
+    Parameters
+    ----------
+    file : path or opened binary file
+    results_only : if True, cycles are not read and the data and flag of the sequences are
+        empty lists
+
+    Returns
+    -------
+    list of Sequence
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            return load(f, results_only=results_only)
+    if not is_archive(file):
+        if not SEQUENCE_PICKLE_IMPORT:
+            raise ValueError("Sequence files of the old version are not supported")
+        return SequenceUnpickler(file).load()
+    with np.load(file, allow_pickle=False) as npz:
+        header = _from_array(npz['header'])
+        if header.get('format') != FORMAT or header.get('version', 0) > VERSION:
+            raise ValueError(f"Unsupported sequence file: {header.get('format')}, version {header.get('version')}")
+        results = unpack(npz['methods'], npz['lengths'], npz['results'], header['irregular'], cast=tuple)
+        coefficients = unpack(npz['coefficient_methods'], npz['coefficient_lengths'], npz['coefficients'],
+                              header['irregular_coefficients'])
+        if results_only:
+            data, flag = [[] for _ in results], [[] for _ in results]
+        else:
+            data, flag = get_data(npz)
+    return [ap.Sequence(data=data[i], flag=flag[i], results=results[i], coefficients=coefficients[i], **meta)
+            for i, meta in enumerate(header['sequences'])]
+
+
+def get_data(npz):
+    """
+    Cycles of the sequences of an opened archive, as lists of rows of Sequence.data and
+    Sequence.flag
+    """
+    cycles, offsets = _from_array(npz['cycles']), npz['offsets']
+    values, flags = npz['data'], npz['flag']
+    data, flag = [], []
+    for i, each in enumerate(cycles):
+        if each is None or 'data' in each:
+            data.append(None if each is None else each['data'])
+            flag.append(None if each is None else each['flag'])
+            continue
+        width = each['width']
+        _values = values[offsets[i]:offsets[i + 1], :width].tolist()
+        _flags = flags[offsets[i]:offsets[i + 1], :width].tolist()
+        data.append([[label, *row] for label, row in zip(each['labels'], _values)])
+        flag.append([[label, *row] for label, row in zip(each['labels'], _flags)])
+    return data, flag
+
+
+def get_summary(raw):
+    """
+    Copy of a RawData whose sequences have no cycles, the data and flag of the sequences are
+    None and cycles is the number of cycles of each sequence
+    """
+    summary = copy.copy(raw)
+    summary.sequence = []
+    for seq in raw.sequence:
+        each = copy.copy(seq)
+        each.cycles = None if seq.data is None else len(seq.data)
+        each.data, each.flag = None, None
+        summary.sequence.append(each)
+    return summary
+
+
+def encode_cycles(seq, encoding: str = 'json'):
+    """
+    Cycles of a sequence for extrapolate.html
+    Parameters
+    ----------
+    seq : Sequence
+    encoding : 'json' for the rows of Sequence.data and Sequence.flag, 'binary' for labels and
+        base64 strings of the values as float64 and the flags as uint8, row by row. Cycles
+        that are not numbers are always sent as JSON
+
+    Returns
+    -------
+    dict
+    """
+    arrays = get_cycles(seq) if encoding == 'binary' and seq.data is not None else None
+    if arrays is None:
+        return {'encoding': 'json', 'data': seq.data, 'flag': seq.flag}
+    labels, data, flag = arrays
+    return {
+        'encoding': 'binary', 'labels': labels, 'shape': list(data.shape),
+        'data': base64.b64encode(data.astype('<f8').tobytes()).decode('ascii'),
+        'flag': base64.b64encode(flag.astype(np.uint8).tobytes()).decode('ascii'),
+    }
@@ -0,0 +1,320 @@
+"""
+Streaming uploads.
+
+Django keeps uploaded files in memory up to FILE_UPLOAD_MAX_MEMORY_SIZE, and
+ap.files.basic.upload copies them again into the upload directory. HashingUploadHandler
+writes every uploaded file to a temporary file chunk by chunk as the request is read,
+computing its SHA-256 on the way, so the memory used by an upload does not depend on the
+size of the file.
+
+Uploaded files are kept once in UploadStore, named by their hash, and the path the file
+is uploaded to is a link to the stored file. Uploading a file that is already stored only
+adds the link. Stored files that are no longer linked from any upload path are removed by
+UploadStore.collect, which uploads run at most every UPLOAD_GC_INTERVAL seconds.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+# Size of the chunks uploaded files are read and written in
+UPLOAD_CHUNK_SIZE = getattr(settings, 'UPLOAD_CHUNK_SIZE', 1048576)
+# Directory of uploaded files named by their SHA-256
+UPLOAD_BLOB_DIR = getattr(settings, 'UPLOAD_BLOB_DIR', os.path.join(settings.PRIVATE_DIR, 'blobs'))
+# Seconds between collections of unused stored files and stale index entries, None to
+# collect only when UploadStore.collect is called
+UPLOAD_GC_INTERVAL = getattr(settings, 'UPLOAD_GC_INTERVAL', 86400)
+# Stored files and index entries younger than this, in seconds, are never collected, so that
+# files being uploaded are not removed between being stored and being linked
+UPLOAD_GC_GRACE = getattr(settings, 'UPLOAD_GC_GRACE', 3600)
+# Same as ap.files.basic.upload
+SUPPORTED_SUFFIXES = ['.xls', '.age', '.xlsx', '.arr', '.jpg', '.png', '.txt', '.log', '.seq', '.json', '.ahd', '.csv']
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """
+    Upload handler streaming files to temporary files, the SHA-256 of the content is set
+    as the sha256 attribute of the uploaded file
+    """
+
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.sha = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.sha.hexdigest()
+        return file
+
+
+_hashes = {}  # path: ((modification time, size), SHA-256)
+_hashes_lock = threading.Lock()
+
+
+def get_file_version(file_path: str):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def set_file_hash(file_path: str, sha256: str):
+    """
+    Remember the hash of a file computed while it was uploaded, until the file is changed
+    """
+    with _hashes_lock:
+        _hashes[file_path] = (get_file_version(file_path), sha256)
+
+
+class UploadStore:
+    """
+    Content-addressed store of uploaded files.
+    Files are stored as directory/ab/abcd..., named by their SHA-256, and the paths files
+    are uploaded to are hard links to them, or copies where links are not supported. The
+    index maps these paths to the hash of their content, with the modification time and
+    size of the file, so that the hash of an uploaded file is known to all workers. Each
+    path has its own small entry file under directory/index, named by the hash of the path,
+    which is replaced atomically, so that an upload writes its own entry only and workers in
+    different processes do not overwrite the entries of each other.
+    """
+
+    index_name = 'index'
+    collected_name = 'collected'
+
+    def __init__(self, directory: str = UPLOAD_BLOB_DIR):
+        self.directory = directory
+        self.stored = 0
+        self.deduplicated = 0
+        self.collected = 0
+
+    def get_blob_path(self, sha256: str):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def get_index_path(self, file_path: str):
+        key = hashlib.sha256(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, self.index_name, key[:2], f"{key}.json")
+
+    def get_entry(self, index_path: str):
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set_index(self, file_path: str, sha256: str):
+        index_path = self.get_index_path(file_path)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        version = get_file_version(file_path)
+        temp = f"{index_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, 'w') as f:
+            json.dump({'path': os.path.abspath(file_path), 'sha256': sha256,
+                       'mtime_ns': version[0], 'size': version[1]}, f)
+        os.replace(temp, index_path)
+
+    def lookup(self, file_path: str):
+        """
+        Returns
+        -------
+        SHA-256 of an uploaded file, None if the file is not in the index or has been changed
+        """
+        item = self.get_entry(self.get_index_path(file_path))
+        if item is None or (item['mtime_ns'], item['size']) != get_file_version(file_path):
+            return None
+        return item['sha256']
+
+    def add(self, temp_path: str, sha256: str):
+        """
+        Store a file by moving it from temp_path, unless a file of the same content is stored
+        Returns
+        -------
+        path of the stored file, and whether the file was new
+        """
+        blob_path = self.get_blob_path(sha256)
+        if os.path.exists(blob_path):
+            self.deduplicated += 1
+            return blob_path, False
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        file_move_safe(temp_path, blob_path, chunk_size=UPLOAD_CHUNK_SIZE, allow_overwrite=True)
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:  # temporary files are private to the owner
+            os.chmod(blob_path, settings.FILE_UPLOAD_PERMISSIONS)
+        self.stored += 1
+        return blob_path, True
+
+    def link(self, blob_path: str, file_path: str):
+        """
+        Make file_path a link to a stored file, replacing the file at file_path
+        """
+        temp = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(blob_path, temp)
+        except OSError:  # other file systems, or no support of hard links
+            shutil.copyfile(blob_path, temp)
+        os.replace(temp, file_path)
+
+    def put(self, file, file_path: str):
+        """
+        Store an uploaded file and link it to file_path
+        Parameters
+        ----------
+        file : UploadedFile, files of HashingUploadHandler are moved from their temporary
+            files, others are written in chunks and hashed
+        file_path : path the file is uploaded to
+
+        Returns
+        -------
+        str, SHA-256 of the file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        sha256 = getattr(file, 'sha256', None)
+        streamed = sha256 is not None and hasattr(file, 'temporary_file_path')
+        if streamed:
+            file.file.flush()
+            temp = file.temporary_file_path()
+        else:
+            sha = hashlib.sha256()
+            temp = os.path.join(self.directory, f"{uuid.uuid4().hex}.tmp")
+            with open(temp, 'wb') as f:
+                for chunk in file.chunks(chunk_size=UPLOAD_CHUNK_SIZE):
+                    sha.update(chunk)
+                    f.write(chunk)
+            sha256 = sha.hexdigest()
+        blob_path, new = self.add(temp, sha256)
+        try:
+            self.link(blob_path, file_path)
+        except FileNotFoundError:  # the stored file was collected in the meantime
+            if new:
+                raise
+            blob_path, new = self.add(temp, sha256)
+            self.link(blob_path, file_path)
+        if not new and not streamed:
+            os.remove(temp)
+        self.set_index(file_path, sha256)
+        if UPLOAD_GC_INTERVAL is not None:
+            self.collect(interval=UPLOAD_GC_INTERVAL)
+        return sha256
+
+    def collect(self, interval=None, grace=UPLOAD_GC_GRACE):
+        """
+        Remove index entries of paths that no longer exist or have been changed, and stored
+        files that no upload path links to or, where files were copied, refers to
+        Parameters
+        ----------
+        interval : seconds, skip the collection if the last one, by any worker, was more recent
+        grace : seconds, entries and stored files modified more recently are kept
+
+        Returns
+        -------
+        int, number of removed stored files
+        """
+        marker = os.path.join(self.directory, self.collected_name)
+        now = time.time()
+        try:
+            if interval is not None and now - os.stat(marker).st_mtime < interval:
+                return 0
+        except OSError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        with open(marker, 'a'):
+            os.utime(marker)
+        referred = set()
+        for root, _, files in os.walk(os.path.join(self.directory, self.index_name)):
+            for name in files:
+                index_path = os.path.join(root, name)
+                item = self.get_entry(index_path)
+                try:
+                    if item is not None and (item['mtime_ns'], item['size']) == get_file_version(item['path']):
+                        referred.add(item['sha256'])
+                        continue
+                    if now - os.stat(index_path).st_mtime > grace:
+                        os.remove(index_path)
+                except OSError:
+                    pass
+        removed = 0
+        for prefix in os.listdir(self.directory):
+            root = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(root):  # blobs are in directory/ab/
+                continue
+            for name in os.listdir(root):
+                blob_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(blob_path)
+                    if name.endswith('.tmp') or name in referred or stat.st_nlink > 1 or now - stat.st_mtime <= grace:
+                        continue
+                    os.remove(blob_path)
+                    removed += 1
+                except OSError:
+                    pass
+        self.collected += removed
+        return removed
+
+    def stats(self):
+        blobs, size = 0, 0
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory and self.index_name in dirs:
+                dirs.remove(self.index_name)
+            for name in files:
+                if root != self.directory and not name.endswith('.tmp'):
+                    blobs += 1
+                    size += os.path.getsize(os.path.join(root, name))
+        return {'stored': self.stored, 'deduplicated': self.deduplicated, 'collected': self.collected,
+                'blobs': blobs, 'bytes': size}
+
+
+upload_store = UploadStore()
+
+
+def get_file_hash(file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """
+    SHA-256 of the content of a file, uploaded files are not read again
+    """
+    version = get_file_version(file_path)
+    with _hashes_lock:
+        item = _hashes.get(file_path)
+    if item is not None and item[0] == version:
+        return item[1]
+    sha256 = upload_store.lookup(file_path)
+    if sha256 is None:
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        sha256 = sha.hexdigest()
+    with _hashes_lock:
+        _hashes[file_path] = (version, sha256)
+    return sha256
+
+
+def upload(file, media_dir):
+    """
+    Same as ap.files.basic.upload, with the file kept in upload_store and the file in
+    media_dir a link to it.
+    Parameters
+    ----------
+    file : UploadedFile of request.FILES
+    media_dir : destination directory
+
+    Returns
+    -------
+    web_file_path, name, suffix
+    """
+    try:
+        name, suffix = os.path.splitext(file.name)
+        if suffix.lower() not in SUPPORTED_SUFFIXES:
+            raise TypeError(f"The imported file is not supported: {suffix}")
+        web_file_path = os.path.join(media_dir, file.name)
+        set_file_hash(web_file_path, upload_store.put(file, web_file_path))
+    except PermissionError:
+        raise ValueError(f'Permission denied')
+    except (Exception, BaseException) as e:
+        raise ValueError(f'Error in opening file: {e}')
+    return web_file_path, name, suffix
@@ -0,0 +1,268 @@
+"""
+Parameter sweeps of random walker diffusion models.
+
+A sweep runs ap.thermo.arw.run for every combination of activation energies and volume
+fractions of the domains in a process pool of WALKER_WORKERS processes, each combination
+saving its own .ads file. The request returns a sweep id at once, the state of the sweep
+is kept in the cache like the job table of job_funcs and is updated by the web worker as
+combinations finish, so that the client polls it.
+
+Every sweep is also checkpointed in the MDD workspace as sweep_<id>.json, with the inputs
+of the simulations, the seed of each combination and the combinations already saved.
+resume_sweep submits the combinations that have not finished again, with the same inputs
+and the same seeds of the numpy random generator. Combinations of ap.thermo.arw.run start
+over and repeat the interrupted simulations exactly; those of the array engine also save
+their walkers and random generator as sweep_<id>_<index>.npz every WALKER_CHECKPOINT_STEPS
+heating steps, and continue from there with the same results as an uninterrupted run. A
+sweep with combinations still running in the web worker is not resumed, and each start of
+a sweep has its own run id, so that results of combinations submitted by an earlier start
+are not counted again.
+"""
+import json
+import os
+import time
+import traceback
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from . import ap, diffusion_funcs, http_funcs, log_funcs
+
+# Number of processes running walker simulations, None for the number of processors
+WALKER_WORKERS = getattr(settings, 'WALKER_WORKERS', None)
+
+_executor = None
+_executor_lock = threading.Lock()
+_state_lock = threading.Lock()
+_futures = {}  # sweep id: futures of the combinations submitted by this worker
+# Statuses of combinations that are not run again
+FINAL_STATUSES = ['finished', 'rejected', 'failed']
+
+
+class SweepRunningError(ValueError):
+    pass
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=WALKER_WORKERS or os.cpu_count())
+    return _executor
+
+
+def get_sweep_key(sweep_id):
+    return f"sweep:{sweep_id}"
+
+
+def get_sweep(sweep_id):
+    """
+    Returns
+    -------
+    dict of the sweep state, None if the sweep does not exist
+    """
+    return cache.get(get_sweep_key(sweep_id))
+
+
+def update_sweep(sweep_id, **kwargs):
+    sweep = get_sweep(sweep_id) or {}
+    sweep.update(kwargs, updated=time.time())
+    cache.set(get_sweep_key(sweep_id), sweep, timeout=http_funcs.DEFAULT_CACHE_TIMEOUT)
+    return sweep
+
+
+def get_file_name(energies, fractions, ndoms, use_walker1, k, gs, ad, f, pumping, engine='ararpy'):
+    # k, the time scale of ararpy's walkers, is not a parameter of the array walker
+    walker = 'array' if engine == 'array' else 'walker1' if use_walker1 else 'walker2'
+    return f"{walker} " + (f"{k=:.1f} " if engine != 'array' else "") + \
+           f"es={'-'.join([str(int(i / 1000)) for i in energies])} " \
+           f"fs={'-'.join([str(i) for i in fractions])} " \
+           f"{gs=:.0f} " \
+           f"{ad=:.0e} " \
+           f"{f=:.0e} " \
+           f"{ndoms=:.0f} " \
+           f"pumping={pumping} " \
+           f"multi"
+
+
+def get_checkpoint_path(loc, sweep_id):
+    return os.path.join(loc, f"sweep_{sweep_id}.json")
+
+
+def get_walker_checkpoint_path(loc, sweep_id, index):
+    # Walkers of a combination of the array engine, see diffusion_funcs.run
+    return os.path.join(loc, f"sweep_{sweep_id}_{index}.npz")
+
+
+def read_checkpoint(loc, sweep_id):
+    with open(get_checkpoint_path(loc, sweep_id), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint):
+    """
+    Write a checkpoint to a temporary file and replace the old one, so that a checkpoint is
+    never left half written
+    """
+    path = get_checkpoint_path(checkpoint['loc'], checkpoint['id'])
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def submit_sweep(combinations, loc, times, temps, statuses, targets, ndoms, use_walker1, k, gs, ad, f,
+                 pumping, dimension=3, engine='ararpy'):
+    """
+    Run a walker simulation for each combination in the pool
+    Parameters
+    ----------
+    combinations : list of (energies, fractions) of the domains
+    loc : directory the .ads files and the checkpoint are saved to
+    times, temps, statuses, targets : heating schedule and cumulative released fractions
+    engine : 'ararpy' for ap.thermo.arw.run, 'array' for diffusion_funcs.run
+    others : parameters of the walker shared by all combinations
+
+    Returns
+    -------
+    str, sweep id
+    """
+    sweep_id = uuid.uuid4().hex
+    seeds = np.random.SeedSequence().generate_state(len(combinations)).tolist()
+    checkpoint = {
+        'id': sweep_id, 'loc': loc, 'created': time.time(),
+        'params': {
+            'times': np.asarray(times, dtype=np.float64).tolist(),
+            'temps': np.asarray(temps, dtype=np.float64).tolist(),
+            'statuses': list(statuses), 'targets': np.asarray(targets, dtype=np.float64).tolist(),
+            'ndoms': ndoms, 'use_walker1': use_walker1, 'k': k, 'gs': gs, 'ad': ad, 'f': f,
+            'pumping': pumping, 'dimension': dimension, 'engine': engine,
+        },
+        'combinations': [
+            {'energies': list(_e), 'fractions': list(_f), 'seed': seed, 'status': 'queued', 'file': '',
+             'hours': None, 'error': ''} for (_e, _f), seed in zip(combinations, seeds)],
+    }
+    write_checkpoint(checkpoint)
+    return start_sweep(checkpoint)
+
+
+def resume_sweep(loc, sweep_id):
+    """
+    Submit the combinations of a checkpointed sweep that have not finished, for example after
+    the web worker was restarted
+    Returns
+    -------
+    str, sweep id
+    """
+    with _state_lock:
+        if any([not future.done() for future in _futures.get(sweep_id, [])]):
+            raise SweepRunningError(f"Sweep {sweep_id} is still running")
+    return start_sweep(read_checkpoint(loc, sweep_id))
+
+
+def start_sweep(checkpoint):
+    sweep_id, loc, params = checkpoint['id'], checkpoint['loc'], checkpoint['params']
+    combinations = checkpoint['combinations']
+    pending = [index for index, each in enumerate(combinations) if each['status'] not in ['finished', 'rejected']]
+    for index in pending:
+        combinations[index].update(status='queued', error='')
+    done = len(combinations) - len(pending)
+    run = uuid.uuid4().hex
+    update_sweep(sweep_id, id=sweep_id, loc=loc, total=len(combinations), done=done, run=run,
+                 status='running' if pending else 'finished', combinations=combinations,
+                 created=checkpoint['created'])
+    times = np.array(params['times'], dtype=np.float64)
+    temps = np.array(params['temps'], dtype=np.float64)
+    targets = np.array(params['targets'], dtype=np.float64)
+    executor = get_executor()
+    futures = []
+    for index in pending:
+        _e, _f = combinations[index]['energies'], combinations[index]['fractions']
+        file_name = get_file_name(_e, _f, params['ndoms'], params['use_walker1'], params['k'], params['gs'],
+                                  params['ad'], params['f'], params['pumping'], params.get('engine', 'ararpy'))
+        future = executor.submit(
+            run_combination, loc, file_name, times, temps, params['statuses'], targets, _e, _f, params['ndoms'],
+            params['use_walker1'], params['k'], params['gs'], params['ad'], params['f'], params['dimension'],
+            combinations[index]['seed'], params.get('engine', 'ararpy'),
+            get_walker_checkpoint_path(loc, sweep_id, index))
+        futures.append(future)
+    with _state_lock:
+        _futures[sweep_id] = futures
+    for index, future in zip(pending, futures):
+        future.add_done_callback(lambda _future, _index=index: finish_combination(sweep_id, _index, _future, run))
+    return sweep_id
+
+
+def run_combination(loc, file_name, times, temps, statuses, targets, energies, fractions, ndoms, use_walker1, k,
+                    gs, ad, f, dimension, seed=None, engine='ararpy', checkpoint=None):
+    """
+    Simulation of one combination in a pool process, the model is saved in loc as an .ads
+    file, or an .npz file for the array engine, whose walkers are checkpointed to the file
+    checkpoint while they walk
+    Returns
+    -------
+    dict, status, file name and hours taken
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    _start = time.time()
+    if engine == 'array':
+        try:
+            walker = diffusion_funcs.run(
+                times, temps, statuses, energies, fractions, ndoms, gs, dimension=dimension, atom_density=ad,
+                frequency=f, targets=targets, epsilon=0.05, seed=seed, file_name=file_name, checkpoint=checkpoint)
+        except diffusion_funcs.OverEpsilonError as e:
+            result = {'status': 'rejected', 'file': '', 'hours': (time.time() - _start) / 3600, 'error': f"{e}"}
+        else:
+            hours = (time.time() - _start) / 3600
+            name = walker.name + f" {hours:.2f}h"
+            diffusion_funcs.save(walker, loc, name=name)
+            result = {'status': 'finished', 'file': name, 'hours': hours, 'error': ''}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return result
+    try:
+        demo, status = ap.thermo.arw.run(
+            times, temps, statuses, energies, fractions, ndoms, file_name=file_name, k=k, grain_szie=gs,
+            dimension=dimension, atom_density=ad, frequency=f, simulation=False, targets=targets, epsilon=0.05,
+            use_walker1=use_walker1
+        )
+    except ap.thermo.arw.OverEpsilonError as e:
+        return {'status': 'rejected', 'file': '', 'hours': (time.time() - _start) / 3600, 'error': f"{e}"}
+    hours = (time.time() - _start) / 3600
+    name = demo.name + f" {hours:.2f}h"
+    ap.thermo.arw.save_ads(demo, f"{loc}", name=name)
+    return {'status': 'finished', 'file': name, 'hours': hours, 'error': ''}
+
+
+def finish_combination(sweep_id, index, future, run=None):
+    """
+    Done callback of a combination, called in the web worker
+    Parameters
+    ----------
+    run : run id of the start of the sweep the combination was submitted by, results of
+        earlier starts are ignored
+    """
+    try:
+        result = future.result()
+    except (Exception, BaseException) as e:
+        log_funcs.write_log('-', 'ERROR', f"Sweep {sweep_id} combination {index} failed: {traceback.format_exc()}",
+                            ignore=True)
+        result = {'status': 'failed', 'file': '', 'hours': None, 'error': f"{type(e).__name__}: {e}"}
+    with _state_lock:
+        sweep = get_sweep(sweep_id)
+        if sweep is None or run is not None and sweep.get('run', run) != run:
+            return
+        sweep['combinations'][index].update(result)
+        done = len([each for each in sweep['combinations'] if each['status'] in FINAL_STATUSES])
+        update_sweep(sweep_id, combinations=sweep['combinations'], done=done,
+                     status='finished' if done >= sweep['total'] else 'running',
+                     **({'finished': time.time()} if done >= sweep['total'] else {}))
+        try:
+            checkpoint = read_checkpoint(sweep['loc'], sweep_id)
+            checkpoint['combinations'][index].update(result)
+            write_checkpoint(checkpoint)
+        except OSError:
+            log_funcs.write_log('-', 'ERROR', f"Sweep {sweep_id} checkpoint failed: {traceback.format_exc()}",
+                                ignore=True)
@@ -847,20 +847,46 @@ function getInterpolatedBlank() {
 
         interpolated_blank = transpose(interpolated_blank)
 
-        $.ajax({
-            url: url_raw_interpolated_blanks,
-            type: 'POST',
-            data: JSON.stringify({
-                'interpolated_blank': interpolated_blank,
-                'cache_key': myRawCacheKey,
-            }),
-            contentType:'application/json',
-            dataType: 'text',
-            success: function(res){
-                res = myParse(res);
-                myRawData['interpolated_blank'] = res.sequences;
-            }
-        });
+        // Linear, quadratic, polynomial and average blanks are computed on the server with errors,
+        // exponential and power curves are sent as they are shown
+        let server_methods = [['polynomial', 1], ['polynomial', 2], ['polynomial', 5], null, null, ['average', 0]];
+        let methods = [0, 1, 2, 3, 4].map((isotope) => server_methods[selects.eq(isotope).val()]);
+        if (methods.every((method) => method !== null)) {
+            $.ajax({
+                url: url_raw_blank_evolution,
+                type: 'POST',
+                data: JSON.stringify({
+                    'blanks': nameList,
+                    'mode': methods.map((method) => method[0]),
+                    'degree': methods.map((method) => method[1]),
+                    'cache_key': myRawCacheKey,
+                }),
+                contentType:'application/json',
+                dataType: 'text',
+                success: function(res){
+                    res = myParse(res);
+                    myRawData['interpolated_blank'] = res.sequences;
+                },
+                error: function (XMLHttpRequest, textStatus, errorThrown) {
+                    showErrorMessage(XMLHttpRequest, textStatus, errorThrown)
+                },
+            });
+        } else {
+            $.ajax({
+                url: url_raw_interpolated_blanks,
+                type: 'POST',
+                data: JSON.stringify({
+                    'interpolated_blank': interpolated_blank,
+                    'cache_key': myRawCacheKey,
+                }),
+                contentType:'application/json',
+                dataType: 'text',
+                success: function(res){
+                    res = myParse(res);
+                    myRawData['interpolated_blank'] = res.sequences;
+                }
+            });
+        }
 
         newSequencesList.push({
             "index": "undefined",
@@ -1140,7 +1166,10 @@ function showSequence(page) {  // page starts with 1
         $('#last_page').attr("disabled",false);
         $('#next_page').attr("disabled",false);
     }
-    updateCharts(smCharts, chartBig, page-1, true, myRawData.sequence[page-1].fitting_method);
+    loadSequenceData([page - 1, page], () => {
+        if (current_page !== page) {return}
+        updateCharts(smCharts, chartBig, page-1, true, myRawData.sequence[page-1].fitting_method);
+    });
     $('#fitMethod').val(myRawData.sequence[page-1].fitting_method[getCurrentIsotope()]);
     $('#isBlank').prop("checked", myRawData.sequence[page-1].is_blank);
     $('#isRemoved').prop("checked", myRawData.sequence[page-1].is_removed);
@@ -1245,6 +1274,61 @@ function submitRawData() {
         }
     })
 }
+function decodeBase64(string) {
+    let binary = atob(string);
+    let bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes.buffer;
+}
+function decodeCycles(cycles) {
+    // Rows of data and flag of a sequence from the response of get_raw_sequences
+    if (cycles.encoding !== 'binary') {
+        return [cycles.data, cycles.flag];
+    }
+    let [rows, cols] = cycles.shape;
+    let values = new Float64Array(decodeBase64(cycles.data));
+    let flags = new Uint8Array(decodeBase64(cycles.flag));
+    let data = [], flag = [];
+    for (let i = 0; i < rows; i++) {
+        data.push([cycles.labels[i]].concat(Array.from(values.subarray(i * cols, (i + 1) * cols))));
+        flag.push([cycles.labels[i]].concat(Array.from(flags.subarray(i * cols, (i + 1) * cols), (v) => v === 1)));
+    }
+    return [data, flag];
+}
+function loadSequenceData(indexes, callback) {
+    // Sequences of the summary rendered in extrapolate.html have no cycles, request the cycles
+    // of the given sequences that have not been loaded
+    let missing = indexes.filter((index) => index >= 0 && index < myRawData.sequence.length &&
+        myRawData.sequence[index].data === null && myRawData.sequence[index].cycles !== null &&
+        myRawData.sequence[index].cycles !== undefined);
+    if (missing.length === 0) {
+        callback();
+        return;
+    }
+    $.ajax({
+        url: url_raw_sequences,
+        type: 'POST',
+        data: JSON.stringify({
+            'cache_key': myRawCacheKey,
+            'indexes': missing,
+            'encoding': 'binary',
+        }),
+        contentType:'application/json',
+        dataType: 'text',
+        success: function(res){
+            res = myParse(res);
+            $.each(res.sequences, (index, cycles) => {
+                [myRawData.sequence[index].data, myRawData.sequence[index].flag] = decodeCycles(cycles);
+            });
+            callback();
+        },
+        error: function (XMLHttpRequest, textStatus, errorThrown) {
+            showErrorMessage(XMLHttpRequest, textStatus, errorThrown)
+        },
+    })
+}
 function getSelectedData(sequence_data, sequence_flag) {
     let selected = sequence_data.map(function (arr, i) {
         return arr.map(function (value, j) {
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - benchmark_diff
+# ==========================================
+#
+# Time of building the response of changed components, deep copy + get_diff_smp
+# against fingerprinted snapshots, for the example age files.
+# Run from the project root: python -m tests.benchmark_diff
+"""
+
+import copy
+import os
+import time
+
+from programs import ap, diff_funcs
+
+AGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'examples', 'age')
+REPEAT = 5
+
+
+def replot_all(sample):
+    # Select the first point and replot all figures, as a recalculation does
+    sample.set_selection(0, 1)
+    sample.recalculate(re_plot=True, isInit=False, isIsochron=True, isPlateau=True)
+    ap.smp.table.update_table_data(sample)
+
+
+def replot_one(sample):
+    # Select the first point and replot the normal isochron only
+    sample.set_selection(0, 1)
+    sample.recalculate(re_plot=True, isInit=False, isIsochron=True, isPlateau=False, figures=['figure_2'])
+    ap.smp.table.update_table_data(sample, only_table='7')
+
+
+def with_deepcopy(sample, change):
+    t = time.perf_counter()
+    backup = copy.deepcopy(ap.smp.basic.get_components(sample))
+    elapsed = time.perf_counter() - t
+    change(sample)
+    t = time.perf_counter()
+    res = ap.smp.basic.get_diff_smp(backup=backup, smp=ap.smp.basic.get_components(sample))
+    return res, elapsed + time.perf_counter() - t
+
+
+def with_snapshot(sample, change):
+    t = time.perf_counter()
+    snapshot = diff_funcs.ComponentSnapshot(sample)
+    elapsed = time.perf_counter() - t
+    change(sample)
+    t = time.perf_counter()
+    res = snapshot.get_diff()
+    return res, elapsed + time.perf_counter() - t
+
+
+def main():
+    print(f"{'file':<16}{'change':<12}{'deepcopy (ms)':>16}{'snapshot (ms)':>16}{'speedup':>10}  same")
+    for file in sorted(os.listdir(AGE_DIR)):
+        name = os.path.splitext(file)[0]
+        sample = ap.from_age(os.path.join(AGE_DIR, file), sample_name=name)
+        sample.recalculate(re_calc_ratio=True, re_plot=True, re_plot_style=True, re_set_table=True)
+        for change in [replot_all, replot_one]:
+            times = {with_deepcopy: [], with_snapshot: []}
+            results = {}
+            for _ in range(REPEAT):
+                for func in times.keys():
+                    res, elapsed = func(copy.deepcopy(sample), change)
+                    times[func].append(elapsed * 1000)
+                    results[func] = ap.smp.json.dumps(res)
+            t1, t2 = min(times[with_deepcopy]), min(times[with_snapshot])
+            same = results[with_deepcopy] == results[with_snapshot]
+            print(f"{name:<16}{change.__name__:<12}{t1:>16.2f}{t2:>16.2f}{t1 / t2:>10.1f}  {same}")
+
+
+if __name__ == '__main__':
+    main()
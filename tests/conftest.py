@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - conftest
+# ==========================================
+#
+# Django settings of the tests: a local memory cache instead of Redis, and private files
+# in a temporary directory. Run from the project root: python -m pytest tests
+"""
+
+import os
+import tempfile
+
+import django
+import pytest
+from django.conf import settings
+
+PRIVATE_DIR = tempfile.mkdtemp(prefix='webarar-tests-')
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='tests',
+        INSTALLED_APPS=[
+            'django.contrib.auth', 'django.contrib.contenttypes', 'django.contrib.sessions',
+            'django.contrib.messages', 'calc.apps.CalcConfig',
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        PRIVATE_DIR=PRIVATE_DIR,
+        UPLOAD_ROOT=os.path.join(PRIVATE_DIR, 'upload'),
+        UPLOAD_BLOB_DIR=os.path.join(PRIVATE_DIR, 'blobs'),
+        RAW_CACHE_DIR=os.path.join(PRIVATE_DIR, 'raw_cache'),
+        MDD_ROOT=os.path.join(PRIVATE_DIR, 'mdd'),
+        FILE_UPLOAD_PERMISSIONS=0o644,
+        RAW_WORKERS=0,
+    )
+    django.setup()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAW_FILE = os.path.join(ROOT, 'static', 'examples', 'raw-data', '21WHA0025.xls')
+RAW_FILTER = os.path.join(ROOT, 'static', 'settings', 'Qtegra-exported-xls.input-filter')
+
+
+@pytest.fixture
+def raw():
+    """
+    Raw data of the example 21WHA0025.xls, parsed by ararpy
+    """
+    from programs import ap
+    return ap.smp.raw.to_raw(file_path=[RAW_FILE], input_filter_path=[RAW_FILTER])
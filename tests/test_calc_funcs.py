@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_calc_funcs
+# ==========================================
+#
+# Dependency graph of the recalculation steps
+"""
+
+from programs import calc_funcs
+
+
+def test_get_downstream():
+    assert calc_funcs.get_downstream(['calc_ratio']) == ['calc_ratio', 'apparent_age', 'plot', 'table']
+    assert calc_funcs.get_downstream(['plot']) == ['plot']
+    assert calc_funcs.get_downstream(['degas_atm', 'table_style']) == \
+        ['degas_atm', 'degas_r', 'calc_ratio', 'apparent_age', 'plot', 'table', 'table_style']
+    assert calc_funcs.get_downstream(['unknown']) == []
+
+
+def test_initial_options():
+    # Initializing a sample evaluates everything, as the option flags of ararpy did
+    options = calc_funcs.get_options(calc_funcs.get_downstream(['initial']))
+    assert options == [True] * 11 + [False] + [True] * 4
+    assert calc_funcs.get_steps(options) == [step for step in calc_funcs.RECALC_STEPS if step != 'monte_carlo']
+
+
+def test_get_param_steps():
+    params = [[i] for i in range(140)]
+    assert calc_funcs.get_param_steps(params, params) == []
+    changed = [list(row) for row in params]
+    changed[20] = [0.5]  # read first by calc_ratio
+    changed[35] = [0.5]  # read first by apparent_age
+    assert calc_funcs.get_param_steps(params, changed) == ['calc_ratio', 'apparent_age']
+    changed[138] = [1]  # rows not listed are inputs of corr_blank
+    assert calc_funcs.get_param_steps(params, changed) == ['corr_blank', 'calc_ratio', 'apparent_age']
+    assert calc_funcs.get_param_steps(params, params[:-1]) == ['corr_blank']
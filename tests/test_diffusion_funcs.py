@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_diffusion_funcs
+# ==========================================
+#
+# The analytical forward model against walks of ArrayWalker through the same schedule, and
+# walks resumed from checkpoints, and against the walkers of ararpy
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from programs import diffusion_funcs
+
+TEMPS = np.array([800, 900, 1000, 1100, 1200], dtype=np.float64)
+TIMES = np.cumsum(np.full(len(TEMPS), 1800.))
+STATUSES = [True] * len(TEMPS)
+
+
+def walk(energies, fractions):
+    walker = diffusion_funcs.run(TIMES, TEMPS, STATUSES, energies, fractions, len(energies), 200,
+                                 atom_density=2e9, resolution=0.1, seed=1)
+    return np.cumsum(walker.get_released_fractions().sum(axis=1))
+
+
+def test_cube_release():
+    tau = np.array([1e-4, 1e-2, 0.1, 1.])
+    plane = diffusion_funcs.get_release_fractions(tau, 'plane')
+    assert np.allclose(diffusion_funcs.get_release_fractions(tau, 'cube'), 1 - (1 - plane) ** 3)
+
+
+def test_forward_single_domain():
+    released, measured = diffusion_funcs.forward(TIMES, TEMPS, STATUSES, [120e3], [1.], 200)
+    assert np.abs(released - walk([120e3], [1.])).max() < 0.01
+    assert measured[-1] == 1
+
+
+def test_forward_nested_domains():
+    for energies, fractions in [([125e3, 115e3, 130e3], [1., 0.8, 0.5]), ([110e3, 130e3], [1., 0.6])]:
+        released, _ = diffusion_funcs.forward(TIMES, TEMPS, STATUSES, energies, fractions, 200)
+        assert np.abs(released - walk(energies, fractions)).max() < 0.035
+
+
+def test_forward_models():
+    # Many models at once are the same as each model alone
+    energies = np.array([[125e3, 115e3], [120e3, 130e3]])
+    fractions = np.array([[1., 0.7], [1., 0.5]])
+    released, _ = diffusion_funcs.forward(TIMES, TEMPS, STATUSES, energies, fractions, 200)
+    for index in range(len(energies)):
+        alone, _ = diffusion_funcs.forward(TIMES, TEMPS, STATUSES, energies[index], fractions[index], 200)
+        assert np.allclose(released[index], alone)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_resume(tmp_path, monkeypatch):
+    kwargs = dict(atom_density=2e8, seed=3, checkpoint_steps=2)
+    expected = diffusion_funcs.run(TIMES, TEMPS, STATUSES, [120e3, 110e3], [1., 0.6], 2, 200, **kwargs)
+    checkpoint = str(tmp_path / 'walk.npz')
+    step, calls = diffusion_funcs.ArrayWalker.step, []
+
+    def interrupted(self, *args):
+        calls.append(args)
+        if len(calls) == 4:
+            raise Interrupted
+        return step(self, *args)
+
+    monkeypatch.setattr(diffusion_funcs.ArrayWalker, 'step', interrupted)
+    with pytest.raises(Interrupted):
+        diffusion_funcs.run(TIMES, TEMPS, STATUSES, [120e3, 110e3], [1., 0.6], 2, 200, checkpoint=checkpoint, **kwargs)
+    assert os.path.exists(checkpoint)
+    calls.clear()
+    walker = diffusion_funcs.run(TIMES, TEMPS, STATUSES, [120e3, 110e3], [1., 0.6], 2, 200, checkpoint=checkpoint,
+                                 **kwargs)
+    assert len(calls) == len(TIMES) - 2  # continued after the checkpoint of the second step
+    assert np.array_equal(walker.get_released_fractions(), expected.get_released_fractions())
+    assert np.array_equal(walker.positions, expected.positions) and walker.substeps == expected.substeps
+    assert walker.rng.bit_generator.state == expected.rng.bit_generator.state
+
+
+@pytest.mark.parametrize('use_walker1', [True, False])
+def test_benchmark(use_walker1):
+    # A few hundred atoms, both engines seeded, released fractions within sampling noise
+    res = diffusion_funcs.benchmark(TIMES, TEMPS, STATUSES, [120e3, 110e3], [1., 0.6], 2, 1.2, 200,
+                                    atom_density=1e8, use_walker1=use_walker1, seed=1)
+    assert res['difference'] < 0.05
+    assert res['array'] < res['ararpy']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_http_funcs
+# ==========================================
+#
+# Round trips of cache values through CacheCodec, copies of the template sample, and leases
+# of live objects in the LRU
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+
+from programs import http_funcs
+
+CODECS = [value[0] for value in http_funcs.CacheCodec.compressors.values()]
+
+
+@pytest.mark.parametrize('name', CODECS)
+def test_round_trip(name):
+    codec = http_funcs.CacheCodec(name)
+    obj = {'values': np.arange(1000, dtype=np.float64).reshape(100, 10), 'names': ['a', 'b'], 'n': 3}
+    value, fingerprint = codec.encode(obj)
+    loaded = codec.loads(value)
+    assert codec.is_encoded(value) and codec.raw_size(value) >= len(pickle.dumps(obj['names']))
+    assert np.array_equal(loaded['values'], obj['values'])
+    assert loaded['names'] == obj['names'] and loaded['n'] == 3
+    assert codec.fingerprint(loaded) == fingerprint
+
+
+@pytest.mark.parametrize('name', CODECS)
+def test_writable(name):
+    codec = http_funcs.CacheCodec(name)
+    loaded = codec.loads(codec.dumps(np.zeros((4, 4))))
+    assert loaded.flags.writeable
+    loaded[0, 0] = 1
+    assert loaded[0, 0] == 1
+
+
+def test_plain_pickle():
+    # Values cached before the codec was introduced
+    codec = http_funcs.CacheCodec()
+    assert codec.loads(pickle.dumps([1, 2, 3])) == [1, 2, 3]
+
+
+def test_fingerprint():
+    codec = http_funcs.CacheCodec()
+    assert codec.fingerprint({'a': np.ones(3)}) == codec.fingerprint({'a': np.ones(3)})
+    assert codec.fingerprint({'a': np.ones(3)}) != codec.fingerprint({'a': np.zeros(3)})
+
+
+def as_tree(obj):
+    if hasattr(obj, '__dict__'):
+        obj = vars(obj)
+    if isinstance(obj, dict):
+        return {key: as_tree(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [as_tree(value) for value in obj]
+    return repr(obj)
+
+
+def test_new_sample():
+    expected = http_funcs.ap.Sample()
+    http_funcs.ap.smp.initial.initial(expected)
+    sample, other = http_funcs.new_sample(), http_funcs.new_sample()
+    assert sample.Doi and sample.Doi != other.Doi
+    other.Info.sample.name = 'changed'
+    other.TotalParam[0].append(1)
+    assert {**as_tree(sample), 'Doi': ''} == {**as_tree(expected), 'Doi': ''}
+    assert vars(http_funcs.new_sample(initialized=False)).keys() == vars(http_funcs.ap.smp.Sample()).keys()
+
+
+def test_checkin():
+    cache_key = http_funcs.create_cache({'a': [1, 2]})
+    obj, lease = http_funcs.checkout(cache_key)
+    assert http_funcs.sample_lru.version(cache_key) is None  # taken by the request
+    http_funcs.checkin(cache_key, obj, lease)
+    assert http_funcs.checkout(cache_key)[0] is obj  # given back unchanged
+    http_funcs.checkin(cache_key, obj, lease, changed=True)
+    assert http_funcs.sample_lru.version(cache_key) is None
+    loaded, _ = http_funcs.checkout(cache_key)
+    assert loaded is not obj and loaded == {'a': [1, 2]}  # decoded again
+
+
+class FakeRedis:
+    """
+    Hashes of a Redis connection, enough for write_fields and read_fields
+    """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field.encode('utf-8'))
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({name.encode('utf-8'): value for name, value in mapping.items()})
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def expire(self, key, timeout):
+        pass
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+def test_write_fields(monkeypatch):
+    monkeypatch.setattr(http_funcs, 'get_redis_connection', lambda alias: conn)
+    conn = FakeRedis()
+    obj = http_funcs.ap.smp.Sample()
+    obj.SequenceName, obj.TotalParam = ['a', 'b'], [[1.] * 100] * 10
+    written, total = http_funcs.write_fields(obj, 'key')
+    assert written == total > 0
+    obj.SequenceName = ['a', 'c']
+    written, _total = http_funcs.write_fields(obj, 'key', dirty=['SequenceName', 'TotalParam'])
+    # Only the changed field is written, the size of the object is kept
+    assert written == http_funcs.cache_codec.raw_size(http_funcs.cache_codec.dumps(['a', 'c']))
+    assert _total == total
+    loaded, size = http_funcs.read_fields('key')
+    assert loaded.SequenceName == ['a', 'c'] and loaded.TotalParam == obj.TotalParam and size == total
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_job_funcs
+# ==========================================
+#
+# Background jobs writing their sample back only if no request has changed it meanwhile
+"""
+
+import pytest
+
+from programs import calc_funcs, http_funcs, job_funcs
+
+
+def start(monkeypatch, edits):
+    """
+    Cached sample and a recalculation editing it as another request would, edits times
+    """
+    cache_key = http_funcs.create_cache(http_funcs.new_sample())
+    runs = []
+
+    def recalculate(sample, steps, **kwargs):
+        runs.append(sample.Info.sample.name)
+        if len(runs) <= edits:
+            edited = http_funcs.cache_load(cache_key)
+            edited.Info.sample.name = f'edit {len(runs)}'
+            http_funcs.create_cache(edited, cache_key)
+        return steps
+
+    monkeypatch.setattr(calc_funcs, 'recalculate', recalculate)
+    monkeypatch.setattr(job_funcs, 'update_job', lambda job_id, **kwargs: kwargs)
+    return cache_key, runs
+
+
+def test_edit_during_job(monkeypatch):
+    cache_key, runs = start(monkeypatch, 1)
+    res = job_funcs.recalculation_job('job', cache_key, ['initial'], False, {})
+    assert res['steps'] == ['initial']
+    assert runs == ['SAMPLE NAME', 'edit 1']  # run again on the edited sample
+    assert http_funcs.cache_load(cache_key).Info.sample.name == 'edit 1'
+
+
+def test_edits_during_all_runs(monkeypatch):
+    cache_key, runs = start(monkeypatch, job_funcs.JOB_ATTEMPTS)
+    with pytest.raises(http_funcs.StaleVersionError):
+        job_funcs.recalculation_job('job', cache_key, ['initial'], False, {})
+    assert len(runs) == job_funcs.JOB_ATTEMPTS
+    assert http_funcs.cache_load(cache_key).Info.sample.name == f'edit {job_funcs.JOB_ATTEMPTS}'
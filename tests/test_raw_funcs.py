@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_raw_funcs
+# ==========================================
+#
+# Parsing with compiled filter plans and the raw file cache against ap.smp.raw.to_raw and
+# ap.files.raw_file.open_file
+"""
+
+import pickle
+from datetime import datetime
+
+from programs import ap, filter_funcs, raw_funcs, sequence_funcs
+
+from .conftest import RAW_FILE, RAW_FILTER
+
+
+def test_to_raw(raw, tmp_path, monkeypatch):
+    monkeypatch.setattr(raw_funcs, 'raw_file_cache', raw_funcs.RawFileCache(str(tmp_path)))
+    key = raw_funcs.raw_file_cache.get_key(RAW_FILE, RAW_FILTER)
+    assert raw_funcs.raw_file_cache.get(key) is None
+    parsed = raw_funcs.to_raw([RAW_FILE], [RAW_FILTER])
+    assert raw_funcs.raw_file_cache.get(key) is not None
+    cached = raw_funcs.to_raw([RAW_FILE], [RAW_FILTER])
+    for each in [parsed, cached]:
+        assert {k: str(v) for k, v in vars(each).items() if k != 'sequence'} == \
+               {k: str(v) for k, v in vars(raw).items() if k != 'sequence'}
+        assert len(each.sequence) == len(raw.sequence)
+        for seq, expected in zip(each.sequence, raw.sequence):
+            assert str(vars(seq)) == str(vars(expected))
+
+
+def test_to_raw_concatenate(raw):
+    both = raw_funcs.to_raw([RAW_FILE, RAW_FILE], [RAW_FILTER, RAW_FILTER])
+    assert len(both.sequence) == 2 * len(raw.sequence)
+    assert [seq.index for seq in both.sequence] == list(range(len(both.sequence)))
+
+
+def test_qtegra_datetime():
+    plan = filter_funcs.get_filter_plan(RAW_FILTER)
+    for string in ['6/8/2019  8:20:51 PM', '6/8/2019  12:05:01 AM', '06/08/2019 23:20:51', '6/8/2019 8:20:51 pm']:
+        f = '%m/%d/%Y  %I:%M:%S %p' if "M" in string.upper() else '%m/%d/%Y  %H:%M:%S'
+        assert filter_funcs.parse_qtegra_datetime(string, plan) == \
+               datetime.strptime(string, f).isoformat(timespec='seconds')
+
+
+def test_open_file(raw, tmp_path):
+    plan = filter_funcs.get_filter_plan(RAW_FILTER)
+    assert plan.handler == 'Qtegra Exported XLS'
+    expected = ap.files.raw_file.open_file(RAW_FILE, plan.input_filter)
+    assert filter_funcs.open_file(RAW_FILE, plan) == expected
+    with open(RAW_FILE, 'rb') as f:
+        assert filter_funcs.open_file(f, plan) == expected
+    # Sequence files, of both versions
+    seq_plan = filter_funcs.FilterPlan([*plan.input_filter[:1], 3, *plan.input_filter[2:]])
+    file_path = str(tmp_path / 'raw.seq')
+    sequence_funcs.dump(raw.sequence, file_path)
+    sequences = filter_funcs.open_file(file_path, seq_plan)['sequences']
+    assert [seq.name for seq in sequences] == [seq.name for seq in raw.sequence]
+    with open(file_path, 'wb') as f:
+        pickle.dump(raw.sequence, f)
+    sequences = filter_funcs.open_file(file_path, seq_plan)['sequences']
+    assert [str(vars(seq)) for seq in sequences] == [str(vars(seq)) for seq in raw.sequence]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_regression_funcs
+# ==========================================
+#
+# Batched and incremental regressions against the per-series regressions of ararpy
+"""
+
+import numpy as np
+
+from programs import ap, regression_funcs
+
+
+def assert_same_results(results, expected):
+    for (lines, coeffs), (_lines, _coeffs) in zip(results, expected):
+        for line, _line in zip(lines, _lines):
+            if isinstance(_line[0], str):
+                assert line[0] == _line[0]
+            else:
+                assert np.allclose(np.array(line, dtype=float), np.array(_line, dtype=float),
+                                   rtol=1e-9, atol=1e-20, equal_nan=True)
+
+
+def get_points(raw):
+    return [points for *_, points in regression_funcs.get_series(raw)]
+
+
+def test_get_regression_results(raw):
+    points = get_points(raw)
+    results = regression_funcs.get_regression_results(points)
+    expected = [ap.calc.raw_funcs.get_raw_data_regression_results(each)[1:] for each in points]
+    assert_same_results(results, expected)
+
+
+def test_get_regression_results_padded():
+    # Series of different lengths, fewer than MIN_POINTS, and labelled as bad fittings
+    rng = np.random.default_rng(0)
+    points = []
+    for size in [3, 5, 8, 8, 12]:
+        x = np.sort(rng.uniform(10, 300, size))
+        points.append(np.stack([x, 5 + np.exp(-x / 100) + rng.normal(0, 0.01, size)], axis=1).tolist())
+    points.append([[1, 1], [2, 50], [3, 1], [4, 60], [5, 2]])
+    results = regression_funcs.get_regression_results(points)
+    expected = [ap.calc.raw_funcs.get_raw_data_regression_results(each)[1:] for each in points]
+    assert_same_results(results, expected)
+
+
+def test_fit_stats_toggles(raw):
+    # Sums updated with the toggled points and curves searched from the previous coefficients
+    # against a full refit of the selected points
+    regression_funcs.do_regression(raw)
+    rng = np.random.default_rng(1)
+    for sequence in raw.sequence[:10]:
+        for index in range(5):
+            x, y, mask = regression_funcs.get_points(sequence, index)
+            stats = regression_funcs.RegressionStats(x, y, mask)
+            coefficients = sequence.coefficients[index]
+            for _ in range(3):
+                toggled = stats.mask.copy()
+                toggled[rng.integers(len(mask))] ^= True
+                stats.update(x, y, toggled)
+                if stats.size < regression_funcs.MIN_POINTS:
+                    continue
+                lines, coefficients = regression_funcs.fit_stats(stats, x[toggled], y[toggled], coefficients)
+                points = np.stack([x[toggled], y[toggled]], axis=1).tolist()
+                expected, _ = ap.calc.raw_funcs.get_raw_data_regression_results(points)[1:]
+                linear = [regression_funcs.METHODS.index(each) for each in ['linest', 'quadratic', 'average']]
+                assert_same_results([([lines[i] for i in linear], [])], [([expected[i] for i in linear], [])])
+                for method in ['exponential', 'power']:
+                    line, _line = lines[regression_funcs.METHODS.index(method)], \
+                        expected[regression_funcs.METHODS.index(method)]
+                    # Curves are the same within the tolerance of the search where they are well determined
+                    if not isinstance(_line[0], str) and _line[3] > 0.9:
+                        assert np.allclose(line[:2], _line[:2], rtol=1e-4)
+            # Selecting the points again brings the sums back
+            sums = regression_funcs.RegressionStats(x, y, mask)
+            stats.update(x, y, mask)
+            assert np.allclose(stats.sums, sums.sums, rtol=1e-9, atol=1e-9 * np.abs(sums.sums).max())
+            assert np.allclose(stats.cross, sums.cross, rtol=1e-9, atol=1e-9 * np.abs(sums.cross).max())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+# ==========================================
+# Copyright 2024 Yang
+# webarar - test_sequence_funcs
+# ==========================================
+#
+# Round trips of version 2 .seq files and legacy pickled sequences
+"""
+
+import io
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from programs import regression_funcs, sequence_funcs
+
+
+def normalize(obj):
+    # Numbers of numpy as Python numbers and tuples as lists, as they are written to the archive
+    if isinstance(obj, dict):
+        return {k: normalize(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [normalize(i) for i in obj]
+    if isinstance(obj, np.ndarray):
+        return normalize(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def test_round_trip(raw):
+    regression_funcs.do_regression(raw)
+    raw.sequence[0].results[0][2] = ['BadFitting', float('nan'), float('nan'), float('nan')]
+    raw.sequence[0].coefficients[0][2] = []
+    loaded = sequence_funcs.load(io.BytesIO(sequence_funcs.dumps(raw.sequence)))
+    assert len(loaded) == len(raw.sequence)
+    for seq, expected in zip(loaded, raw.sequence):
+        assert str(normalize(vars(seq))) == str(normalize(vars(expected)))
+
+
+def test_results_only(raw):
+    regression_funcs.do_regression(raw)
+    loaded = sequence_funcs.load(io.BytesIO(sequence_funcs.dumps(raw.sequence)), results_only=True)
+    for seq, expected in zip(loaded, raw.sequence):
+        assert seq.data == [] and seq.flag == []
+        assert str(normalize(seq.results)) == str(normalize(expected.results))
+        assert seq.name == expected.name
+
+
+def test_legacy_pickle(raw):
+    loaded = sequence_funcs.load(io.BytesIO(pickle.dumps(raw.sequence)))
+    assert [seq.name for seq in loaded] == [seq.name for seq in raw.sequence]
+
+
+class Exploit:
+    def __reduce__(self):
+        return os.system, ('echo',)
+
+
+def test_legacy_pickle_refused():
+    with pytest.raises(pickle.UnpicklingError):
+        sequence_funcs.load(io.BytesIO(pickle.dumps([Exploit()])))
+
+
+def test_legacy_pickle_ararpy_refused():
+    # Only the classes of sequences are loaded, not any class of ararpy
+    data = b'(lp0\ncararpy.smp.export\nWorkbook\np1\na.'
+    with pytest.raises(pickle.UnpicklingError, match='ararpy.smp.export.Workbook'):
+        sequence_funcs.load(io.BytesIO(data))
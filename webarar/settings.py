@@ -124,6 +124,45 @@ CACHES = {
     }
 }
 
+# Memory budget of the per-worker LRU of live sample instances, in bytes of pickled size
+SAMPLE_LRU_MAX_BYTES = 268435456
+# How samples are stored in Redis: 'pickle', a single pickle per sample, or 'components',
+# a hash with one field per sample attribute so that edits only rewrite changed attributes
+SAMPLE_CACHE_MODE = 'pickle'
+# Compression of cached samples and raw data: 'zstd', 'lz4', 'zlib' or 'none'
+CACHE_CODEC = 'zstd'
+# Number of isochron regression results memoized per worker, by figure, selection and parameters
+ISOCHRON_MEMO_SIZE = 4096
+# Regressions of isochron figures after a click run 'serial', or in a 'thread' or 'process' pool
+# of ISOCHRON_WORKERS workers (None for the number of processors)
+ISOCHRON_EXECUTOR = 'serial'
+ISOCHRON_WORKERS = None
+# Run recalculation, raw data submission and parameter setting as background jobs unless a
+# request sends async=false, and number of processes running the jobs
+ASYNC_JOBS = False
+JOB_WORKERS = 2
+# Runs of a job before it fails when other requests keep changing its sample meanwhile
+JOB_ATTEMPTS = 3
+# Number of processes parsing raw files submitted together, None for the number of processors,
+# 0 or 1 to parse them in the web worker
+RAW_WORKERS = None
+# Number of processes running the combinations of random walker parameter sweeps, None for
+# the number of processors
+WALKER_WORKERS = None
+# Walkers simulated at most by the array walker engine
+WALKER_MAX_ATOMS = 1000000
+# Heating steps between two checkpoints of the walkers of a sweep combination of the array engine
+WALKER_CHECKPOINT_STEPS = 5
+# Parsed raw files are kept in RAW_CACHE_DIR (PRIVATE_DIR/raw_cache by default) up to this size
+RAW_CACHE_MAX_BYTES = 1073741824
+# Exported sequences are .npz archives. Legacy pickled .seq files are still imported, with
+# only the globals listed in sequence_funcs._PICKLE_GLOBALS (sequences, raw data, numpy
+# arrays and a few builtins) allowed, unless SEQUENCE_PICKLE_IMPORT is False.
+# Imported blanks keep their cycles unless SEQUENCE_IMPORT_RESULTS_ONLY is True or a
+# request sends results_only
+SEQUENCE_PICKLE_IMPORT = True
+SEQUENCE_IMPORT_RESULTS_ONLY = False
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -201,6 +240,17 @@ LOGGING = {
 
 # DATA_UPLOAD_MAX_MEMORY_SIZE为10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760
+# Uploaded files are streamed to temporary files in chunks of UPLOAD_CHUNK_SIZE bytes and
+# hashed as they arrive, instead of being kept in memory
+FILE_UPLOAD_HANDLERS = ['programs.upload_funcs.HashingUploadHandler']
+UPLOAD_CHUNK_SIZE = 1048576
+# Uploaded files are stored once in UPLOAD_BLOB_DIR, named by their SHA-256, and files in
+# UPLOAD_ROOT are links to them
+UPLOAD_BLOB_DIR = os.path.join(PRIVATE_DIR, 'blobs')
+# Stored files no longer linked from any upload path are removed at most once every
+# UPLOAD_GC_INTERVAL seconds, if older than UPLOAD_GC_GRACE seconds
+UPLOAD_GC_INTERVAL = 86400
+UPLOAD_GC_GRACE = 3600
 
 
 # SECURITY WARNING: don't run with debug turned on in production!